@@ -0,0 +1,76 @@
+# Benchmark: recall@k vs. per-query latency of the ANN index types against the exact flat baseline.
+# Uses synthetic clustered, normalized vectors of embedding dimension (no Azure calls) and sweeps
+# the search-time knobs (efSearch for HNSW, nprobe for IVF-PQ).
+# Run from the repo root: python -m benchmarks.bench_ann
+
+import os
+import sys
+import time
+import numpy as np
+import faiss
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.ann_index import build_index, apply_search_params
+
+DIMENSION = int(os.getenv("BENCH_DIM", "1536"))
+NTOTAL = int(os.getenv("BENCH_NTOTAL", "50000"))
+NQUERIES = int(os.getenv("BENCH_QUERIES", "200"))
+K = int(os.getenv("BENCH_K", "10"))
+N_TOPICS = 200
+NOISE = 1.0  # relative to unit-norm topic centers; intra-topic cosine around 0.5
+SWEEPS = {
+    "hnsw": ("efSearch", [16, 32, 64, 128, 256]),
+    "ivfpq": ("nprobe", [1, 4, 16, 64]),
+}
+
+# Function to draw vectors around random topic centers, roughly like document embeddings
+def synthetic_vectors(rng, centers, n):
+    topics = rng.integers(0, len(centers), n)
+    noise = rng.standard_normal((n, centers.shape[1]), dtype="float32") * (NOISE / np.sqrt(centers.shape[1]))
+    vectors = (centers[topics] + noise).astype("float32")
+    faiss.normalize_L2(vectors)
+    return vectors
+
+def recall_at_k(found, truth):
+    return np.mean([len(set(f) & set(t)) / len(t) for f, t in zip(found, truth)])
+
+# Function to time single-query searches, the way the app calls the index
+def timed_search(index, queries):
+    found = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), K)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(ids[0])
+    return found, np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+def report(label, found, truth, p50, p95, build_s=None):
+    build = f"{build_s:>9.1f}" if build_s is not None else f"{'':>9}"
+    print(f"{label:<28} | {recall_at_k(found, truth):>9.3f} | {p50:>8.3f} | {p95:>8.3f} | {build}")
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((N_TOPICS, DIMENSION), dtype="float32")
+    faiss.normalize_L2(centers)
+    vectors = synthetic_vectors(rng, centers, NTOTAL)
+    queries = synthetic_vectors(rng, centers, NQUERIES)
+
+    print(f"{NTOTAL} vectors, dim {DIMENSION}, {NQUERIES} queries, k={K}")
+    print(f"{'index':<28} | {'recall@' + str(K):>9} | {'p50 ms':>8} | {'p95 ms':>8} | {'build s':>9}")
+
+    start = time.perf_counter()
+    flat, _ = build_index(vectors, "flat")
+    build_s = time.perf_counter() - start
+    truth, p50, p95 = timed_search(flat, queries)
+    report("flat (exact)", truth, truth, p50, p95, build_s)
+
+    for kind, (param, values) in SWEEPS.items():
+        start = time.perf_counter()
+        index, meta = build_index(vectors, kind)
+        build_s = time.perf_counter() - start
+        for value in values:
+            apply_search_params(index, {"search": {param: value}})
+            found, p50, p95 = timed_search(index, queries)
+            report(f"{meta['factory']} {param}={value}", found, truth, p50, p95, build_s)
+            build_s = None
@@ -0,0 +1,47 @@
+# Micro-benchmark: per-call cost of the out-of-domain check as the index grows.
+# Compares the old per-request reconstruct-and-average against the precomputed domain model.
+# Run from the repo root: python -m benchmarks.bench_domain_check
+
+import os
+import sys
+import time
+import numpy as np
+import faiss
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.domain_model import build_domain_centroids_from_index, domain_similarity, normalize_rows
+
+DIMENSION = 1536
+SIZES = [1_000, 10_000, 50_000]
+REPEATS = 20
+
+# Old implementation, kept here only as the baseline
+def legacy_similarity(query_vec, index):
+    all_embeddings = index.reconstruct_n(0, index.ntotal)
+    avg_embedding = np.mean(all_embeddings, axis=0)
+    return np.dot(query_vec, avg_embedding) / (np.linalg.norm(query_vec) * np.linalg.norm(avg_embedding))
+
+def time_per_call(fn, repeats=REPEATS):
+    fn()  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return (time.perf_counter() - start) / repeats * 1000
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    query_vec = normalize_rows(rng.standard_normal((1, DIMENSION)))[0]
+
+    print(f"{'ntotal':>8} | {'legacy ms/call':>15} | {'centroid ms/call':>17} | {'build ms (once)':>16}")
+    for n in SIZES:
+        index = faiss.IndexFlatL2(DIMENSION)
+        index.add(normalize_rows(rng.standard_normal((n, DIMENSION))))
+        sources = [f"doc {i % 4}" for i in range(n)]
+
+        start = time.perf_counter()
+        centroids = build_domain_centroids_from_index(index, sources)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        legacy_ms = time_per_call(lambda: legacy_similarity(query_vec, index))
+        centroid_ms = time_per_call(lambda: domain_similarity(query_vec, centroids), repeats=REPEATS * 100)
+        print(f"{n:>8} | {legacy_ms:>15.3f} | {centroid_ms:>17.4f} | {build_ms:>16.1f}")
@@ -0,0 +1,349 @@
+# Offline end-to-end latency benchmark: drives ask_chatbot (BENCH_MODE=direct) or the Flask
+# /api/chat endpoint (BENCH_MODE=http) under concurrency, against local fake Azure OpenAI and Blob
+# Storage servers (benchmarks/fake_azure.py) and a synthetic corpus, so it runs with no network.
+# Reports p50/p95/p99 per stage (domain check, embed, search, rerank, pack, generate), throughput
+# and memory, and writes the numbers as JSON (BENCH_OUTPUT) to compare runs (BENCH_BASELINE).
+# Run from the repo root: python -m benchmarks.bench_e2e
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import faiss
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from benchmarks.fake_azure import start_fake_servers, fake_embedding
+from utils.ann_index import build_index
+from utils.chunk_store import CHUNK_STORE_FILE_NAME, write_chunk_store, corpus_fingerprint
+from utils.lexical_index import LEXICAL_INDEX_FILE_NAME, build_lexical_index
+from utils.domain_model import DOMAIN_MODEL_FILE_NAME, DOMAIN_THRESHOLD, build_domain_centroids, save_domain_model, domain_similarity
+from utils.shards import SHARD_MANIFEST_FILE_NAME, group_chunks_by_shard, shard_entry, save_shard_manifest, generation_blob_name
+
+BENCH_MODE = os.getenv("BENCH_MODE", "direct")  # direct or http
+REQUESTS = int(os.getenv("BENCH_REQUESTS", "200"))
+CONCURRENCY = int(os.getenv("BENCH_CONCURRENCY", "8"))
+WARMUP = int(os.getenv("BENCH_WARMUP", "10"))
+N_DOCS = int(os.getenv("BENCH_DOCS", "8"))
+CHUNKS_PER_DOC = int(os.getenv("BENCH_CHUNKS_PER_DOC", "250"))
+KEEP_CACHES = os.getenv("BENCH_CACHES", "false").lower() in ("1", "true", "yes")
+OUTPUT_PATH = os.getenv("BENCH_OUTPUT")
+BASELINE_PATH = os.getenv("BENCH_BASELINE")
+MIN_GENERATED = float(os.getenv("BENCH_MIN_GENERATED", "0.9"))  # fail when a smaller fraction of requests reaches generation
+FAKE_CONFIG = {
+    "embed_latency_ms": float(os.getenv("BENCH_EMBED_LATENCY_MS", "20")),
+    "chat_latency_ms": float(os.getenv("BENCH_CHAT_LATENCY_MS", "300")),
+    "token_latency_ms": float(os.getenv("BENCH_TOKEN_LATENCY_MS", "2")),
+    "completion_tokens": int(os.getenv("BENCH_COMPLETION_TOKENS", "120")),
+    "error_rate": float(os.getenv("BENCH_ERROR_RATE", "0")),
+    "retry_after_ms": int(os.getenv("BENCH_RETRY_AFTER_MS", "50"))
+}
+CONTAINER = "embeddings"
+STAGES = ["domain", "embed", "search", "rerank", "pack", "generate"]
+COMMON_WORDS = ("consumer market brand retail price quality online store shopper trend survey share "
+                "growth digital loyalty value segment channel product service demand").split()
+
+
+# Function to write a synthetic corpus as the embedder would: shards, chunk store, lexical index
+# and domain model in BLOB_ROOT/<container>. Each document has its own small vocabulary, so queries
+# drawn from a document retrieve it. Returns the chunks and the domain centroids.
+def build_corpus(container_dir, rng):
+    chunks = []
+    for d in range(N_DOCS):
+        vocabulary = [f"doc{d}term{i}" for i in range(16)]
+        for c in range(CHUNKS_PER_DOC):
+            n_words = int(rng.integers(80, 120))
+            words = [vocabulary[i] for i in rng.integers(0, len(vocabulary), n_words)]
+            for position in rng.integers(0, n_words, n_words // 3):
+                words[position] = COMMON_WORDS[rng.integers(0, len(COMMON_WORDS))]
+            chunks.append({
+                "text": " ".join(words) + ".",
+                "source": f"Report {d}",
+                "year": 2022 + d % 3,
+                "section": f"Section {c * 5 // CHUNKS_PER_DOC}",
+                "page_start": c // 3 + 1,
+                "page_end": c // 3 + 1,
+                "token_count": n_words + 1
+            })
+    vectors = np.vstack([fake_embedding(chunk["text"]) for chunk in chunks]).astype("float32")
+
+    order, groups = group_chunks_by_shard(chunks)
+    chunks = [chunks[i] for i in order]
+    vectors = vectors[order]
+    generation = "bench"
+    artifacts = {name: generation_blob_name(generation, file_name) for name, file_name in
+                 [("chunk_store", CHUNK_STORE_FILE_NAME), ("lexical_index", LEXICAL_INDEX_FILE_NAME), ("domain_model", DOMAIN_MODEL_FILE_NAME)]}
+    os.makedirs(os.path.join(container_dir, generation_blob_name(generation, "shards")), exist_ok=True)
+    entries = []
+    for name, start, end in groups:
+        index, index_meta = build_index(vectors[start:end])
+        entry = shard_entry(name, start, end, chunks[start:end], index_meta, generation)
+        faiss.write_index(index, os.path.join(container_dir, entry["index"]))
+        entries.append(entry)
+    write_chunk_store(os.path.join(container_dir, artifacts["chunk_store"]), chunks)
+    fingerprint = corpus_fingerprint(os.path.join(container_dir, artifacts["chunk_store"]))
+    build_lexical_index((chunk["text"] for chunk in chunks), fingerprint).save(os.path.join(container_dir, artifacts["lexical_index"]))
+    centroids = build_domain_centroids(vectors, [chunk["source"] for chunk in chunks])
+    save_domain_model(os.path.join(container_dir, artifacts["domain_model"]), centroids, len(chunks), fingerprint)
+    save_shard_manifest(os.path.join(container_dir, SHARD_MANIFEST_FILE_NAME), entries, generation, artifacts, fingerprint)
+    return chunks, centroids
+
+# Function to draw a question from a random chunk's words. A random sample of words does not always
+# land close enough to a centroid, so questions are drawn until one passes the app's domain check
+# (the fake embedding is the one the app gets), and every request exercises the whole pipeline.
+def make_query(chunks, centroids, rng, attempts=1000):
+    for _ in range(attempts):
+        words = chunks[rng.randrange(len(chunks))]["text"].rstrip(".").split()
+        query = "What does the report say about " + " ".join(rng.sample(words, min(30, len(words)))) + "?"
+        if domain_similarity(fake_embedding(query), centroids) >= DOMAIN_THRESHOLD:
+            return query
+    raise RuntimeError(f"No in-domain question found in {attempts} draws; is DOMAIN_THRESHOLD too high for the synthetic corpus?")
+
+
+# Per-thread stage timer. Each wrapped call records its own time minus the wrapped calls inside it,
+# so nested stages (the domain check embeds the query) are not counted twice.
+class StageTimer:
+    def __init__(self):
+        self.local = threading.local()
+
+    def begin(self):
+        self.local.stages = {}
+        self.local.stack = []
+
+    def end(self):
+        stages, self.local.stages = self.local.stages, None
+        return stages
+
+    def wrap(self, stage, fn):
+        def timed(*args, **kwargs):
+            stages = getattr(self.local, "stages", None)
+            if stages is None:
+                return fn(*args, **kwargs)
+            self.local.stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                inner = self.local.stack.pop()
+                stages[stage] = stages.get(stage, 0.0) + (elapsed - inner) * 1000
+                if self.local.stack:
+                    self.local.stack[-1] += elapsed
+        return timed
+
+# Function to time the pipeline stages by wrapping the functions that implement them
+def instrument(timer, retriever, chat_code, openai_client):
+    chat_code.is_out_of_domain = timer.wrap("domain", chat_code.is_out_of_domain)
+    retriever.embed_queries = timer.wrap("embed", retriever.embed_queries)
+    retriever.search_index = timer.wrap("search", retriever.search_index)
+    retriever.rerank_chunks = timer.wrap("rerank", retriever.rerank_chunks)
+    chat_code.build_chat_request = timer.wrap("pack", chat_code.build_chat_request)
+    # Chat completion calls (generation, and the LLM reranker when enabled)
+    completions = openai_client.chat.completions
+    completions.create = timer.wrap("generate", completions.create)
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except (OSError, ValueError):
+        return None
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+def percentiles(values):
+    if not values:
+        return None
+    values = np.asarray(values)
+    return {
+        "p50": round(float(np.percentile(values, 50)), 2),
+        "p95": round(float(np.percentile(values, 95)), 2),
+        "p99": round(float(np.percentile(values, 99)), 2),
+        "mean": round(float(values.mean()), 2),
+        "count": int(len(values))
+    }
+
+# Function to run the requests with CONCURRENCY workers; send(query) returns (reply, stages)
+def run_load(send, queries):
+    records = []
+    lock = threading.Lock()
+
+    def one(query):
+        start = time.perf_counter()
+        try:
+            reply, stages = send(query)
+        except Exception as e:
+            print("❌ Request failed:", e)
+            reply, stages = None, {}
+        total = (time.perf_counter() - start) * 1000
+        with lock:
+            records.append({"reply": reply, "total": total, "stages": stages})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor:
+        list(executor.map(one, queries))
+    return records, time.perf_counter() - start
+
+# server_stages: [{"reply", "stages"}] recorded on the server in http mode
+def summarize(records, wall_s, error_reply, out_of_domain_reply, server_stages=None):
+    answered = [r for r in records if r["reply"] not in (None, error_reply, out_of_domain_reply)]
+    # Stage percentiles only cover requests answered in domain, so every stage has the same population
+    stage_records = [r["stages"] for r in (server_stages if server_stages is not None else records)
+                     if r["reply"] not in (None, error_reply, out_of_domain_reply)]
+    latency = {"total": percentiles([r["total"] for r in records])}
+    for stage in STAGES:
+        latency[stage] = percentiles([stages[stage] for stages in stage_records if stage in stages])
+    return {
+        "requests": len(records),
+        "answered": len(answered),
+        "errors": sum(r["reply"] in (None, error_reply) for r in records),
+        "out_of_domain": sum(r["reply"] == out_of_domain_reply for r in records),
+        "wall_s": round(wall_s, 3),
+        "throughput_rps": round(len(records) / wall_s, 2) if wall_s else None,
+        "latency_ms": latency
+    }
+
+def print_report(report, baseline=None):
+    print(f"\n{report['config']['mode']} mode, {report['requests']} requests, concurrency {report['config']['concurrency']}, "
+          f"{report['answered']} answered, {report['errors']} errors, {report['out_of_domain']} out of domain, {report['throughput_rps']} req/s")
+    print("stage percentiles are over answered requests; total is over all requests")
+    print(f"memory: {report['memory_mb']['after_load']} MB after load, {report['memory_mb']['peak']} MB peak")
+    header = f"{'stage':<10} | {'p50 ms':>9} | {'p95 ms':>9} | {'p99 ms':>9} | {'mean ms':>9}"
+    print(header + (" | vs baseline p50 / p95" if baseline else ""))
+    for stage in ["total"] + STAGES:
+        values = report["latency_ms"].get(stage)
+        if values is None:
+            print(f"{stage:<10} | {'-':>9} | {'-':>9} | {'-':>9} | {'-':>9}")
+            continue
+        line = f"{stage:<10} | {values['p50']:>9.2f} | {values['p95']:>9.2f} | {values['p99']:>9.2f} | {values['mean']:>9.2f}"
+        before = (baseline or {}).get("latency_ms", {}).get(stage)
+        if before:
+            change = [f"{(values[p] - before[p]) / before[p] * 100:+.1f}%" if before[p] else "-" for p in ("p50", "p95")]
+            line += f" | {change[0]} / {change[1]}"
+        print(line)
+
+if __name__ == "__main__":
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    server_process = None
+    try:
+        rng = np.random.default_rng(0)
+        blob_root = os.path.join(workdir, "blobs")
+        build_start = time.perf_counter()
+        chunks, centroids = build_corpus(os.path.join(blob_root, CONTAINER), rng)
+        print(f"🧮 Built a corpus of {len(chunks)} chunks in {N_DOCS} documents in {time.perf_counter() - build_start:.1f}s")
+
+        server_process, server_env = start_fake_servers(blob_root, FAKE_CONFIG)
+        os.environ.update(server_env)
+        os.environ.update({
+            "EMBEDDINGS_CONTAINER_NAME": CONTAINER,
+            "AZURE_OPENAI_EMBEDDING_DEPLOYMENT": "fake-embedding",
+            "DEPLOYMENT_NAME": "fake-chat",
+            "AZURE_OPENAI_API_VERSION": "2024-06-01",
+            "ARTIFACT_STORE": "blob",
+            "INDEX_RELOAD_INTERVAL": "0"
+        })
+        if not KEEP_CACHES:
+            os.environ["ANSWER_CACHE_ENABLED"] = "false"
+            os.environ["EMBED_CACHE_SIZE"] = "0"
+        # temp/ and logs/ of this run stay in the work directory
+        os.chdir(workdir)
+
+        load_start = time.perf_counter()
+        import retriever
+        import chat_code
+        from utils.clients import get_openai_client
+        load_s = time.perf_counter() - load_start
+        rss_after_load = rss_mb()
+
+        timer = StageTimer()
+        instrument(timer, retriever, chat_code, get_openai_client())
+        query_rng = random.Random(1)
+        queries = [make_query(chunks, centroids, query_rng) for _ in range(WARMUP + REQUESTS)]
+        server_stages = None
+
+        if BENCH_MODE == "http":
+            import requests
+            from werkzeug.serving import make_server, WSGIRequestHandler
+            import app as flask_app
+            server_stages = []
+            stages_lock = threading.Lock()
+            ask_chatbot = flask_app.ask_chatbot
+
+            # The endpoint's stage timings are collected on the server thread handling each request
+            def timed_ask_chatbot(*args, **kwargs):
+                timer.begin()
+                reply = None
+                try:
+                    result = ask_chatbot(*args, **kwargs)
+                    reply = result["reply"]
+                    return result
+                finally:
+                    stages = timer.end()
+                    with stages_lock:
+                        server_stages.append({"reply": reply, "stages": stages})
+            flask_app.ask_chatbot = timed_ask_chatbot
+
+            class QuietRequestHandler(WSGIRequestHandler):
+                def log_request(self, *args, **kwargs):
+                    pass
+
+            http_server = make_server("127.0.0.1", 0, flask_app.app, threaded=True, request_handler=QuietRequestHandler)
+            threading.Thread(target=http_server.serve_forever, daemon=True).start()
+            url = f"http://127.0.0.1:{http_server.server_port}/api/chat"
+            sessions = threading.local()
+
+            def send(query):
+                if not hasattr(sessions, "session"):
+                    sessions.session = requests.Session()
+                response = sessions.session.post(url, json={"messages": [{"role": "user", "content": query}]}, timeout=120)
+                return response.json().get("reply") if response.status_code == 200 else None, {}
+        else:
+            def send(query):
+                timer.begin()
+                try:
+                    result = chat_code.ask_chatbot(query, chat_history=[{"role": "user", "content": query}])
+                finally:
+                    stages = timer.end()
+                return result["reply"], stages
+
+        run_load(send, queries[:WARMUP])
+        if server_stages is not None:
+            server_stages.clear()
+        records, wall_s = run_load(send, queries[WARMUP:])
+
+        report = summarize(records, wall_s, chat_code.ERROR_REPLY, chat_code.OUT_OF_DOMAIN_REPLY, server_stages)
+        report["config"] = {
+            "mode": BENCH_MODE, "concurrency": CONCURRENCY, "warmup": WARMUP, "chunks": len(chunks),
+            "documents": N_DOCS, "caches": KEEP_CACHES, "fake_servers": FAKE_CONFIG,
+            "retrieval_mode": retriever.RETRIEVAL_MODE, "rerank_mode": retriever.RERANK_MODE
+        }
+        report["startup_s"] = round(load_s, 3)
+        report["memory_mb"] = {"after_load": round(rss_after_load, 1) if rss_after_load else None, "peak": round(peak_rss_mb(), 1)}
+
+        baseline = None
+        if BASELINE_PATH:
+            with open(BASELINE_PATH, "r", encoding="utf-8") as f:
+                baseline = json.load(f)
+        print_report(report, baseline)
+        if OUTPUT_PATH:
+            with open(OUTPUT_PATH, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2)
+            print(f"✅ Wrote {OUTPUT_PATH}")
+        if report["answered"] < MIN_GENERATED * report["requests"]:
+            print(f"❌ Only {report['answered']} of {report['requests']} requests were answered (BENCH_MIN_GENERATED={MIN_GENERATED}); "
+                  "the stage numbers do not describe the full pipeline")
+            sys.exit(1)
+    finally:
+        if server_process is not None:
+            server_process.terminate()
+        shutil.rmtree(workdir, ignore_errors=True)
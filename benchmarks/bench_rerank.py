@@ -0,0 +1,59 @@
+# Benchmark: local (BM25 + FAISS) reranker vs. LLM reranker on evaluation/test_cases.json.
+# Reports per-call rerank latency and how closely the two modes agree on the final top-k.
+# Needs the same .env as the app (embeddings and the LLM reranker call Azure OpenAI).
+# Run from the repo root: python -m benchmarks.bench_rerank
+
+import os
+import sys
+import json
+import time
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+import retriever
+
+K = int(os.getenv("BENCH_K", "5"))
+TEST_CASES_PATH = os.path.join(os.path.dirname(__file__), '..', 'evaluation', 'test_cases.json')
+
+# Function to collect first-stage candidates exactly as retrieve_top_k does
+def first_stage(query, threshold=0.6):
+    query_ctx = retriever.QueryContext(query)
+    scores, indices = retriever.search_index(query_ctx.embed(), max(K, retriever.RERANK_CANDIDATES), generation=query_ctx.generation)
+    chunks, similarities, chunk_ids = [], [], []
+    for i, similarity in zip(indices, scores):
+        if similarity >= threshold:
+            chunks.append(query_ctx.generation.chunk_store[i])
+            similarities.append(similarity)
+            chunk_ids.append(i)
+    return chunks, similarities, chunk_ids
+
+def timed_rerank(mode, query, chunks, similarities, chunk_ids):
+    start = time.perf_counter()
+    ranked = retriever.rerank_chunks(query, chunks, similarities, chunk_ids, mode=mode)[:K]
+    return ranked, (time.perf_counter() - start) * 1000
+
+if __name__ == "__main__":
+    with open(TEST_CASES_PATH, "r", encoding="utf-8") as f:
+        test_cases = json.load(f)
+
+    latencies = {"local": [], "llm": []}
+    overlaps = []
+    top1_matches = 0
+    for case in test_cases:
+        chunks, similarities, chunk_ids = first_stage(case["query"])
+        ranked = {}
+        for mode in ("local", "llm"):
+            ranked[mode], ms = timed_rerank(mode, case["query"], chunks, similarities, chunk_ids)
+            latencies[mode].append(ms)
+        local_texts = [c["text"] for c in ranked["local"]]
+        llm_texts = [c["text"] for c in ranked["llm"]]
+        if local_texts and llm_texts:
+            overlaps.append(len(set(local_texts) & set(llm_texts)) / len(llm_texts))
+            top1_matches += local_texts[0] == llm_texts[0]
+
+    for mode, values in latencies.items():
+        print(f"{mode:>5} rerank: p50 {np.percentile(values, 50):8.2f} ms | p95 {np.percentile(values, 95):8.2f} ms")
+    if overlaps:
+        print(f"Overlap@{K} (local vs llm): {np.mean(overlaps):.3f}")
+        print(f"Top-1 agreement: {top1_matches / len(overlaps):.3f} over {len(overlaps)} queries")
@@ -0,0 +1,63 @@
+# Startup-time benchmark for index artifacts, using a local directory as the blob-store stand-in.
+# Compares the old path (read the whole artifact into memory, write it, load the index into RAM)
+# with the ETag-checked, streamed, memory-mapped path on cold and warm starts.
+# Run from the repo root: python -m benchmarks.bench_startup
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+import faiss
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.artifacts import LocalArtifactStore, load_faiss_index
+
+DIMENSION = 1536
+SIZES = [10_000, 50_000, 100_000]
+
+# Old implementation, kept here only as the baseline
+def legacy_startup(store_dir, local_path):
+    with open(os.path.join(store_dir, "index.faiss"), "rb") as src:
+        data = src.read()
+    with open(local_path, "wb") as f:
+        f.write(data)
+    return faiss.read_index(local_path)
+
+def new_startup(store, local_path):
+    store.fetch("index.faiss", local_path)
+    return load_faiss_index(local_path)
+
+def timed(fn):
+    start = time.perf_counter()
+    index = fn()
+    elapsed = (time.perf_counter() - start) * 1000
+    assert index.ntotal > 0
+    return elapsed
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    print(f"{'ntotal':>8} | {'size MB':>8} | {'legacy ms':>10} | {'cold ms':>9} | {'warm ms':>9}")
+    for n in SIZES:
+        workdir = tempfile.mkdtemp()
+        try:
+            store_dir = os.path.join(workdir, "store")
+            local_dir = os.path.join(workdir, "local")
+            os.makedirs(store_dir)
+            os.makedirs(local_dir)
+
+            index = faiss.IndexFlatL2(DIMENSION)
+            index.add(rng.standard_normal((n, DIMENSION), dtype="float32"))
+            faiss.write_index(index, os.path.join(store_dir, "index.faiss"))
+            size_mb = os.path.getsize(os.path.join(store_dir, "index.faiss")) / 1e6
+            del index
+
+            legacy_ms = timed(lambda: legacy_startup(store_dir, os.path.join(local_dir, "legacy.faiss")))
+            store = LocalArtifactStore(store_dir)
+            local_path = os.path.join(local_dir, "index.faiss")
+            cold_ms = timed(lambda: new_startup(store, local_path))
+            warm_ms = timed(lambda: new_startup(store, local_path))
+            print(f"{n:>8} | {size_mb:>8.1f} | {legacy_ms:>10.1f} | {cold_ms:>9.1f} | {warm_ms:>9.2f}")
+        finally:
+            shutil.rmtree(workdir)
@@ -0,0 +1,236 @@
+# Local stand-ins for Azure OpenAI (embeddings + chat completions, streamed or not) and Azure Blob
+# Storage (conditional, ranged blob downloads), for offline benchmarks. Latency and 429s are injectable.
+# The real SDK clients talk to them over HTTP, so connection pooling, retries and parsing are exercised.
+#
+# Standalone: python -m benchmarks.fake_azure BLOB_ROOT   (BLOB_ROOT/<container>/<blob> are served)
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import hashlib
+import functools
+import threading
+import multiprocessing
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+import numpy as np
+
+EMBED_DIMENSION = int(os.getenv("FAKE_EMBED_DIMENSION", "256"))
+BLOB_ACCOUNT = "devstoreaccount1"
+BLOB_ACCOUNT_KEY = "RmFrZUtleUZvckxvY2FsQmVuY2htYXJrc09ubHk="  # any base64 value; the fake does not check it
+
+DEFAULT_CONFIG = {
+    "embed_latency_ms": 20.0,
+    "chat_latency_ms": 300.0,     # time to first token
+    "token_latency_ms": 5.0,      # per completion token
+    "completion_tokens": 120,
+    "error_rate": 0.0,            # fraction of OpenAI requests answered with 429
+    "retry_after_ms": 50,
+    "blob_latency_ms": 2.0
+}
+
+@functools.lru_cache(maxsize=100_000)
+def token_vector(token, dimension=EMBED_DIMENSION):
+    return np.random.default_rng(zlib.crc32(token.encode("utf-8"))).standard_normal(dimension).astype("float32")
+
+# Function to embed text as a normalized bag of hashed word vectors: texts sharing words are similar,
+# which is enough for retrieval, domain checks and reranking to behave like they do on real embeddings
+def fake_embedding(text, dimension=EMBED_DIMENSION):
+    tokens = re.findall(r"\w+", text.lower()) or [text]
+    vector = np.sum([token_vector(token, dimension) for token in tokens], axis=0)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = DEFAULT_CONFIG
+
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        path = urlparse(self.path).path
+        if random.random() < self.config["error_rate"]:
+            retry_after = self.config["retry_after_ms"]
+            self.send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded."}},
+                           {"retry-after-ms": str(retry_after), "retry-after": str(max(1, round(retry_after / 1000)))})
+            return
+        if path.endswith("/embeddings"):
+            self.embeddings(body)
+        elif path.endswith("/chat/completions"):
+            self.chat(body)
+        else:
+            self.send_json(404, {"error": {"code": "404", "message": "Resource not found"}})
+
+    def embeddings(self, body):
+        texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        time.sleep(self.config["embed_latency_ms"] / 1000)
+        tokens = sum(len(text.split()) for text in texts)
+        self.send_json(200, {
+            "object": "list",
+            "data": [{"object": "embedding", "index": i, "embedding": fake_embedding(text).tolist()} for i, text in enumerate(texts)],
+            "model": "fake-embedding",
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens}
+        })
+
+    def chat(self, body):
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+        completion_tokens = min(int(body.get("max_tokens") or self.config["completion_tokens"]), self.config["completion_tokens"])
+        words = [f"word{i % 50}" for i in range(completion_tokens)]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        base = {"id": "chatcmpl-fake", "created": int(time.time()), "model": "fake-chat"}
+        time.sleep(self.config["chat_latency_ms"] / 1000)
+
+        if not body.get("stream"):
+            time.sleep(self.config["token_latency_ms"] * completion_tokens / 1000)
+            self.send_json(200, dict(base, object="chat.completion", usage=usage, choices=[
+                {"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}
+            ]))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        for i, word in enumerate(words):
+            time.sleep(self.config["token_latency_ms"] / 1000)
+            delta = {"content": word if i == 0 else " " + word}
+            send_event(json.dumps(dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": delta, "finish_reason": None}])))
+        send_event(json.dumps(dict(base, object="chat.completion.chunk", choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send_event(json.dumps(dict(base, object="chat.completion.chunk", choices=[], usage=usage)))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+# Serves BLOB_ROOT/<container>/<blob> the way Blob Storage does for downloads:
+# x-ms-range / Range requests, ETag with If-None-Match (304), BlobNotFound errors
+class FakeBlobHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    root = "."
+    config = DEFAULT_CONFIG
+
+    def log_message(self, *args):
+        pass
+
+    def blob_path(self):
+        parts = unquote(urlparse(self.path).path).lstrip("/").split("/", 2)
+        if len(parts) < 3 or parts[0] != BLOB_ACCOUNT:
+            return None
+        return os.path.join(self.root, parts[1], parts[2])
+
+    def send_error_code(self, status, code):
+        body = f'<?xml version="1.0" encoding="utf-8"?><Error><Code>{code}</Code><Message>{code}</Message></Error>'.encode("utf-8")
+        self.send_response(status)
+        self.send_header("x-ms-error-code", code)
+        self.send_header("Content-Type", "application/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.config["blob_latency_ms"] / 1000)
+        path = self.blob_path()
+        if path is None or not os.path.isfile(path):
+            self.send_error_code(404, "BlobNotFound")
+            return
+        stat = os.stat(path)
+        etag = '"0x' + hashlib.sha1(f"{stat.st_size}-{stat.st_mtime_ns}".encode("ascii")).hexdigest()[:16].upper() + '"'
+        headers = {
+            "ETag": etag,
+            "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+            "x-ms-blob-type": "BlockBlob",
+            "x-ms-version": "2023-11-03",
+            "Accept-Ranges": "bytes"
+        }
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("x-ms-error-code", "ConditionNotMet")
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        size = stat.st_size
+        start, end = 0, size - 1
+        requested = self.headers.get("x-ms-range") or self.headers.get("Range")
+        match = re.match(r"bytes=(\d+)-(\d*)", requested or "")
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            if start >= size:
+                self.send_error_code(416, "InvalidRange")
+                return
+        with open(path, "rb") as f:
+            f.seek(start)
+            body = f.read(end - start + 1)
+        self.send_response(206 if match else 200)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def blob_connection_string(port):
+    return (f"DefaultEndpointsProtocol=http;AccountName={BLOB_ACCOUNT};AccountKey={BLOB_ACCOUNT_KEY};"
+            f"BlobEndpoint=http://127.0.0.1:{port}/{BLOB_ACCOUNT};")
+
+# Function to run both servers in this process until it is killed; reports (openai port, blob port) on ports_queue
+def serve(blob_root, config=None, ports_queue=None):
+    config = dict(DEFAULT_CONFIG, **(config or {}))
+    openai_handler = type("OpenAIHandler", (FakeOpenAIHandler,), {"config": config})
+    blob_handler = type("BlobHandler", (FakeBlobHandler,), {"config": config, "root": blob_root})
+    servers = [ThreadingHTTPServer(("127.0.0.1", 0), openai_handler), ThreadingHTTPServer(("127.0.0.1", 0), blob_handler)]
+    for server in servers:
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ports = tuple(server.server_address[1] for server in servers)
+    if ports_queue is not None:
+        ports_queue.put(ports)
+    else:
+        print(f"OpenAI endpoint: http://127.0.0.1:{ports[0]}")
+        print(f"Blob connection string: {blob_connection_string(ports[1])}")
+    threading.Event().wait()
+
+# Function to start the servers in a child process, so they do not compete with the app for the GIL.
+# Returns (process, environment variables pointing the app's clients at them).
+def start_fake_servers(blob_root, config=None):
+    ports_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(blob_root, config, ports_queue), daemon=True)
+    process.start()
+    openai_port, blob_port = ports_queue.get(timeout=30)
+    return process, {
+        "AZURE_OPENAI_ENDPOINT": f"http://127.0.0.1:{openai_port}",
+        "AZURE_OPENAI_API_KEY": "fake-key",
+        "AZURE_STORAGE_CONNECTION_STRING": blob_connection_string(blob_port)
+    }
+
+if __name__ == "__main__":
+    serve(sys.argv[1] if len(sys.argv) > 1 else ".")
@@ -1,47 +1,145 @@
-import json
+# Evaluation runner: answers the test cases with the chatbot on a bounded worker pool, scores the
+# answers against the expected ones (BERTScore, exact/fuzzy fact match, BLEU, ROUGE-L) and writes
+# the summary, a per-case spreadsheet and a chart.
+#
+# Answers are cached by (query, prompt version, index version, strategy) and scores by
+# (expected, answer), both appended to JSON-lines files as each one completes. An interrupted run
+# resumes where it stopped, re-scoring never re-queries the model, and after a prompt edit only the
+# changed answers are generated and scored.
+#
+# Run from the repo root: python -m evaluation.eval [--workers 4] [--strategy cot] [--rescore]
+
 import os
 import re
-from openai import AzureOpenAI
-import matplotlib.pyplot as plt
+import sys
+import json
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 from fuzzywuzzy import fuzz
-from bert_score import score as bert_score
 from dotenv import load_dotenv
 from rouge_score import rouge_scorer
 from nltk.translate.bleu_score import sentence_bleu
 
-# Import retriever and ask_chatbot functions
-from src.retriever import retrieve_top_k
-from src.chat_code import ask_chatbot
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from utils.clients import get_openai_client
 
 # Load environment variables
 load_dotenv()
 base_folder = os.getenv("BASE_FOLDER_PATH")
 
-# Azure OpenAI client for GPT-based evaluation
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version="2023-05-15"
-)
+# Azure OpenAI deployment for GPT-based evaluation (client shared via utils.clients)
 CHAT_MODEL = os.getenv("DEPLOYMENT_NAME")
 
-# Load test cases
-results_path = os.path.join(os.path.dirname(__file__), "test_cases.json")
-with open(results_path, "r", encoding="utf-8") as f:
-    test_cases = json.load(f)
+EVAL_DIR = os.path.dirname(__file__)
+EVAL_CACHE_DIR = os.getenv("EVAL_CACHE_DIR", os.path.join(EVAL_DIR, "cache"))
+EVAL_WORKERS = int(os.getenv("EVAL_WORKERS", "4"))  # concurrent chatbot calls; keep under the deployment's rate limit
+EVAL_BERTSCORE_BATCH_SIZE = int(os.getenv("EVAL_BERTSCORE_BATCH_SIZE", "32"))
+METRICS = ["bertscore_precision", "bertscore_recall", "bertscore_f1", "exact_match", "fuzzy_score", "bleu", "rouge_l"]
+
+
+# Append-only JSON-lines cache: one {"key": ..., ...} object per line, the last line for a key wins.
+# Each entry is flushed as soon as it is added, so a crash loses at most the entry being written.
+class JsonlCache:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by an interrupted run
+                    self.entries[entry["key"]] = entry
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def put(self, key, value):
+        entry = dict(value, key=key)
+        with self.lock:
+            self.entries[key] = entry
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        return entry
+
+def cache_key(*parts):
+    return hashlib.sha256("\x00".join(str(part) for part in parts).encode("utf-8")).hexdigest()
 
 # Function to extract concise factual answers
 def extract_facts(text):
     facts = re.findall(r'\b\d+%|\b\d+\b|(?:\b[A-Z][a-z]*\b\s?){1,3}', text)
     return ' '.join(facts)
 
-# Function to evaluate using BERTScore
-def evaluate_bertscore(results):
-    references = [result['expected'] for result in results]
-    candidates = [result['answer'] for result in results]
-    P, R, F1 = bert_score(candidates, references, lang="en", rescale_with_baseline=True)
-    return P.mean().item(), R.mean().item(), F1.mean().item()
+# Function to drop the reference tags ("[1] [2]") the chatbot appends, so only the answer is scored
+def strip_reference_tags(reply):
+    return re.sub(r'(\s*\[\d+\])+\s*$', '', reply)
+
+
+# Function to get the versions answers would be served with now (the answer cache key)
+def served_versions():
+    from chat_code import PROMPT_VERSION
+    from retriever import current_index
+    from utils.prompt_loader import get_prompts
+    return {"prompt": get_prompts(PROMPT_VERSION).version, "index": current_index().version}
+
+# Function to answer one test case with the full pipeline; ask_chatbot does the retrieval itself
+def answer_case(test_case, strategy, k):
+    from chat_code import ask_chatbot, ERROR_REPLY
+    result = ask_chatbot(test_case["query"], k=k, strategy=strategy)
+    return {
+        "answer": strip_reference_tags(result["reply"]),
+        "references": result["references"],
+        "versions": result["versions"],
+        # Failed calls are not cached, so the next run retries them
+        "failed": result["reply"] == ERROR_REPLY
+    }
+
+# Function to answer every case not in the answer cache, a bounded number at a time
+def generate_answers(test_cases, answers, strategy, k, workers=EVAL_WORKERS):
+    versions = served_versions()
+    keys = [cache_key(case["query"], versions["prompt"], versions["index"], strategy) for case in test_cases]
+    pending = {key: case for key, case in zip(keys, test_cases) if answers.get(key) is None}
+    print(f"🔄 {len(test_cases) - len(pending)} cached answers, {len(pending)} to generate with {workers} workers")
+
+    failed = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(answer_case, case, strategy, k): key for key, case in pending.items()}
+        for done, future in enumerate(as_completed(futures), start=1):
+            key = futures[future]
+            try:
+                answer = future.result()
+            except Exception as e:
+                answer = {"answer": "", "references": [], "versions": None, "failed": True, "error": str(e)}
+            if answer["failed"]:
+                failed[key] = answer
+                print(f"⚠️ [{done}/{len(pending)}] No answer for: {pending[key]['query']}")
+            else:
+                answers.put(key, dict(answer, query=pending[key]["query"], strategy=strategy))
+                print(f"✅ [{done}/{len(pending)}] {pending[key]['query']}")
+    return [failed.get(key) or answers.get(key) for key in keys]
+
+
+# BERTScore model loaded once per process, and only when there is something to score
+_bert_scorer = None
+
+def get_bert_scorer():
+    global _bert_scorer
+    if _bert_scorer is None:
+        from bert_score import BERTScorer
+        _bert_scorer = BERTScorer(lang="en", rescale_with_baseline=True)
+    return _bert_scorer
+
+# Function to evaluate using BERTScore, all pairs in batches
+def evaluate_bertscore(candidates, references):
+    P, R, F1 = get_bert_scorer().score(candidates, references, batch_size=EVAL_BERTSCORE_BATCH_SIZE)
+    return P.tolist(), R.tolist(), F1.tolist()
 
 # # Function to evaluate using GPT-based evaluation
 # def evaluate_gpt(results):
@@ -54,7 +152,7 @@ def evaluate_bertscore(results):
 # Model's Answer: {result['answer']}
 
 # Rating (1-5):"""
-#         response = client.chat.completions.create(
+#         response = get_openai_client().chat.completions.create(
 #             model=CHAT_MODEL,
 #             messages=[
 #                 {"role": "system", "content": "You are an evaluator."},
@@ -71,107 +169,154 @@ def evaluate_bertscore(results):
 #     return sum(scores) / len(scores)
 
 # Function to evaluate using exact match and fuzzy match
-def evaluate_exact_fuzzy(results):
-    exact_matches = 0
-    fuzzy_scores = []
-    for result in results:
-        expected_facts = extract_facts(result['expected'])
-        answer_facts = extract_facts(result['answer'])
-        if expected_facts == answer_facts:
-            exact_matches += 1
-        fuzzy_scores.append(fuzz.ratio(expected_facts, answer_facts))
-    exact_match_ratio = exact_matches / len(results)
-    avg_fuzzy_score = sum(fuzzy_scores) / len(fuzzy_scores)
-    return exact_match_ratio, avg_fuzzy_score
+def evaluate_exact_fuzzy(expected, answer):
+    expected_facts = extract_facts(expected)
+    answer_facts = extract_facts(answer)
+    return float(expected_facts == answer_facts), fuzz.ratio(expected_facts, answer_facts)
 
 # Function to evaluate using BLEU
-def evaluate_bleu(results):
-    scores = []
-    for result in results:
-        reference = result['expected'].split()
-        candidate = result['answer'].split()
-        score = sentence_bleu([reference], candidate)
-        scores.append(score)
-    return sum(scores) / len(scores)
+def evaluate_bleu(expected, answer):
+    return sentence_bleu([expected.split()], answer.split())
 
 # Function to evaluate using ROUGE-L
-def evaluate_rouge(results):
-    scorer = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
-    scores = []
-    for result in results:
-        score = scorer.score(result['answer'], result['expected'])['rougeL'].fmeasure
-        scores.append(score)
-    return sum(scores) / len(scores)
-
-# Generate answers using retriever and chatbot
-for test_case in test_cases:
-    query = test_case['query']
-    retrieved_chunks = retrieve_top_k(query, k=5)
-    answer = ask_chatbot(query, retrieved_chunks)
-    test_case['answer'] = answer
-
-# Evaluate using BERTScore
-bertscore_P, bertscore_R, bertscore_F1 = evaluate_bertscore(test_cases)
-
-# Evaluate using GPT-based evaluation
-# gpt_score = evaluate_gpt(test_cases)
-
-# Evaluate using exact match and fuzzy match
-exact_match_ratio, avg_fuzzy_score = evaluate_exact_fuzzy(test_cases)
-
-# Evaluate using BLEU
-bleu_score = evaluate_bleu(test_cases)
-
-# Evaluate using ROUGE-L
-rouge_l_score = evaluate_rouge(test_cases)
-
-# Print summary of all metrics
-print(f"BERTScore - Precision: {bertscore_P:.4f}, Recall: {bertscore_R:.4f}, F1: {bertscore_F1:.4f}")
-# print(f"GPT-based Evaluation - Average Score: {gpt_score:.2f} / 5")
-print(f"Exact Match Ratio: {exact_match_ratio:.4f}")
-print(f"Average Fuzzy Score: {avg_fuzzy_score:.2f}")
-print(f"BLEU Score: {bleu_score:.4f}")
-print(f"ROUGE-L Score: {rouge_l_score:.4f}")
-
-# Save the evaluation summary
-summary = {
-    "BERTScore": {
-        "Precision": bertscore_P,
-        "Recall": bertscore_R,
-        "F1": bertscore_F1
-    },
-    "GPT-based Evaluation": {
-        # "Average Score": gpt_score
-    },
-    "Exact Match Ratio": exact_match_ratio,
-    "Average Fuzzy Score": avg_fuzzy_score,
-    "BLEU Score": bleu_score,
-    "ROUGE-L Score": rouge_l_score
-}
-summary_path = os.path.join(os.path.dirname(__file__), "evaluation_summary.json")
-with open(summary_path, "w", encoding="utf-8") as f:
-    json.dump(summary, f, indent=2)
-print(f"✅ Evaluation summary saved to {summary_path}")
-
-# Save detailed results to Excel
-df = pd.DataFrame(test_cases)
-excel_path = os.path.join(os.path.dirname(__file__), "evaluation_results.xlsx")
-df.to_excel(excel_path, index=False)
-print(f"✅ Detailed results saved to {excel_path}")
-
-# Generate bar chart for visual comparison
-# metrics = ["BERTScore F1", "GPT Score", "Exact Match Ratio", "Fuzzy Score", "BLEU Score", "ROUGE-L Score"]
-metrics = ["BERTScore F1", "Exact Match Ratio", "Fuzzy Score", "BLEU Score", "ROUGE-L Score"]
-# values = [bertscore_F1, gpt_score, exact_match_ratio, avg_fuzzy_score, bleu_score, rouge_l_score]
-values = [bertscore_F1, exact_match_ratio, avg_fuzzy_score, bleu_score, rouge_l_score]
-
-plt.figure(figsize=(10, 6))
-plt.bar(metrics, values, color=['blue', 'green', 'red', 'purple', 'orange'])
-# plt.bar(metrics, values, color=['blue', 'green', 'red', 'purple', 'orange', 'cyan'])
-plt.xlabel('Metrics')
-plt.ylabel('Scores')
-plt.title('Evaluation Metrics Comparison')
-plt_path = os.path.join(os.path.dirname(__file__), "evaluation_metrics_comparison.png")
-plt.savefig(plt_path)
-plt.show()
-print(f"✅ Bar chart saved to {plt_path}")
\ No newline at end of file
+def evaluate_rouge(scorer, expected, answer):
+    return scorer.score(answer, expected)['rougeL'].fmeasure
+
+# Function to score every (expected, answer) pair not in the score cache, all metrics in one batch
+def score_answers(pairs, scores):
+    keys = [cache_key(expected, answer) for expected, answer in pairs]
+    pending = list({key: pair for key, pair in zip(keys, pairs) if scores.get(key) is None}.items())
+    if pending:
+        print(f"🔄 Scoring {len(pending)} answers ({len(pairs) - len(pending)} scores cached)")
+        references = [expected for _, (expected, _) in pending]
+        candidates = [answer for _, (_, answer) in pending]
+        precision, recall, f1 = evaluate_bertscore(candidates, references)
+        rouge = rouge_scorer.RougeScorer(['rougeL'], use_stemmer=True)
+        for i, (key, (expected, answer)) in enumerate(pending):
+            exact_match, fuzzy_score = evaluate_exact_fuzzy(expected, answer)
+            scores.put(key, {
+                "bertscore_precision": precision[i],
+                "bertscore_recall": recall[i],
+                "bertscore_f1": f1[i],
+                "exact_match": exact_match,
+                "fuzzy_score": fuzzy_score,
+                "bleu": evaluate_bleu(expected, answer),
+                "rouge_l": evaluate_rouge(rouge, expected, answer)
+            })
+    return [scores.get(key) for key in keys]
+
+
+def summarize(results):
+    means = {metric: sum(result[metric] for result in results) / len(results) for metric in METRICS}
+    return {
+        "BERTScore": {
+            "Precision": means["bertscore_precision"],
+            "Recall": means["bertscore_recall"],
+            "F1": means["bertscore_f1"]
+        },
+        "GPT-based Evaluation": {
+            # "Average Score": gpt_score
+        },
+        "Exact Match Ratio": means["exact_match"],
+        "Average Fuzzy Score": means["fuzzy_score"],
+        "BLEU Score": means["bleu"],
+        "ROUGE-L Score": means["rouge_l"]
+    }
+
+def print_summary(summary):
+    bertscore = summary["BERTScore"]
+    print(f"BERTScore - Precision: {bertscore['Precision']:.4f}, Recall: {bertscore['Recall']:.4f}, F1: {bertscore['F1']:.4f}")
+    # print(f"GPT-based Evaluation - Average Score: {gpt_score:.2f} / 5")
+    print(f"Exact Match Ratio: {summary['Exact Match Ratio']:.4f}")
+    print(f"Average Fuzzy Score: {summary['Average Fuzzy Score']:.2f}")
+    print(f"BLEU Score: {summary['BLEU Score']:.4f}")
+    print(f"ROUGE-L Score: {summary['ROUGE-L Score']:.4f}")
+
+# Function to save the summary, the per-case results and the bar chart
+def save_outputs(summary, results, output_dir, plot=True):
+    summary_path = os.path.join(output_dir, "evaluation_summary.json")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    print(f"✅ Evaluation summary saved to {summary_path}")
+
+    excel_path = os.path.join(output_dir, "evaluation_results.xlsx")
+    pd.DataFrame(results).to_excel(excel_path, index=False)
+    print(f"✅ Detailed results saved to {excel_path}")
+
+    if not plot:
+        return
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    # metrics = ["BERTScore F1", "GPT Score", "Exact Match Ratio", "Fuzzy Score", "BLEU Score", "ROUGE-L Score"]
+    metrics = ["BERTScore F1", "Exact Match Ratio", "Fuzzy Score", "BLEU Score", "ROUGE-L Score"]
+    values = [summary["BERTScore"]["F1"], summary["Exact Match Ratio"], summary["Average Fuzzy Score"], summary["BLEU Score"], summary["ROUGE-L Score"]]
+    plt.figure(figsize=(10, 6))
+    plt.bar(metrics, values, color=['blue', 'green', 'red', 'purple', 'orange'])
+    plt.xlabel('Metrics')
+    plt.ylabel('Scores')
+    plt.title('Evaluation Metrics Comparison')
+    plt_path = os.path.join(output_dir, "evaluation_metrics_comparison.png")
+    plt.savefig(plt_path)
+    plt.close()
+    print(f"✅ Bar chart saved to {plt_path}")
+
+# Function to run the evaluation; returns the summary
+def run_evaluation(cases_path, strategy="cot", k=5, workers=EVAL_WORKERS, rescore=False, output_dir=EVAL_DIR, plot=True):
+    with open(cases_path, "r", encoding="utf-8") as f:
+        test_cases = json.load(f)
+    answers = JsonlCache(os.path.join(EVAL_CACHE_DIR, "answers.jsonl"))
+    scores = JsonlCache(os.path.join(EVAL_CACHE_DIR, "scores.jsonl"))
+
+    if rescore:
+        # Score the latest cached answer of each query as it is, without calling the chatbot
+        latest = {entry["query"]: entry for entry in answers.entries.values() if entry.get("strategy") == strategy}
+        generated = [latest.get(case["query"]) for case in test_cases]
+        missing = sum(answer is None for answer in generated)
+        if missing:
+            print(f"⚠️ {missing} test cases have no cached answer and are left out")
+        test_cases = [case for case, answer in zip(test_cases, generated) if answer is not None]
+        generated = [answer for answer in generated if answer is not None]
+    else:
+        generated = generate_answers(test_cases, answers, strategy, k, workers)
+
+    failed = sum(answer["failed"] for answer in generated)
+    if failed:
+        print(f"⚠️ {failed} test cases failed; they are scored as empty answers and retried on the next run")
+    if not test_cases:
+        print("❌ Nothing to score")
+        return None
+
+    case_scores = score_answers([(case["expected"], answer["answer"]) for case, answer in zip(test_cases, generated)], scores)
+    results = []
+    for case, answer, case_score in zip(test_cases, generated, case_scores):
+        versions = answer.get("versions") or {}
+        results.append({
+            "query": case["query"],
+            "expected": case["expected"],
+            "answer": answer["answer"],
+            "strategy": strategy,
+            "prompt_version": versions.get("prompt"),
+            "index_version": versions.get("index"),
+            "failed": answer["failed"],
+            **{metric: case_score[metric] for metric in METRICS}
+        })
+
+    summary = summarize(results)
+    print_summary(summary)
+    save_outputs(summary, results, output_dir, plot)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the chatbot against the test cases")
+    parser.add_argument("--cases", default=os.path.join(EVAL_DIR, "test_cases.json"), help="JSON list of {query, expected}")
+    parser.add_argument("--strategy", default="cot", help="prompt strategy to answer with")
+    parser.add_argument("--k", type=int, default=5, help="chunks retrieved per query")
+    parser.add_argument("--workers", type=int, default=EVAL_WORKERS, help="test cases answered concurrently")
+    parser.add_argument("--rescore", action="store_true", help="score the cached answers only; never call the chatbot")
+    parser.add_argument("--output-dir", default=EVAL_DIR, help="where the summary, spreadsheet and chart are written")
+    parser.add_argument("--no-plot", action="store_true", help="skip the bar chart")
+    args = parser.parse_args()
+    run_evaluation(args.cases, args.strategy, args.k, args.workers, args.rescore, args.output_dir, not args.no_plot)
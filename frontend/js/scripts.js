@@ -1,8 +1,32 @@
 let chatId = null;
 let chats = JSON.parse(localStorage.getItem("chats") || "{}");
 let chatTitles = JSON.parse(localStorage.getItem("chatTitles") || "{}");
+// Server-side conversation id per chat, so requests carry only the new message
+let conversationIds = JSON.parse(localStorage.getItem("conversationIds") || "{}");
 let chatHistory = [];
 
+function rememberConversation(id, conversationId) {
+  if (!conversationId || conversationIds[id] === conversationId) return;
+  conversationIds[id] = conversationId;
+  localStorage.setItem("conversationIds", JSON.stringify(conversationIds));
+}
+
+// Posts with the conversation id only; if the server no longer knows it, re-sends the whole transcript once
+async function postWithConversation(url, id, payload, messages) {
+  const post = body => fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body)
+  });
+  const conversationId = conversationIds[id];
+  if (conversationId) {
+    const response = await post({ ...payload, conversation_id: conversationId });
+    if (response.status !== 404) return response;
+  }
+  const { message, ...rest } = payload;
+  return post({ ...rest, messages, conversation_id: conversationId });
+}
+
 function renderChat(chat) {
   const chatWindow = document.getElementById("chatWindow");
   chatWindow.innerHTML = "";
@@ -27,6 +51,7 @@ function renderChat(chat) {
         link.href = ref.url;
         link.target = "_blank";
         link.textContent = `[${ref.id}]`;
+        link.title = ref.page ? `${ref.title}, p. ${ref.page}` : ref.title;
         link.style.marginRight = "5px";
         refDiv.appendChild(link);
       });
@@ -50,7 +75,6 @@ async function handleNewChatClick(previousChatId) {
   if (!lastChat || lastChat.length < 2 || lastChat.feedbackGiven) return;
 
   const feedbackPayload = {
-    messages: lastChat,
     strategy: "cot",
     prompt_version: "v1",
     model_name: "gpt-4o-mini-voc2",
@@ -58,11 +82,7 @@ async function handleNewChatClick(previousChatId) {
   };
 
   try {
-    const res = await fetch("/api/feedback", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify(feedbackPayload)
-    });
+    const res = await postWithConversation("/api/feedback", previousChatId, feedbackPayload, lastChat);
 
     if (res.ok) {
       const result = await res.json();
@@ -96,48 +116,127 @@ async function sendMessage() {
   showLoading(true);
 
   try {
-    const response = await fetch("/api/chat", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ messages: chatHistory })
-    });
-
-    if (!response.ok) throw new Error("Failed to fetch response from server");
-
-    const data = await response.json();
-    const assistantReply = data.reply || "Sorry, I didn't understand that.";
-    const references = data.references || [];
+    const assistantMessage = window.ReadableStream && window.TextDecoder
+      ? await streamReply(chat)
+      : await fetchReply(chat);
 
-    const assistantMessage = {
-      role: "assistant",
-      content: assistantReply,
-      references: references
-    };
-
-    chat.push(assistantMessage);
     chatHistory.push(assistantMessage);
     chats[chatId] = chat;
     localStorage.setItem("chats", JSON.stringify(chats));
     renderChat(chat);
   } catch (error) {
+    // The server stores a turn only with its reply, so drop the unanswered message here too
+    // and give it back to the input to retry
+    chat.pop();
+    chatHistory.pop();
+    chats[chatId] = chat;
+    localStorage.setItem("chats", JSON.stringify(chats));
+    renderChat(chat);
+    input.value = text;
     alert("Error: " + error.message);
   } finally {
     showLoading(false);
   }
 }
 
+function postChat(url) {
+  const message = chatHistory[chatHistory.length - 1].content;
+  return postWithConversation(url, chatId, { message }, chatHistory);
+}
+
+async function fetchReply(chat) {
+  const response = await postChat("/api/chat");
+
+  if (!response.ok) {
+    const error = await response.json().catch(() => ({}));
+    throw new Error(error.error || "Failed to fetch response from server");
+  }
+
+  const data = await response.json();
+  rememberConversation(chatId, data.conversation_id);
+  const assistantMessage = {
+    role: "assistant",
+    content: data.reply || "Sorry, I didn't understand that.",
+    references: data.references || []
+  };
+  chat.push(assistantMessage);
+  return assistantMessage;
+}
+
+function parseSseEvent(raw) {
+  let event = "message";
+  const dataLines = [];
+  raw.split("\n").forEach(line => {
+    if (line.startsWith("event:")) event = line.slice(6).trim();
+    else if (line.startsWith("data:")) dataLines.push(line.slice(5).trim());
+  });
+  return { event, data: dataLines.length ? JSON.parse(dataLines.join("\n")) : {} };
+}
+
+// Streams the reply from /api/chat/stream and renders tokens as they arrive
+async function streamReply(chat) {
+  const response = await postChat("/api/chat/stream");
+
+  if (!response.ok || !response.body) throw new Error("Failed to fetch response from server");
+  rememberConversation(chatId, response.headers.get("X-Conversation-Id"));
+
+  const assistantMessage = { role: "assistant", content: "", references: [] };
+  chat.push(assistantMessage);
+
+  // Re-render at most once per animation frame
+  let renderPending = false;
+  const scheduleRender = () => {
+    if (renderPending) return;
+    renderPending = true;
+    requestAnimationFrame(() => {
+      renderPending = false;
+      renderChat(chat);
+    });
+  };
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  try {
+    while (true) {
+      const { value, done } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+
+      let boundary;
+      while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+        const { event, data } = parseSseEvent(buffer.slice(0, boundary));
+        buffer = buffer.slice(boundary + 2);
+
+        if (event === "references") {
+          assistantMessage.references = data.references || [];
+        } else if (event === "token") {
+          showLoading(false);
+          assistantMessage.content += data.content;
+          scheduleRender();
+        } else if (event === "done") {
+          assistantMessage.content = data.reply;
+        } else if (event === "error") {
+          throw new Error(data.error || "Streaming failed");
+        }
+      }
+    }
+  } catch (error) {
+    chat.pop();
+    throw error;
+  }
+
+  if (!assistantMessage.content) assistantMessage.content = "Sorry, I didn't understand that.";
+  return assistantMessage;
+}
+
 function sendFeedback(type) {
-  fetch("/api/feedback", {
-    method: "POST",
-    headers: { "Content-Type": "application/json" },
-    body: JSON.stringify({
-      messages: chats[chatId],
-      strategy: "cot",
-      prompt_version: "v1",
-      model_name: "gpt-4o-mini-voc2",
-      feedback: type
-    })
-  })
+  postWithConversation("/api/feedback", chatId, {
+    strategy: "cot",
+    prompt_version: "v1",
+    model_name: "gpt-4o-mini-voc2",
+    feedback: type
+  }, chats[chatId])
     .then(res => res.json())
     .then(result => {
       chatTitles[chatId] = result.title || `Chat ${new Date(Number(chatId)).toLocaleTimeString()}`;
@@ -201,8 +300,10 @@ function updateHistory() {
       e.stopPropagation();
       delete chats[id];
       delete chatTitles[id];
+      delete conversationIds[id];
       localStorage.setItem("chats", JSON.stringify(chats));
       localStorage.setItem("chatTitles", JSON.stringify(chatTitles));
+      localStorage.setItem("conversationIds", JSON.stringify(conversationIds));
       updateHistory();
       if (chatId === id) {
         const remainingIds = Object.keys(chats);
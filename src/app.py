@@ -1,13 +1,15 @@
 # Clean version of app.py with chat title generation and readable history formatting
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
-from chat_code import ask_chatbot
+from chat_code import ask_chatbot, stream_chatbot, CHAT_MODEL, ERROR_REPLY
+from chat_api import generate_chat_title, format_chat_history, format_sse, parse_filters, resolve_conversation, turn_history, store_turn, CONVERSATION_NOT_FOUND
 from utils.feedback_logger import log_feedback
+from utils.conversation_store import conversation_store
+from utils.metrics import render_metrics, METRICS_CONTENT_TYPE
 import os
 import sys
 import traceback
-import datetime
 
 # Add root to sys.path to access utils
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
@@ -15,14 +17,6 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 app = Flask(__name__, static_folder='../frontend', static_url_path='')
 CORS(app)
 
-def generate_chat_title(messages):
-    first_user_msg = next((m["content"] for m in messages if m["role"] == "user"), "")
-    title = " ".join(first_user_msg.split()[:6]).replace("?", "").replace("!", "").strip()
-    return title or f"Chat {datetime.datetime.now().strftime('%H:%M:%S')}"
-
-def format_chat_history(messages):
-    return "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages)
-
 @app.route('/')
 def serve_index():
     return send_from_directory(app.static_folder, 'index.html')
@@ -31,41 +25,82 @@ def serve_index():
 def serve_static(path):
     return send_from_directory(app.static_folder, path)
 
+# Prometheus scrape endpoint: stage latencies, tokens, cache hit ratios and upstream errors of this worker
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+
 @app.route("/api/chat", methods=["POST"])
 def chat():
     data = request.get_json()
-    messages = data.get("messages", [])
-
-    if not messages:
-        return jsonify({"error": "No messages provided"}), 400
-
-    user_message = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
-    if not user_message:
-        return jsonify({"error": "No user message found"}), 400
+    filters, error = parse_filters(data)
+    if error:
+        return jsonify({"error": error}), 400
+    conversation, user_message, error, status = resolve_conversation(data)
+    if error:
+        return jsonify({"error": error}), status
 
     try:
-        result = ask_chatbot(user_message, chat_history=messages)
+        result = ask_chatbot(user_message, turn_history(conversation, user_message), filters=filters, conversation=conversation)
+        if result["reply"] == ERROR_REPLY:
+            return jsonify({"error": ERROR_REPLY, "conversation_id": conversation.id}), 502
+        store_turn(conversation, user_message, result["reply"], result["references"])
         return jsonify({
             "reply": result["reply"],
-            "references": result["references"]
+            "references": result["references"],
+            "versions": result.get("versions"),
+            "conversation_id": conversation.id
         })
     except Exception as e:
         print("❌ Error in ask_chatbot:", e)
         traceback.print_exc()
         return jsonify({"error": str(e)}), 500
 
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    data = request.get_json()
+    filters, error = parse_filters(data)
+    if error:
+        return jsonify({"error": error}), 400
+    conversation, user_message, error, status = resolve_conversation(data)
+    if error:
+        return jsonify({"error": error}), status
+
+    def generate():
+        references = []
+        try:
+            for event, payload in stream_chatbot(user_message, turn_history(conversation, user_message), filters=filters, conversation=conversation):
+                if event == "references":
+                    references = payload["references"]
+                elif event == "done":
+                    store_turn(conversation, user_message, payload["reply"], references)
+                yield format_sse(event, payload)
+        except Exception as e:
+            print("❌ Error in stream_chatbot:", e)
+            traceback.print_exc()
+            yield format_sse("error", {"error": str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Conversation-Id": conversation.id}
+    )
+
 @app.route("/api/feedback", methods=["POST"])
 def save_feedback():
     data = request.get_json()
-    messages = data.get("messages", [])
+    # Feedback can reference a stored conversation instead of re-sending the transcript
+    conversation = conversation_store.get(data.get("conversation_id"))
+    messages = conversation.messages if conversation is not None else data.get("messages", [])
+    if not messages and data.get("conversation_id"):
+        return jsonify({"error": CONVERSATION_NOT_FOUND}), 404
     strategy = data.get("strategy", "cot")
     prompt_version = data.get("prompt_version", "v1")
-    model_name = data.get("model_name", "gpt-4o-mini-voc2")
+    model_name = data.get("model_name", CHAT_MODEL)
     feedback = data.get("feedback", "thumbs_up")
     title = data.get("title") or generate_chat_title(messages)
 
     formatted_history = format_chat_history(messages)
-    print("📝 Chat Transcript:\n", formatted_history)
 
     try:
         log_feedback(
@@ -0,0 +1,118 @@
+# ASGI serving mode: same routes and payloads as app.py, served from one event loop per worker.
+# Start with: gunicorn --chdir src -k uvicorn.workers.UvicornWorker --bind=0.0.0.0 --timeout 600 async_app:app
+
+from quart import Quart, request, jsonify, send_from_directory
+from quart_cors import cors
+from async_chat import ask_chatbot_async, stream_chatbot_async
+from chat_code import CHAT_MODEL, ERROR_REPLY
+from chat_api import generate_chat_title, format_chat_history, format_sse, parse_filters, resolve_conversation, turn_history, store_turn, CONVERSATION_NOT_FOUND
+from utils.conversation_store import conversation_store
+from utils.feedback_logger import log_feedback_async
+from utils.metrics import render_metrics, METRICS_CONTENT_TYPE
+import traceback
+
+app = Quart(__name__, static_folder='../frontend', static_url_path='')
+app = cors(app)
+
+@app.route('/')
+async def serve_index():
+    return await send_from_directory(app.static_folder, 'index.html')
+
+@app.route('/<path:path>')
+async def serve_static(path):
+    return await send_from_directory(app.static_folder, path)
+
+@app.route("/metrics")
+async def metrics():
+    return render_metrics(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+@app.route("/api/chat", methods=["POST"])
+async def chat():
+    data = await request.get_json()
+    filters, error = parse_filters(data)
+    if error:
+        return jsonify({"error": error}), 400
+    conversation, user_message, error, status = resolve_conversation(data)
+    if error:
+        return jsonify({"error": error}), status
+
+    try:
+        result = await ask_chatbot_async(user_message, turn_history(conversation, user_message), filters=filters, conversation=conversation)
+        if result["reply"] == ERROR_REPLY:
+            return jsonify({"error": ERROR_REPLY, "conversation_id": conversation.id}), 502
+        store_turn(conversation, user_message, result["reply"], result["references"])
+        return jsonify({
+            "reply": result["reply"],
+            "references": result["references"],
+            "versions": result.get("versions"),
+            "conversation_id": conversation.id
+        })
+    except Exception as e:
+        print("❌ Error in ask_chatbot_async:", e)
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/api/chat/stream", methods=["POST"])
+async def chat_stream():
+    data = await request.get_json()
+    filters, error = parse_filters(data)
+    if error:
+        return jsonify({"error": error}), 400
+    conversation, user_message, error, status = resolve_conversation(data)
+    if error:
+        return jsonify({"error": error}), status
+
+    async def generate():
+        references = []
+        try:
+            async for event, payload in stream_chatbot_async(user_message, turn_history(conversation, user_message), filters=filters, conversation=conversation):
+                if event == "references":
+                    references = payload["references"]
+                elif event == "done":
+                    store_turn(conversation, user_message, payload["reply"], references)
+                yield format_sse(event, payload)
+        except Exception as e:
+            print("❌ Error in stream_chatbot_async:", e)
+            traceback.print_exc()
+            yield format_sse("error", {"error": str(e)})
+
+    return generate(), 200, {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+        "X-Conversation-Id": conversation.id
+    }
+
+@app.route("/api/feedback", methods=["POST"])
+async def save_feedback():
+    data = await request.get_json()
+    # Feedback can reference a stored conversation instead of re-sending the transcript
+    conversation = conversation_store.get(data.get("conversation_id"))
+    messages = conversation.messages if conversation is not None else data.get("messages", [])
+    if not messages and data.get("conversation_id"):
+        return jsonify({"error": CONVERSATION_NOT_FOUND}), 404
+    strategy = data.get("strategy", "cot")
+    prompt_version = data.get("prompt_version", "v1")
+    model_name = data.get("model_name", CHAT_MODEL)
+    feedback = data.get("feedback", "thumbs_up")
+    title = data.get("title") or generate_chat_title(messages)
+
+    formatted_history = format_chat_history(messages)
+
+    try:
+        await log_feedback_async(
+            strategy=strategy,
+            prompt_version=prompt_version,
+            model_name=model_name,
+            feedback=feedback,
+            title=title,
+            messages=formatted_history
+        )
+        return jsonify({"status": "saved", "title": title})
+    except Exception as e:
+        print("❌ Error in log_feedback_async:", e)
+        traceback.print_exc()
+        return jsonify({"error": str(e)}), 500
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=8000)
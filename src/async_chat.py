@@ -0,0 +1,134 @@
+import os
+import sys
+import time
+import asyncio
+from dotenv import load_dotenv
+# Ensure the parent directory is in the path for imports
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.logger import log_error
+from utils.clients import get_async_openai_client
+from utils.metrics import start_trace, span, start_span, traced
+from retriever import (
+    QueryContext, retrieve_top_k, lookup_cached_embeddings, store_embeddings, merge_embeddings,
+    EMBED_MODEL, EMBEDDING_UNAVAILABLE_ERRORS
+)
+from chat_code import (
+    check_domain_and_cache, build_chat_request, finish_chat, reply_usage,
+    ERROR_REPLY, CHAT_MODEL
+)
+
+# Load environment variables
+load_dotenv()
+
+# Function to embed texts with the async client, going through the shared embedding cache
+@traced("embed")
+async def embed_queries_async(texts):
+    texts = list(texts)
+    cached, missing = lookup_cached_embeddings(texts)
+    fetched = {}
+    if missing:
+        response = await get_async_openai_client().embeddings.create(input=missing, model=EMBED_MODEL)
+        fetched = store_embeddings(missing, response)
+    return merge_embeddings(texts, cached, fetched)
+
+# Async counterpart of chat_code.prepare_chat. The blocking stages run in worker threads, and
+# retrieval only starts once the domain gate and the answer cache have not answered the request.
+async def prepare_chat_async(query, chat_history=None, k=5, strategy="cot", filters=None, conversation=None):
+    # Worker threads started with asyncio.to_thread inherit the trace
+    start_trace()
+    query_ctx = QueryContext(query)
+    if chat_history is None and conversation is not None:
+        chat_history = conversation.messages
+    try:
+        query_ctx.add([query], await embed_queries_async([query]))
+    except EMBEDDING_UNAVAILABLE_ERRORS as e:
+        query_ctx.mark_embedding_unavailable(e)
+
+    early_result, strategy, use_cache = await asyncio.to_thread(check_domain_and_cache, query, chat_history, None, strategy, query_ctx, filters)
+    if early_result is not None:
+        return {"result": early_result}
+    retrieved_chunks = await asyncio.to_thread(retrieve_top_k, query, k, query_ctx=query_ctx, filters=filters)
+    # History compaction may call the chat model for a summary, so it runs off the event loop
+    return await asyncio.to_thread(build_chat_request, query, chat_history, retrieved_chunks, strategy, use_cache, query_ctx, conversation)
+
+# Async counterpart of chat_code.ask_chatbot, same reply/references contract
+async def ask_chatbot_async(query, chat_history=None, k=5, strategy="cot", filters=None, conversation=None):
+    prepared = await prepare_chat_async(query, chat_history, k, strategy, filters, conversation)
+    if "result" in prepared:
+        return prepared["result"]
+
+    try:
+        with span("generate"):
+            response = await get_async_openai_client().chat.completions.create(
+                model=CHAT_MODEL,
+                messages=prepared["messages"],
+                temperature=0.3,
+                max_tokens=800
+            )
+        response_text = response.choices[0].message.content
+        return finish_chat(prepared, response_text, reply_usage(prepared, response_text, getattr(response, "usage", None)))
+
+    except Exception as e:
+        log_error(str(e), context={"query": query, "strategy": prepared["strategy"]})
+        return {
+            "reply": ERROR_REPLY,
+            "references": [],
+            "versions": prepared["versions"]
+        }
+
+# Async counterpart of chat_code.stream_chatbot, yielding the same (event, payload) pairs
+async def stream_chatbot_async(query, chat_history=None, k=5, strategy="cot", filters=None, conversation=None):
+    start = time.perf_counter()
+    prepared = await prepare_chat_async(query, chat_history, k, strategy, filters, conversation)
+    if "result" in prepared:
+        result = prepared["result"]
+        yield "references", {"references": result["references"]}
+        yield "token", {"content": result["reply"]}
+        yield "done", {"reply": result["reply"], "usage": None, "versions": result["versions"], "metrics": {"total_ms": round((time.perf_counter() - start) * 1000, 1)}}
+        return
+
+    yield "references", {"references": prepared["references"]}
+    prepare_ms = (time.perf_counter() - start) * 1000
+
+    parts = []
+    usage_data = None
+    first_token_ms = None
+    generation_span = start_span("generate")
+    try:
+        stream = await get_async_openai_client().chat.completions.create(
+            model=CHAT_MODEL,
+            messages=prepared["messages"],
+            temperature=0.3,
+            max_tokens=800,
+            stream=True
+        )
+        async for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage_data = chunk.usage
+            # Azure sends content-filter chunks with no choices
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_token_ms is None:
+                first_token_ms = (time.perf_counter() - start) * 1000
+            parts.append(chunk.choices[0].delta.content)
+            yield "token", {"content": chunk.choices[0].delta.content}
+    except Exception as e:
+        generation_span.end(e)
+        log_error(str(e), context={"query": query, "strategy": prepared["strategy"]})
+        yield "error", {"error": ERROR_REPLY}
+        return
+    generation_span.end()
+
+    response_text = "".join(parts)
+    usage = reply_usage(prepared, response_text, usage_data)
+    result = finish_chat(prepared, response_text, usage)
+    yield "done", {
+        "reply": result["reply"],
+        "usage": usage,
+        "versions": result["versions"],
+        "metrics": {
+            "prepare_ms": round(prepare_ms, 1),
+            "time_to_first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+            "total_ms": round((time.perf_counter() - start) * 1000, 1)
+        }
+    }
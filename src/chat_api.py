@@ -0,0 +1,66 @@
+# Request helpers shared by the Flask (app.py) and Quart (async_app.py) apps: payload parsing,
+# conversation lookup and storage, SSE framing and feedback formatting
+
+from utils.shards import normalize_filters
+from utils.conversation_store import conversation_store
+import datetime
+import json
+
+def generate_chat_title(messages):
+    first_user_msg = next((m["content"] for m in messages if m["role"] == "user"), "")
+    title = " ".join(first_user_msg.split()[:6]).replace("?", "").replace("!", "").strip()
+    return title or f"Chat {datetime.datetime.now().strftime('%H:%M:%S')}"
+
+def format_chat_history(messages):
+    return "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages)
+
+def format_sse(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+# Function to read the optional metadata filter ({"document", "year", "section"}); returns (filters, error)
+def parse_filters(data):
+    filters = data.get("filters")
+    if filters is not None and not isinstance(filters, dict):
+        return None, "filters must be an object"
+    try:
+        normalize_filters(filters)
+    except ValueError as e:
+        return None, str(e)
+    return filters, None
+
+CONVERSATION_NOT_FOUND = "conversation_not_found"
+
+# Function to find the conversation a chat request belongs to; returns (conversation, user_message, error, status).
+# Clients send {"conversation_id", "message"} and the server keeps the transcript, or the full
+# {"messages"} array (older clients, or after "conversation not found"), which seeds the store.
+# The new user message is not stored here: store_turn adds it together with a successful reply.
+def resolve_conversation(data):
+    if "message" in data:
+        message = data.get("message")
+        if not isinstance(message, str) or not message.strip():
+            return None, None, "No user message found", 400
+        conversation = conversation_store.get(data.get("conversation_id"))
+        if conversation is None:
+            return None, None, CONVERSATION_NOT_FOUND, 404
+        return conversation, message, None, None
+
+    messages = data.get("messages", [])
+    if not messages:
+        return None, None, "No messages provided", 400
+    user_index = next((i for i in range(len(messages) - 1, -1, -1) if messages[i]["role"] == "user"), None)
+    if user_index is None or not messages[user_index]["content"]:
+        return None, None, "No user message found", 400
+    return conversation_store.replace(data.get("conversation_id"), messages[:user_index]), messages[user_index]["content"], None, None
+
+# Function to give the model the stored turns plus the new user message
+def turn_history(conversation, user_message):
+    return conversation.messages + [{"role": "user", "content": user_message}]
+
+# Function to record a finished turn. The user message and the reply are stored together, so a failed
+# generation (an exception, an "error" event or ERROR_REPLY) leaves the conversation as it was.
+def store_turn(conversation, user_message, reply, references):
+    conversation_store.append(
+        conversation,
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": reply, "references": references}
+    )
@@ -1,112 +1,262 @@
 import os
 from dotenv import load_dotenv
-from openai import AzureOpenAI
 import sys
-import os
+import time
 # Ensure the parent directory is in the path for imports
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils.prompt_loader import load_prompt
-from utils.feedback_logger import log_feedback
+from utils.prompt_loader import get_prompts
 from utils.logger import log_interaction, log_error
-from retriever import retrieve_top_k, filter_chunks, is_out_of_domain
+from utils.answer_cache import SemanticAnswerCache, ANSWER_CACHE_ENABLED
+from utils.tokens import count_tokens
+from utils.clients import get_openai_client
+from utils.chat_history import compact_history
+from utils.metrics import start_trace, span, start_span, record_usage, register_cache
+from retriever import retrieve_top_k, filter_chunks, is_out_of_domain, QueryContext
 
 
 # Load environment variables
 load_dotenv()
 base_folder = os.getenv("BASE_FOLDER_PATH")
 
-# Azure OpenAI client
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version="2023-05-15"
-)
+# Azure OpenAI deployment (the client is shared and created lazily in utils.clients)
 CHAT_MODEL = os.getenv("DEPLOYMENT_NAME")
+PROMPT_VERSION = "v1"
+
+# Semantic answer cache for near-duplicate standalone questions
+answer_cache = SemanticAnswerCache() if ANSWER_CACHE_ENABLED else None
+if answer_cache is not None:
+    register_cache("answer", answer_cache.stats)
 
-# Prompt templates - Load from Utils
-def build_prompt(query, context_chunks, mode="default", version="v1"):
-    prompt_data = load_prompt(version)
-    strategies = prompt_data["strategies"]
-    
-    if mode not in strategies:
-        mode = "default"
-    
-    template = strategies[mode]["template"]
+# Prompt templates - Load from Utils (parsed once, recompiled when the file changes)
+def build_prompt(query, context_chunks, mode="default", version=PROMPT_VERSION, prompts=None):
+    prompts = prompts or get_prompts(version)
     context = "\n\n".join(chunk["text"] for chunk in context_chunks)
-    
-    return template.format(context=context, query=query)
+    return prompts.render(mode, context=context, query=query)
 
+# Function to report the index and prompt versions a request was served with
+def served_versions(query_ctx, prompts):
+    return {"index": query_ctx.generation.version, "prompt": prompts.version}
 
-# Core function with memory and reference tagging
-def ask_chatbot(query, chat_history=None, retrieved_chunks=None, k=5, strategy="cot"):
-    if is_out_of_domain(query):
-        return {
-            "reply": "I'm sorry, your question appears to be outside the scope of the provided document.",
-            "references": []
-        }
+
+# Function to check that the chat has no user turns other than the current query
+def is_standalone_question(query, chat_history):
+    if not chat_history:
+        return True
+    user_turns = [m["content"] for m in chat_history if m.get("role") == "user"]
+    return user_turns in ([], [query])
+
+
+OUT_OF_DOMAIN_REPLY = "I'm sorry, your question appears to be outside the scope of the provided document."
+ERROR_REPLY = "An error occurred while processing your request."
+
+# Function to run the checks that can answer without retrieval: domain gate, strategy choice, answer cache.
+# Returns (early_result or None, strategy, use_cache).
+def check_domain_and_cache(query, chat_history, retrieved_chunks, strategy, query_ctx, filters=None):
+    prompts = get_prompts(PROMPT_VERSION)
+    if is_out_of_domain(query, query_ctx=query_ctx):
+        return {"reply": OUT_OF_DOMAIN_REPLY, "references": [], "versions": served_versions(query_ctx, prompts)}, strategy, False
 
     if query.lower().strip().endswith("?") and len(query.split()) < 6:
         strategy = "casual"
 
-    if retrieved_chunks is None:
-        retrieved_chunks = retrieve_top_k(query, k)
+    # Only standalone questions are cacheable: no caller-supplied chunks, no earlier user turns and no
+    # document filter (and not when the embedding endpoint is unavailable, since lookups are by query embedding)
+    use_cache = answer_cache is not None and retrieved_chunks is None and not filters and is_standalone_question(query, chat_history) and query_ctx.embedding_error is None
+    if use_cache:
+        cached = answer_cache.lookup(query_ctx.embed(query), prompts.version, strategy, query_ctx.generation.version)
+        if cached is not None:
+            log_interaction(
+                user_query=query,
+                strategy=strategy,
+                response=cached["reply"],
+                prompt_version=prompts.version,
+                model_name=CHAT_MODEL,
+                tokens_used=0,
+                index_version=query_ctx.generation.version
+            )
+            return cached, strategy, use_cache
 
+    return None, strategy, use_cache
+
+# Function to pack context, build references and assemble the chat messages
+def build_chat_request(query, chat_history, retrieved_chunks, strategy, use_cache, query_ctx, conversation=None):
     context_chunks = filter_chunks(retrieved_chunks, max_tokens=4000)
 
     # Build reference map
     references = []
-    reference_map = {}
     for idx, chunk in enumerate(context_chunks, start=1):
-        ref = {
+        reference = {
             "id": idx,
-            "title": chunk.get("title", f"Source {idx}"),
+            "title": chunk.get("title", chunk.get("section", f"Source {idx}")),
             "url": chunk.get("source", "#")
         }
-        references.append(ref)
-        reference_map[chunk["text"]] = idx
+        if "page_start" in chunk:
+            reference["page"] = chunk["page_start"]
+        references.append(reference)
 
-    # Build prompt
-    prompt = build_prompt(query, context_chunks, mode=strategy)
+    # Build prompt with the prompt set active now; the request keeps it through to logging and caching
+    prompts = get_prompts(PROMPT_VERSION)
+    prompt = build_prompt(query, context_chunks, mode=strategy, prompts=prompts)
 
+    # Earlier turns within a token budget, older ones summarized, so the prompt size stays bounded
     messages = [{"role": "system", "content": "You are a helpful assistant."}]
-    if chat_history:
-        messages.extend(chat_history)
+    # A stored conversation keeps its own rolling summary
+    messages.extend(compact_history(chat_history, query, cache=conversation))
     messages.append({"role": "user", "content": prompt})
 
+    return {
+        "query": query,
+        "query_ctx": query_ctx,
+        "strategy": strategy,
+        "use_cache": use_cache,
+        "references": references,
+        "messages": messages,
+        "versions": served_versions(query_ctx, prompts)
+    }
+
+# Function to run everything before generation: domain check, cache lookup, retrieval and prompt building.
+# Returns {"result": ...} when the request is answered without the chat model.
+# A server-side conversation (utils.conversation_store) supplies the history when chat_history is not given.
+def prepare_chat(query, chat_history=None, retrieved_chunks=None, k=5, strategy="cot", query_ctx=None, filters=None, conversation=None):
+    # Stage spans of this request are collected under one trace and listed on its log record
+    start_trace()
+    # One query context per request so the query is embedded only once
+    query_ctx = query_ctx or QueryContext(query)
+    if chat_history is None and conversation is not None:
+        chat_history = conversation.messages
+    early_result, strategy, use_cache = check_domain_and_cache(query, chat_history, retrieved_chunks, strategy, query_ctx, filters)
+    if early_result is not None:
+        return {"result": early_result}
+
+    if retrieved_chunks is None:
+        retrieved_chunks = retrieve_top_k(query, k, query_ctx=query_ctx, filters=filters)
+
+    return build_chat_request(query, chat_history, retrieved_chunks, strategy, use_cache, query_ctx, conversation)
+
+# Function to tag, log and cache a generated answer; usage is the reply_usage dict
+def finish_chat(prepared, response_text, usage=None):
+    response_text = response_text.strip()
+    references = prepared["references"]
+
+    # Append reference tags at the end
+    ref_tags = " ".join([f"[{ref['id']}]" for ref in references])
+    response_with_refs = f"{response_text} {ref_tags}".strip()
+
+    record_usage("generate", CHAT_MODEL, usage)
+    log_interaction(
+        user_query=prepared["query"],
+        strategy=prepared["strategy"],
+        response=response_text,
+        prompt_version=prepared["versions"]["prompt"],
+        model_name=CHAT_MODEL,
+        tokens_used=usage["total_tokens"] if usage else None,
+        index_version=prepared["versions"]["index"],
+        prompt_tokens=usage["prompt_tokens"] if usage else None,
+        completion_tokens=usage["completion_tokens"] if usage else None
+    )
+
+    result = {
+        "reply": response_with_refs,
+        "references": references,
+        "versions": prepared["versions"]
+    }
+    if prepared["use_cache"]:
+        answer_cache.store(prepared["query_ctx"].embed(prepared["query"]), prepared["versions"]["prompt"], prepared["strategy"], prepared["versions"]["index"], result)
+    return result
+
+# Core function with memory and reference tagging.
+# Every result has reply, references and versions; a failed generation has reply == ERROR_REPLY.
+def ask_chatbot(query, chat_history=None, retrieved_chunks=None, k=5, strategy="cot", filters=None, conversation=None):
+    prepared = prepare_chat(query, chat_history, retrieved_chunks, k, strategy, filters=filters, conversation=conversation)
+    if "result" in prepared:
+        return prepared["result"]
+
     try:
-        response = client.chat.completions.create(
-            model=CHAT_MODEL,
-            messages=messages,
-            temperature=0.3,
-            max_tokens=800
-        )
-        response_text = response.choices[0].message.content.strip()
-
-        # Append reference tags at the end
-        ref_tags = " ".join([f"[{ref['id']}]" for ref in references])
-        response_with_refs = f"{response_text} {ref_tags}".strip()
-
-        usage_data = response.usage if hasattr(response, 'usage') else None
-        log_interaction(
-            user_query=query,
-            strategy=strategy,
-            response=response_text,
-            prompt_version="v1",
-            model_name="gpt-4o-mini-voc2",
-            tokens_used=usage_data.total_tokens if usage_data else None
-        )
+        with span("generate"):
+            response = get_openai_client().chat.completions.create(
+                model=CHAT_MODEL,
+                messages=prepared["messages"],
+                temperature=0.3,
+                max_tokens=800
+            )
+        response_text = response.choices[0].message.content
+        return finish_chat(prepared, response_text, reply_usage(prepared, response_text, getattr(response, "usage", None)))
 
+    except Exception as e:
+        log_error(str(e), context={"query": query, "strategy": prepared["strategy"]})
         return {
-            "reply": response_with_refs,
-            "references": references
+            "reply": ERROR_REPLY,
+            "references": [],
+            "versions": prepared["versions"]
         }
 
+# Function to report token usage for a reply
+def reply_usage(prepared, response_text, usage_data=None):
+    if usage_data:
+        return {"prompt_tokens": usage_data.prompt_tokens, "completion_tokens": usage_data.completion_tokens, "total_tokens": usage_data.total_tokens, "estimated": False}
+    # Older API versions do not report usage on streams; count locally
+    prompt_tokens = sum(count_tokens(m["content"]) for m in prepared["messages"])
+    completion_tokens = count_tokens(response_text)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens, "estimated": True}
+
+# Streaming variant of ask_chatbot. Yields (event, payload) pairs:
+# "references" first, then "token" deltas, then "done" with the tagged reply, usage and timings.
+def stream_chatbot(query, chat_history=None, k=5, strategy="cot", filters=None, conversation=None):
+    start = time.perf_counter()
+    prepared = prepare_chat(query, chat_history, k=k, strategy=strategy, filters=filters, conversation=conversation)
+    if "result" in prepared:
+        result = prepared["result"]
+        yield "references", {"references": result["references"]}
+        yield "token", {"content": result["reply"]}
+        yield "done", {"reply": result["reply"], "usage": None, "versions": result["versions"], "metrics": {"total_ms": round((time.perf_counter() - start) * 1000, 1)}}
+        return
+
+    yield "references", {"references": prepared["references"]}
+    prepare_ms = (time.perf_counter() - start) * 1000
+
+    parts = []
+    usage_data = None
+    first_token_ms = None
+    # The span stays open across yields, so it is ended explicitly
+    generation_span = start_span("generate")
+    try:
+        stream = get_openai_client().chat.completions.create(
+            model=CHAT_MODEL,
+            messages=prepared["messages"],
+            temperature=0.3,
+            max_tokens=800,
+            stream=True
+        )
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage_data = chunk.usage
+            # Azure sends content-filter chunks with no choices
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if first_token_ms is None:
+                first_token_ms = (time.perf_counter() - start) * 1000
+            parts.append(chunk.choices[0].delta.content)
+            yield "token", {"content": chunk.choices[0].delta.content}
     except Exception as e:
-        log_error(str(e), context={"query": query, "strategy": strategy})
-        return {
-            "reply": "An error occurred while processing your request.",
-            "references": []
+        generation_span.end(e)
+        log_error(str(e), context={"query": query, "strategy": prepared["strategy"]})
+        yield "error", {"error": ERROR_REPLY}
+        return
+    generation_span.end()
+
+    response_text = "".join(parts)
+    usage = reply_usage(prepared, response_text, usage_data)
+    result = finish_chat(prepared, response_text, usage)
+    yield "done", {
+        "reply": result["reply"],
+        "usage": usage,
+        "versions": result["versions"],
+        "metrics": {
+            "prepare_ms": round(prepare_ms, 1),
+            "time_to_first_token_ms": round(first_token_ms, 1) if first_token_ms is not None else None,
+            "total_ms": round((time.perf_counter() - start) * 1000, 1)
         }
+    }
 
 # # Example usage
 # if __name__ == "__main__":
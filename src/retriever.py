@@ -1,18 +1,27 @@
 import os
 import json
 import faiss
+import openai
 import numpy as np
-from openai import AzureOpenAI
 from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient
-import tiktoken
+import sys
+# Ensure the parent directory is in the path for imports
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.domain_model import DOMAIN_MODEL_FILE_NAME, DOMAIN_THRESHOLD, load_or_build_domain_model, domain_similarity
+from utils.embedding_cache import EmbeddingCache
+from utils.rerankers import local_rerank, parse_ranking
+from utils.lexical_index import LEXICAL_INDEX_FILE_NAME, load_or_build_lexical_index, reciprocal_rank_fusion
+from utils.tokens import count_tokens, ensure_token_counts
+from utils.chunk_store import CHUNK_STORE_FILE_NAME, ChunkStore, write_chunk_store
+from utils.clients import get_openai_client
+from utils.artifacts import create_artifact_store, file_fingerprint
+from utils.shards import ShardedIndex, fetch_manifest, fetch_shards, open_shards, validate_shards
+from utils.artifact_registry import ArtifactRegistry
+from utils.metrics import traced, span, record_usage, register_cache
 
 # Load environment variables
 load_dotenv()
 
-# Azure Blob Storage setup
-blob_service_client = BlobServiceClient.from_connection_string(os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
-
 # Local temp directory for downloaded files
 temp_dir = "./temp"
 os.makedirs(temp_dir, exist_ok=True)
@@ -21,75 +30,250 @@ os.makedirs(temp_dir, exist_ok=True)
 embeddings_container = os.getenv("EMBEDDINGS_CONTAINER_NAME")
 faiss_blob_name = os.getenv("FAISS_INDEX_BLOB_NAME", "index.faiss")
 metadata_blob_name = "metadata.json"
-faiss_local_path = os.path.join(temp_dir, "index.faiss")
 metadata_local_path = os.path.join(temp_dir, "metadata.json")
+chunk_store_local_path = os.path.join(temp_dir, CHUNK_STORE_FILE_NAME)
+domain_model_local_path = os.path.join(temp_dir, DOMAIN_MODEL_FILE_NAME)
+lexical_index_local_path = os.path.join(temp_dir, LEXICAL_INDEX_FILE_NAME)
+
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "300"))  # seconds between artifact checks, 0 = never
+
+artifact_store = create_artifact_store(embeddings_container)
+
+# Function to refresh the local artifacts, downloading only what changed (ETag) and streaming to disk.
+# Returns the index version and the shard layout; the version changes whenever an index file did.
+def sync_index_artifacts():
+    # The manifest comes first and names every file of one build, so what is fetched below belongs together.
+    # Builds from before the manifest listed its artifacts use the fixed names.
+    manifest, manifest_path = fetch_manifest(artifact_store, temp_dir)
+    artifacts = (manifest or {}).get("artifacts", {})
+    try:
+        if artifact_store.fetch(artifacts.get("chunk_store", CHUNK_STORE_FILE_NAME), chunk_store_local_path):
+            print(f"⬇️ Downloaded {CHUNK_STORE_FILE_NAME}")
+    except FileNotFoundError:
+        if "chunk_store" in artifacts:
+            raise
+        # Index built before the chunk store existed: convert metadata.json once
+        if artifact_store.fetch(metadata_blob_name, metadata_local_path) or not os.path.exists(chunk_store_local_path):
+            with open(metadata_local_path, "r", encoding="utf-8") as f:
+                write_chunk_store(chunk_store_local_path, ensure_token_counts(json.load(f)))
+            print(f"🔄 Converted {metadata_blob_name} to {CHUNK_STORE_FILE_NAME}")
+    try:
+        artifact_store.fetch(artifacts.get("lexical_index", LEXICAL_INDEX_FILE_NAME), lexical_index_local_path)
+    except FileNotFoundError:
+        # Optional artifact: load_or_build_lexical_index builds it from the chunk store if missing or stale
+        if not os.path.exists(lexical_index_local_path):
+            print("⚠️ Lexical index not found in the artifact store, using a locally built one")
+    try:
+        artifact_store.fetch(artifacts.get("domain_model", DOMAIN_MODEL_FILE_NAME), domain_model_local_path)
+    except FileNotFoundError:
+        # Optional artifact: load_or_build_domain_model rebuilds it from the index if missing or stale
+        if not os.path.exists(domain_model_local_path):
+            print("⚠️ Domain model not found in the artifact store, using a locally built one")
+
+    # shards.json and its shards, or the single index.faiss of older builds
+    layout, index_paths = fetch_shards(artifact_store, temp_dir, manifest, manifest_path, faiss_blob_name)
+    version = file_fingerprint(index_paths + [chunk_store_local_path])
+    # The corpus the domain model and lexical index must match; builds that do not record one use the file version
+    corpus = (manifest or {}).get("fingerprint") or version
+    return version, (layout, index_paths, corpus)
+
+
+# Everything retrieval reads from the artifacts, loaded together so a request sees one consistent version
+class IndexGeneration:
+    def __init__(self, version, chunk_store, index, index_paths, lexical_index, domain_centroids):
+        self.version = version
+        self.chunk_store = chunk_store
+        self.index = index
+        self.index_paths = index_paths
+        self.lexical_index = lexical_index
+        self.domain_centroids = domain_centroids
 
-# Download blobs to local files
-def download_blob_to_file(container_name, blob_name, local_path):
-    blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
-    with open(local_path, "wb") as f:
-        f.write(blob_client.download_blob().readall())
-
-download_blob_to_file(embeddings_container, faiss_blob_name, faiss_local_path)
-download_blob_to_file(embeddings_container, metadata_blob_name, metadata_local_path)
-
-# Load FAISS index and metadata
-index = faiss.read_index(faiss_local_path)
-with open(metadata_local_path, "r", encoding="utf-8") as f:
-    metadata = json.load(f)
-
-# Azure OpenAI config
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version="2023-05-15"
-)
+# Function to open a synced set of artifacts as a new generation. The chunk store and the index shards
+# are memory-mapped; downloads replace files by rename, so an older generation keeps its own mappings.
+# Files that do not line up raise, so the registry keeps serving the previous generation.
+def load_index_generation(version, state):
+    layout, index_paths, corpus = state
+    chunk_store = ChunkStore(chunk_store_local_path)
+    shards = open_shards(layout)
+    validate_shards(shards, layout, len(chunk_store))
+    index = ShardedIndex(shards, chunk_store)
+    # Domain model (corpus centroids) built once per generation, not per request
+    domain_centroids = load_or_build_domain_model(domain_model_local_path, index, chunk_store.ids("source"), corpus)
+    # BM25 inverted index, used for lexical/hybrid retrieval and by the local reranker
+    lexical_index = load_or_build_lexical_index(
+        lexical_index_local_path,
+        (chunk_store.text(i) for i in range(len(chunk_store))),
+        len(chunk_store),
+        corpus
+    )
+    return IndexGeneration(version, chunk_store, index, index_paths, lexical_index, domain_centroids)
+
+# Index generations: loaded now, then rebuilt in the background whenever the stored artifacts change
+index_registry = ArtifactRegistry("index", sync_index_artifacts, load_index_generation, INDEX_RELOAD_INTERVAL, background=True)
+
+# Function to get the active index generation; a request keeps the one it started with
+def current_index():
+    return index_registry.get()
+
+# Azure OpenAI config (the client itself is shared and created lazily in utils.clients)
 EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
 CHAT_MODEL = os.getenv("DEPLOYMENT_NAME")
 
+# Reranking: "local" (BM25 + FAISS similarity, CPU only) or "llm" (chat-completion call)
+RERANK_MODE = os.getenv("RERANK_MODE", "local")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+
+# First stage: "vector" (FAISS), "lexical" (BM25 inverted index) or "hybrid" (both, fused by reciprocal rank)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector")
+
+# Errors meaning the embedding endpoint is throttled or unreachable; retrieval then falls back to lexical
+EMBEDDING_UNAVAILABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError)
+
+# Query-embedding cache shared by all requests in this worker
+embedding_cache = EmbeddingCache()
+register_cache("embedding", embedding_cache.stats)
+
+# Function to split texts into cached vectors and the distinct texts that still need embedding
+def lookup_cached_embeddings(texts):
+    cached = [embedding_cache.get(text, EMBED_MODEL) for text in texts]
+    missing = list(dict.fromkeys(text for text, vec in zip(texts, cached) if vec is None))
+    return cached, missing
+
+# Function to normalize an embeddings response and add the vectors to the cache
+def store_embeddings(texts, response):
+    record_usage("embedding", EMBED_MODEL, getattr(response, "usage", None))
+    data = sorted(response.data, key=lambda item: item.index)
+    vecs = np.array([item.embedding for item in data], dtype="float32")
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    for text, vec in zip(texts, vecs):
+        embedding_cache.put(text, EMBED_MODEL, vec)
+    return dict(zip(texts, vecs))
+
+def merge_embeddings(texts, cached, fetched):
+    return np.vstack([vec if vec is not None else fetched[text] for text, vec in zip(texts, cached)])
+
+# Function to normalize and embed a batch of texts in a single request, skipping cached texts
+@traced("embed")
+def embed_queries(texts) -> np.ndarray:
+    texts = list(texts)
+    cached, missing = lookup_cached_embeddings(texts)
+    fetched = store_embeddings(missing, get_openai_client().embeddings.create(input=missing, model=EMBED_MODEL)) if missing else {}
+    return merge_embeddings(texts, cached, fetched)
+
 # Function to normalize and embed query
 def embed_query(query: str) -> np.ndarray:
-    response = client.embeddings.create(input=query, model=EMBED_MODEL)
-    vec = np.array(response.data[0].embedding).astype("float32")
-    vec /= np.linalg.norm(vec)
-    return vec.reshape(1, -1)
+    return embed_queries([query])[0].reshape(1, -1)
+
+# Request-scoped query context: carries embeddings through the pipeline so each text is embedded once,
+# and pins the index generation the request started on so a reload never changes data mid-request
+class QueryContext:
+    def __init__(self, query, generation=None):
+        self.query = query
+        self.generation = generation or current_index()
+        self.embeddings = {}
+        self.embedding_error = None
+
+    def embed(self, text=None) -> np.ndarray:
+        text = self.query if text is None else text
+        if text not in self.embeddings:
+            self.embeddings[text] = embed_query(text)
+        return self.embeddings[text]
+
+    # Function to embed, or return None once the embedding endpoint has proved unavailable for this request
+    def try_embed(self, text=None):
+        if self.embedding_error is not None:
+            return None
+        try:
+            return self.embed(text)
+        except EMBEDDING_UNAVAILABLE_ERRORS as e:
+            self.mark_embedding_unavailable(e)
+            return None
+
+    def mark_embedding_unavailable(self, error):
+        self.embedding_error = error
+        print("⚠️ Embedding endpoint unavailable, using lexical retrieval only:", error)
+
+    def embed_many(self, texts):
+        missing = self.missing(texts)
+        if missing:
+            self.add(missing, embed_queries(missing))
+        return [self.embeddings[text] for text in texts]
+
+    def missing(self, texts):
+        return [text for text in dict.fromkeys(texts) if text not in self.embeddings]
+
+    # Function to hand the context vectors embedded elsewhere (e.g. by the async pipeline)
+    def add(self, texts, vecs):
+        for text, vec in zip(texts, vecs):
+            self.embeddings[text] = np.asarray(vec, dtype="float32").reshape(1, -1)
+
+# Function to search the index shards in scope, returning cosine similarities and chunk ids, best first
+@traced("search")
+def search_index(query_vector, n, filters=None, generation=None):
+    return (generation or current_index()).index.search(query_vector, n, filters)
 
 # Function to retrieve top-k relevant chunks
-def retrieve_top_k(query: str, k: int = 10, threshold: float = 0.6):
-    query_vector = embed_query(query)
-    distances, indices = index.search(query_vector, k)
+# filters ({"document": ..., "year": ..., "section": ...}, values or lists) prune shards before searching
+def retrieve_top_k(query: str, k: int = 10, threshold: float = 0.6, query_ctx=None, rerank_mode=None, retrieval_mode=None, filters=None):
+    query_ctx = query_ctx or QueryContext(query)
+    generation = query_ctx.generation
+    retrieval_mode = retrieval_mode or RETRIEVAL_MODE
+    n_candidates = max(k, RERANK_CANDIDATES)
+    query_vector = query_ctx.try_embed(query) if retrieval_mode != "lexical" else None
+    if query_vector is None:
+        # Lexical only: requested, or the embedding endpoint is unavailable.
+        # Without vector scores the local reranker keeps the BM25 order.
+        with span("lexical_search"):
+            _, indices = generation.lexical_index.search(query, n_candidates, generation.index.allowed_ids(filters))
+        return rerank_chunks(query, [generation.chunk_store[i] for i in indices], mode=rerank_mode, generation=generation)[:k]
+
+    # First stage: over-fetch candidates, then rerank down to k
+    scores, indices = search_index(query_vector, n_candidates, filters, generation)
+    if retrieval_mode == "hybrid":
+        # Exact terms (percentages, brands, cluster names) come in through BM25; reciprocal-rank
+        # fusion already blends both signals, so the local reranker keeps the fused order
+        with span("lexical_search"):
+            _, lexical_ids = generation.lexical_index.search(query, n_candidates, generation.index.allowed_ids(filters))
+        fused = reciprocal_rank_fusion([indices[scores >= threshold], lexical_ids])[:n_candidates]
+        return rerank_chunks(query, [generation.chunk_store[i] for i in fused], mode=rerank_mode, generation=generation)[:k]
+
     results = []
-    for i, dist in zip(indices[0], distances[0]):
-        similarity = 1 - dist
+    similarities = []
+    chunk_ids = []
+    for i, similarity in zip(indices, scores):
         if similarity >= threshold:
-            results.append(metadata[i])
-    return rerank_chunks(query, results)
+            results.append(generation.chunk_store[i])
+            similarities.append(similarity)
+            chunk_ids.append(i)
+    return rerank_chunks(query, results, similarities, chunk_ids, mode=rerank_mode, generation=generation)[:k]
 
 # Function to check if query is out-of-domain
-def is_out_of_domain(query: str, threshold: float = 0.55):
-    query_vec = embed_query(query).flatten()
-    all_embeddings = index.reconstruct_n(0, index.ntotal)
-    avg_embedding = np.mean(all_embeddings, axis=0)
-    dot = np.dot(query_vec, avg_embedding)
-    norm = np.linalg.norm(query_vec) * np.linalg.norm(avg_embedding)
-    similarity = dot / norm
+@traced("domain")
+def is_out_of_domain(query: str, threshold: float = DOMAIN_THRESHOLD, query_ctx=None):
+    query_ctx = query_ctx or QueryContext(query)
+    query_vec = query_ctx.try_embed(query)
+    if query_vec is None:
+        # Cannot tell without an embedding; let lexical retrieval answer
+        return False
+    similarity = domain_similarity(query_vec.flatten(), query_ctx.generation.domain_centroids)
     return similarity < threshold
 
-# Function to filter chunks by token limit
+# Function to filter chunks by token limit using the precomputed token counts
+@traced("filter")
 def filter_chunks(chunks, max_tokens=4000):
-    enc = tiktoken.encoding_for_model("gpt-4o")
-    filtered = []
-    total_tokens = 0
-    for chunk in chunks:
-        tokens = len(enc.encode(chunk["text"]))
-        if total_tokens + tokens > max_tokens:
-            break
-        filtered.append(chunk)
-        total_tokens += tokens
-    return filtered
+    if not chunks:
+        return []
+    counts = np.array([chunk["token_count"] if "token_count" in chunk else count_tokens(chunk["text"]) for chunk in chunks])
+    # Keep the longest prefix whose running total fits the budget
+    fits = int(np.searchsorted(np.cumsum(counts), max_tokens, side="right"))
+    return chunks[:fits]
+
+# Function to rerank chunks locally with BM25 + vector similarity
+def local_rerank_chunks(query, chunks, similarities, chunk_ids, generation=None):
+    return local_rerank(query, chunks, similarities, chunk_ids, (generation or current_index()).lexical_index)
 
 # Function to rerank chunks using LLM
-def rerank_chunks(query, chunks):
+def llm_rerank_chunks(query, chunks, similarities=None, chunk_ids=None, generation=None):
     if not chunks:
         return []
 
@@ -106,7 +290,7 @@ Chunks:
 
     prompt += "Return the chunk numbers in order of relevance, one per line (e.g., 3, 1, 2)."
 
-    response = client.chat.completions.create(
+    response = get_openai_client().chat.completions.create(
         model=CHAT_MODEL,
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
@@ -117,29 +301,44 @@ Chunks:
         max_tokens=300
     )
 
+    record_usage("rerank", CHAT_MODEL, response.usage)
     raw_output = response.choices[0].message.content.strip()
-    print("🔧 Reranker raw output:\n", raw_output)
+    indices = parse_ranking(raw_output, len(chunks))
+    if not indices:
+        return chunks
+    # Chunks the model left out keep their retrieval order after the ranked ones
+    indices += [i for i in range(len(chunks)) if i not in indices]
+    return [chunks[i] for i in indices]
 
-    try:
-        lines = raw_output.splitlines()
-        indices = []
-        for line in lines:
-            line = line.strip().strip(",.")
-            if line.isdigit():
-                idx = int(line) - 1
-                if 0 <= idx < len(chunks):
-                    indices.append(idx)
-        if indices:
-            return [chunks[i] for i in indices]
-    except Exception as e:
-        print("Failed to parse reranker output:", e)
-
-    return chunks
+# Pluggable rerankers: each takes (query, chunks, similarities, chunk_ids, generation) and returns reordered chunks.
+# chunk_ids refer to that index generation.
+RERANKERS = {
+    "local": local_rerank_chunks,
+    "llm": llm_rerank_chunks
+}
+
+def register_reranker(name, reranker):
+    RERANKERS[name] = reranker
+
+# Function to rerank retrieved chunks with the configured reranker
+@traced("rerank")
+def rerank_chunks(query, chunks, similarities=None, chunk_ids=None, mode=None, generation=None):
+    if not chunks:
+        return []
+    mode = mode or RERANK_MODE
+    if mode not in RERANKERS:
+        print(f"⚠️ Unknown rerank mode '{mode}', falling back to local")
+        mode = "local"
+    if mode == "local" and (similarities is None or chunk_ids is None):
+        # Without retrieval scores there is nothing to blend; keep the given order
+        return chunks
+    return RERANKERS[mode](query, chunks, similarities, chunk_ids, generation or current_index())
 
 # Function to decompose complex query
+@traced("decompose")
 def decompose_query(query):
     prompt = f"Decompose the following complex query into simpler sub-questions:\n\nQuery: {query}\n\nSub-questions:"
-    response = client.chat.completions.create(
+    response = get_openai_client().chat.completions.create(
         model=CHAT_MODEL,
         messages=[
             {"role": "system", "content": "You are a helpful assistant."},
@@ -149,15 +348,20 @@ def decompose_query(query):
         top_p=1,
         max_tokens=800
     )
+    record_usage("decompose", CHAT_MODEL, response.usage)
     sub_questions = response.choices[0].message.content.strip().split("\n")
     return [q.strip() for q in sub_questions if q.strip()]
 
 # Function to perform multi-hop retrieval
-def multi_hop_retrieve(query, k=10):
+def multi_hop_retrieve(query, k=10, query_ctx=None):
+    query_ctx = query_ctx or QueryContext(query)
     sub_questions = decompose_query(query)
+    # Embed all sub-questions in one batched request
+    if sub_questions:
+        query_ctx.embed_many(sub_questions)
     all_chunks = []
     for sub_query in sub_questions:
-        chunks = retrieve_top_k(sub_query, k)
+        chunks = retrieve_top_k(sub_query, k, query_ctx=query_ctx)
         all_chunks.extend(chunks)
     seen = set()
     unique_chunks = []
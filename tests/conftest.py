@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Modules import each other as utils.* (repo root) and chat_code, app, ... (src)
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "src")]
@@ -0,0 +1,52 @@
+import utils.chat_history as chat_history
+from utils.chat_history import compact_history, SummaryCache
+from utils.conversation_store import ConversationStore
+
+
+def word_count(texts):
+    return [len(text.split()) for text in texts]
+
+
+def counting_summarizer(calls):
+    def summarize(previous, messages):
+        calls.append(len(messages))
+        return f"{previous or ''}+{len(messages)}"
+    return summarize
+
+
+def turn(n):
+    return {"role": "user", "content": f"question {n} " + "word " * 20}, {"role": "assistant", "content": f"answer {n} " + "word " * 20}
+
+
+def test_trimmed_conversation_extends_its_summary(monkeypatch):
+    monkeypatch.setattr(chat_history, "count_tokens_batch", word_count)
+    store = ConversationStore(db_path=None, max_messages=40)
+    conversation = store.replace(None, [])
+    calls = []
+    per_turn = []
+    for n in range(60):
+        user, reply = turn(n)
+        before = len(calls)
+        compact_history(conversation.messages + [user], user["content"], budget=200, segment=6,
+                        summarize=counting_summarizer(calls), cache=conversation)
+        per_turn.append(len(calls) - before)
+        store.append(conversation, user, reply)
+    # Past the 40 message cap every turn trims the head, yet each turn adds at most one segment
+    assert len(conversation.messages) == 40
+    assert max(per_turn[30:]) <= 1
+    assert sum(per_turn[30:]) <= 30 * 2 // 6 + 1
+
+
+def test_summary_calls_per_turn_are_capped(monkeypatch):
+    monkeypatch.setattr(chat_history, "count_tokens_batch", word_count)
+    messages = [message for n in range(100) for message in turn(n)]
+    calls = []
+    cache = SummaryCache()
+    history = compact_history(messages + [{"role": "user", "content": "next"}], "next", budget=200, segment=6,
+                              summarize=counting_summarizer(calls), cache=cache)
+    assert len(calls) == chat_history.HISTORY_MAX_SUMMARY_SEGMENTS
+    assert history[0]["role"] == "system"
+    # The next turn resumes where the previous one stopped
+    compact_history(messages + [{"role": "user", "content": "next"}], "next", budget=200, segment=6,
+                    summarize=counting_summarizer(calls), cache=cache)
+    assert len(calls) == 2 * chat_history.HISTORY_MAX_SUMMARY_SEGMENTS
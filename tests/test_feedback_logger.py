@@ -0,0 +1,33 @@
+import os
+from utils.feedback_logger import LocalFileBackend, build_feedback_record, feedback_to_csv, read_feedback
+from utils.analytics_store import read_new_feedback
+
+# The legacy feedback.csv starts with an unquoted header that predates the feedback_id column
+LEGACY_CSV = (
+    "timestamp,strategy,prompt_version,model_name,feedback,title,chat_history\n"
+    '"2025-06-17T09:00:00","cot","v1","gpt","thumbs_up","Old chat","User: hi"\n'
+)
+
+
+def make_backend(tmp_path):
+    backend = LocalFileBackend(str(tmp_path))
+    with open(os.path.join(tmp_path, "feedback.csv"), "w", encoding="utf-8", newline="") as f:
+        f.write(LEGACY_CSV)
+    record = build_feedback_record("cot", "v1", "gpt", "thumbs_down", "New chat", "User: hello")
+    backend.append("date=2025-06-18/hour=10", feedback_to_csv([record]))
+    return backend
+
+
+def test_read_feedback_skips_legacy_header(tmp_path):
+    df = read_feedback(make_backend(tmp_path))
+    assert list(df["title"]) == ["Old chat", "New chat"]
+    assert "timestamp" not in set(df["timestamp"])
+    assert df["feedback_id"].iloc[0] == ""
+    assert len(df["feedback_id"].iloc[1]) == 32
+
+
+def test_read_new_feedback_skips_legacy_header(tmp_path):
+    records, checkpoint = read_new_feedback(make_backend(tmp_path), {})
+    assert [record["title"] for record in sorted(records, key=lambda r: r["timestamp"])] == ["Old chat", "New chat"]
+    assert all(record["timestamp"] != "timestamp" for record in records)
+    assert len(checkpoint) == 2
@@ -0,0 +1,12 @@
+from utils.rerankers import parse_ranking
+
+
+def test_parse_ranking_reads_number_lines():
+    assert parse_ranking("3\n1\n2", 5) == [2, 0, 1]
+    assert parse_ranking("3, 1, 2", 5) == [2, 0, 1]
+    assert parse_ranking("[2] most relevant\n[4] also relevant\n2. repeated", 5) == [1, 3]
+
+
+def test_parse_ranking_ignores_numbers_in_prose():
+    assert parse_ranking("Chunk 3 is best because it covers 2019 and 1 more fact", 5) == []
+    assert parse_ranking("4 - covers 2019 and 1 more fact\n9\n0", 5) == [3]
@@ -0,0 +1,430 @@
+import os
+import re
+import io
+import csv
+import sys
+import glob
+import gzip
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from utils.feedback_logger import FEEDBACK_HEADER, create_backend, drop_duplicate_feedback, is_header_row
+
+# Columnar store for dashboards: interaction logs (logs/interactions.*.jsonl, see utils.logger) and
+# feedback records are ingested incrementally from a checkpoint into Parquet files partitioned by
+# date (<dir>/<table>/date=YYYY-MM-DD/part-<run>.parquet). An hourly rollup per strategy and prompt
+# version is recomputed for every date that received rows, so dashboards read a few rows per hour
+# instead of scanning the raw history.
+ANALYTICS_DIR = os.getenv("ANALYTICS_DIR", "analytics")
+LOG_DIR = os.getenv("LOG_DIR", "logs")
+ANALYTICS_COMPACT_PARTS = int(os.getenv("ANALYTICS_COMPACT_PARTS", "8"))  # merge a past date once it has this many files
+CHECKPOINT_FILE_NAME = "checkpoint.json"
+LOG_FILE_PATTERN = re.compile(r"^interactions\.(\d+)(?:\.(.+?))?\.jsonl(?:\.gz)?$")
+STAGES = ["embed", "domain", "search", "lexical_search", "rerank", "filter", "generate"]
+
+INTERACTION_SCHEMA = pa.schema(
+    [
+        ("timestamp", pa.timestamp("us")),
+        ("event", pa.string()),
+        ("trace_id", pa.string()),
+        ("query", pa.string()),
+        ("strategy", pa.string()),
+        ("prompt_version", pa.string()),
+        ("index_version", pa.string()),
+        ("model", pa.string()),
+        ("latency_ms", pa.float64()),
+        ("tokens_used", pa.int64()),
+        ("prompt_tokens", pa.int64()),
+        ("completion_tokens", pa.int64()),
+        ("response_chars", pa.int64()),
+        ("response", pa.string()),
+        ("error", pa.string()),
+        ("context", pa.string())
+    ]
+    + [(f"{stage}_ms", pa.float64()) for stage in STAGES]
+    + [("spans", pa.string())]
+)
+FEEDBACK_SCHEMA = pa.schema([("timestamp", pa.timestamp("us"))] + [(name, pa.string()) for name in FEEDBACK_HEADER[1:]])
+ROLLUP_SCHEMA = pa.schema([
+    ("hour", pa.timestamp("us")),
+    ("strategy", pa.string()),
+    ("prompt_version", pa.string()),
+    ("requests", pa.int64()),
+    ("errors", pa.int64()),
+    ("cache_hits", pa.int64()),
+    ("latency_p50_ms", pa.float64()),
+    ("latency_p95_ms", pa.float64()),
+    ("latency_p99_ms", pa.float64()),
+    ("prompt_tokens", pa.int64()),
+    ("completion_tokens", pa.int64()),
+    ("total_tokens", pa.int64()),
+    ("thumbs_up", pa.int64()),
+    ("thumbs_down", pa.int64())
+])
+TABLES = {"interactions": INTERACTION_SCHEMA, "feedback": FEEDBACK_SCHEMA, "rollups": ROLLUP_SCHEMA}
+
+# Function to reduce a served prompt version ("v1@27e44ba3") to the prompt file version ("v1"),
+# which is what feedback records carry, so the two line up in rollups
+def prompt_family(version):
+    return version.split("@", 1)[0] if isinstance(version, str) else version
+
+# Function to flatten one JSON log record into an interactions row
+def interaction_row(record):
+    context = record.get("context") or {}
+    durations = {}
+    for span in record.get("spans") or []:
+        durations[span["stage"]] = durations.get(span["stage"], 0.0) + span["duration_ms"]
+    row = {
+        "timestamp": record.get("timestamp"),
+        "event": record.get("event", "interaction"),
+        "trace_id": record.get("trace_id"),
+        "query": record.get("query", context.get("query")),
+        "strategy": record.get("strategy", context.get("strategy")),
+        "prompt_version": record.get("prompt_version"),
+        "index_version": record.get("index_version"),
+        "model": record.get("model"),
+        "latency_ms": record.get("latency_ms"),
+        "tokens_used": record.get("tokens_used"),
+        "prompt_tokens": record.get("prompt_tokens"),
+        "completion_tokens": record.get("completion_tokens"),
+        "response_chars": record.get("response_chars"),
+        "response": record.get("response"),
+        "error": record.get("error"),
+        "context": json.dumps(context) if context else None,
+        "spans": json.dumps(record["spans"]) if record.get("spans") else None
+    }
+    for stage in STAGES:
+        row[f"{stage}_ms"] = durations.get(stage)
+    return row
+
+def to_table(rows, schema):
+    df = pd.DataFrame(rows, columns=schema.names)
+    time_column = schema.names[0]
+    df[time_column] = pd.to_datetime(df[time_column], errors="coerce")
+    for field in schema:
+        if pa.types.is_integer(field.type):
+            df[field.name] = pd.to_numeric(df[field.name], errors="coerce").astype("Int64")
+        elif pa.types.is_floating(field.type):
+            df[field.name] = pd.to_numeric(df[field.name], errors="coerce").astype("float64")
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+def date_of(timestamp):
+    return str(timestamp)[:10]
+
+
+# Tails the per-worker JSONL logs. A worker's active file is read from a byte offset; when it has
+# rotated, the first new rotated file is the old active file and is read from that same offset.
+class LogTailer:
+    def __init__(self, directory=LOG_DIR):
+        self.directory = directory
+
+    def streams(self):
+        streams = {}
+        for path in glob.glob(os.path.join(self.directory, "interactions.*.jsonl*")):
+            match = LOG_FILE_PATTERN.match(os.path.basename(path))
+            if not match:
+                continue
+            stream = streams.setdefault(match.group(1), {"active": None, "rotated": {}})
+            if match.group(2) is None:
+                stream["active"] = path
+            else:
+                # While loguru compresses, a rotated file briefly exists both plain and gzipped
+                key = os.path.basename(path).removesuffix(".gz")
+                if key not in stream["rotated"] or path.endswith(".gz"):
+                    stream["rotated"][key] = path
+        return streams
+
+    # Function to read the records written since the checkpoint; returns (records, new checkpoint)
+    def read(self, checkpoint):
+        records = []
+        new_checkpoint = {}
+        for pid, stream in self.streams().items():
+            state = checkpoint.get(pid, {"done": [], "inode": None, "offset": 0})
+            done = set(state["done"])
+            inode, offset = state["inode"], state["offset"]
+            for key in sorted(stream["rotated"]):
+                if key in done:
+                    continue
+                skip = offset if inode is not None else 0
+                data, _ = self._read_lines(stream["rotated"][key], skip, complete_only=False)
+                records += data
+                inode, offset = None, 0
+                done.add(key)
+            if stream["active"] is not None:
+                active_inode = os.stat(stream["active"]).st_ino
+                start = offset if inode == active_inode else 0
+                data, offset = self._read_lines(stream["active"], start, complete_only=True)
+                records += data
+                inode = active_inode
+            # Rotated files removed by retention no longer need tracking
+            new_checkpoint[pid] = {"done": sorted(done & set(stream["rotated"])), "inode": inode, "offset": offset}
+        return records, new_checkpoint
+
+    def _read_lines(self, path, offset, complete_only):
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        if complete_only:
+            # A line still being written is picked up next time
+            data = data[:data.rfind(b"\n") + 1]
+        records = []
+        for line in data.splitlines():
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print(f"⚠️ Skipped a malformed line in {path}")
+        return records, offset + len(data)
+
+
+# Function to read feedback appended since the checkpoint ({segment: bytes read}); returns (records, new checkpoint)
+def read_new_feedback(backend, checkpoint):
+    records = []
+    new_checkpoint = {}
+    for name, size in backend.segment_sizes().items():
+        offset = checkpoint.get(name, 0)
+        if size < offset:
+            # Rewritten (the legacy feedback.csv), read again from the start
+            offset = 0
+        if size > offset:
+            data = backend.read_segment_bytes(name, offset)
+            # Rows are fully quoted, so complete rows end with a quote and a line break
+            end = max(data.rfind(b'"\n') + 2, data.rfind(b'"\r\n') + 3, 0)
+            data = data[:end] if end > 2 else b""
+            for row in csv.reader(io.StringIO(data.decode("utf-8"), newline="")):
+                if not row or is_header_row(row):
+                    continue
+                row = (row + [""] * len(FEEDBACK_HEADER))[:len(FEEDBACK_HEADER)]
+                records.append(dict(zip(FEEDBACK_HEADER, row)))
+            offset += len(data)
+        new_checkpoint[name] = offset
+    return records, new_checkpoint
+
+
+# Function to compute the hourly rollup of one date from its interaction and feedback rows
+def compute_rollup(interactions, feedback):
+    keys = ["hour", "strategy", "prompt_version"]
+    frames = []
+    if len(interactions):
+        df = interactions.assign(
+            hour=interactions["timestamp"].dt.floor("h"),
+            prompt_version=interactions["prompt_version"].map(prompt_family)
+        )
+        answered = df[df["event"] == "interaction"]
+        grouped = answered.groupby(keys, dropna=False)
+        frames.append(pd.DataFrame({
+            "requests": grouped.size(),
+            "cache_hits": grouped["tokens_used"].apply(lambda tokens: int((tokens == 0).sum())),
+            "latency_p50_ms": grouped["latency_ms"].quantile(0.5),
+            "latency_p95_ms": grouped["latency_ms"].quantile(0.95),
+            "latency_p99_ms": grouped["latency_ms"].quantile(0.99),
+            "prompt_tokens": grouped["prompt_tokens"].sum(min_count=1),
+            "completion_tokens": grouped["completion_tokens"].sum(min_count=1),
+            "total_tokens": grouped["tokens_used"].sum(min_count=1)
+        }))
+        errors = df[df["event"] == "error"].groupby(keys, dropna=False).size()
+        if len(errors):
+            frames.append(pd.DataFrame({"errors": errors}))
+    if len(feedback):
+        df = drop_duplicate_feedback(feedback).assign(hour=feedback["timestamp"].dt.floor("h"), prompt_version=feedback["prompt_version"].map(prompt_family))
+        grouped = df.groupby(keys, dropna=False)["feedback"]
+        frames.append(pd.DataFrame({
+            "thumbs_up": grouped.apply(lambda values: int((values == "thumbs_up").sum())),
+            "thumbs_down": grouped.apply(lambda values: int((values == "thumbs_down").sum()))
+        }))
+    if not frames:
+        return ROLLUP_SCHEMA.empty_table()
+    rollup = pd.concat(frames, axis=1).reset_index()
+    for column in ("requests", "errors", "cache_hits", "thumbs_up", "thumbs_down"):
+        rollup[column] = rollup[column].fillna(0) if column in rollup else 0
+    return to_table(rollup.to_dict("records"), ROLLUP_SCHEMA)
+
+
+class AnalyticsStore:
+    def __init__(self, directory=ANALYTICS_DIR, log_dir=LOG_DIR, feedback_backend=None):
+        self.directory = directory
+        self.tailer = LogTailer(log_dir)
+        self.feedback_backend = feedback_backend
+
+    def table_dir(self, table):
+        return os.path.join(self.directory, table)
+
+    def partition_dir(self, table, date):
+        return os.path.join(self.table_dir(table), f"date={date}")
+
+    def load_checkpoint(self):
+        path = os.path.join(self.directory, CHECKPOINT_FILE_NAME)
+        if not os.path.exists(path):
+            return {"run": 0, "logs": {}, "feedback": {}, "superseded": []}
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_checkpoint(self, checkpoint):
+        path = os.path.join(self.directory, CHECKPOINT_FILE_NAME)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(path + ".tmp", path)
+
+    def write_part(self, table, date, data, run):
+        directory = self.partition_dir(table, date)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{run:08d}.parquet")
+        # Dot-prefixed while being written, so readers never see half a file
+        tmp_path = os.path.join(directory, f".part-{run:08d}.parquet.tmp")
+        pq.write_table(data, tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    # Function to drop what a crashed run left behind: parts newer than the last committed run,
+    # and files a committed compaction replaced but did not get to delete
+    def recover(self, checkpoint):
+        for path in glob.glob(os.path.join(self.directory, "*", "date=*", "part-*.parquet")):
+            run = int(re.search(r"part-(\d+)", os.path.basename(path)).group(1))
+            if run > checkpoint["run"]:
+                os.remove(path)
+        for path in checkpoint.get("superseded", []):
+            if os.path.exists(path):
+                os.remove(path)
+        checkpoint["superseded"] = []
+
+    def read_partition(self, table, date):
+        directory = self.partition_dir(table, date)
+        if not glob.glob(os.path.join(directory, "part-*.parquet")):
+            return TABLES[table].empty_table().to_pandas()
+        return ds.dataset(directory, schema=TABLES[table], format="parquet").to_table().to_pandas()
+
+    # Function to ingest everything new since the last run; returns the number of rows added per table
+    def ingest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        checkpoint = self.load_checkpoint()
+        self.recover(checkpoint)
+        run = checkpoint["run"] + 1
+
+        log_records, log_checkpoint = self.tailer.read(checkpoint["logs"])
+        feedback_backend = self.feedback_backend or create_backend()
+        feedback_records, feedback_checkpoint = read_new_feedback(feedback_backend, checkpoint["feedback"])
+        new_rows = {
+            "interactions": [interaction_row(record) for record in log_records if record.get("timestamp")],
+            "feedback": [record for record in feedback_records if record.get("timestamp")]
+        }
+
+        touched = set()
+        for table, rows in new_rows.items():
+            by_date = {}
+            for row in rows:
+                by_date.setdefault(date_of(row["timestamp"]), []).append(row)
+            for date, date_rows in by_date.items():
+                self.write_part(table, date, to_table(date_rows, TABLES[table]), run)
+                touched.add(date)
+
+        superseded = self.compact(run)
+        for date in sorted(touched):
+            rollup = compute_rollup(self.read_partition("interactions", date), self.read_partition("feedback", date))
+            directory = self.partition_dir("rollups", date)
+            for old in glob.glob(os.path.join(directory, "part-*.parquet")):
+                superseded.append(old)
+            self.write_part("rollups", date, rollup, run)
+
+        self.save_checkpoint({"run": run, "logs": log_checkpoint, "feedback": feedback_checkpoint, "superseded": superseded})
+        for path in superseded:
+            if os.path.exists(path):
+                os.remove(path)
+        self.save_checkpoint({"run": run, "logs": log_checkpoint, "feedback": feedback_checkpoint, "superseded": []})
+        return {table: len(rows) for table, rows in new_rows.items()}
+
+    # Function to merge the part files of past dates that have accumulated many; returns the replaced files
+    def compact(self, run):
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        superseded = []
+        for table in ("interactions", "feedback"):
+            for directory in glob.glob(os.path.join(self.table_dir(table), "date=*")):
+                date = directory.rsplit("=", 1)[1]
+                parts = sorted(glob.glob(os.path.join(directory, "part-*.parquet")))
+                if date >= today or len(parts) < ANALYTICS_COMPACT_PARTS:
+                    continue
+                merged = ds.dataset(parts, schema=TABLES[table], format="parquet").to_table()
+                merged_path = self.write_part(table, date, merged, run)
+                superseded += [part for part in parts if part != merged_path]
+        return superseded
+
+    # Query API. start and end are dates ("2025-06-17") or timestamps; end is exclusive.
+    def _read(self, table, start=None, end=None, columns=None, time_column="timestamp"):
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        # Only the files of date partitions inside the range are opened
+        files = []
+        for directory in sorted(glob.glob(os.path.join(self.table_dir(table), "date=*"))):
+            date = directory.rsplit("=", 1)[1]
+            if (start is None or date >= start.strftime("%Y-%m-%d")) and (end is None or date <= end.strftime("%Y-%m-%d")):
+                files += sorted(glob.glob(os.path.join(directory, "part-*.parquet")))
+        if not files:
+            return TABLES[table].empty_table().select(columns or TABLES[table].names).to_pandas()
+
+        condition = None
+        if start is not None:
+            condition = ds.field(time_column) >= pa.scalar(start.to_pydatetime(), pa.timestamp("us"))
+        if end is not None:
+            upper = ds.field(time_column) < pa.scalar(end.to_pydatetime(), pa.timestamp("us"))
+            condition = upper if condition is None else condition & upper
+        return ds.dataset(files, schema=TABLES[table], format="parquet").to_table(columns=columns, filter=condition).to_pandas()
+
+    def interactions(self, start=None, end=None, columns=None):
+        return self._read("interactions", start, end, columns)
+
+    def feedback(self, start=None, end=None, columns=None):
+        return drop_duplicate_feedback(self._read("feedback", start, end, columns))
+
+    def rollups(self, start=None, end=None, strategy=None, prompt_version=None):
+        df = self._read("rollups", start, end, time_column="hour")
+        if strategy is not None:
+            df = df[df["strategy"] == strategy]
+        if prompt_version is not None:
+            df = df[df["prompt_version"] == prompt_version]
+        return df.sort_values("hour").reset_index(drop=True)
+
+    # Function to total the rollups over a range, grouped by strategy and/or prompt version.
+    # Latency percentiles do not add up across hours, so they are computed from the raw latency column.
+    def summary(self, start=None, end=None, by=("strategy", "prompt_version")):
+        by = list(by)
+        rollups = self.rollups(start, end)
+        totals = rollups.groupby(by, dropna=False)[
+            ["requests", "errors", "cache_hits", "prompt_tokens", "completion_tokens", "total_tokens", "thumbs_up", "thumbs_down"]
+        ].sum()
+        latencies = self.interactions(start, end, columns=["event", "latency_ms"] + by)
+        latencies = latencies[latencies["event"] == "interaction"]
+        if "prompt_version" in by:
+            latencies = latencies.assign(prompt_version=latencies["prompt_version"].map(prompt_family))
+        if len(latencies):
+            grouped = latencies.groupby(by, dropna=False)["latency_ms"]
+            for q in (50, 95, 99):
+                totals[f"latency_p{q}_ms"] = grouped.quantile(q / 100)
+        feedback_total = totals["thumbs_up"] + totals["thumbs_down"]
+        totals["thumbs_up_ratio"] = totals["thumbs_up"] / feedback_total.replace(0, np.nan)
+        return totals.reset_index()
+
+
+# Ingest once, or every --interval seconds; or print a summary
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest interaction logs and feedback into the analytics store")
+    parser.add_argument("command", choices=["ingest", "summary"])
+    parser.add_argument("--interval", type=float, default=0, help="seconds between ingestion runs (0 = run once)")
+    parser.add_argument("--start", help="summary start date (inclusive)")
+    parser.add_argument("--end", help="summary end date (exclusive)")
+    args = parser.parse_args()
+
+    store = AnalyticsStore()
+    if args.command == "summary":
+        with pd.option_context("display.width", 200, "display.max_columns", None):
+            print(store.summary(args.start, args.end))
+        sys.exit(0)
+    while True:
+        added = store.ingest()
+        print(f"✅ Ingested {added['interactions']} log records and {added['feedback']} feedback records")
+        if not args.interval:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,134 @@
+import os
+import json
+import faiss
+import numpy as np
+
+# Index types the embedder can build. All of them index L2-normalized vectors, so the score a
+# search returns can be turned back into cosine similarity (see to_similarity).
+#   flat  - exact inner product (brute force), best for small corpora
+#   hnsw  - graph index, fast and high recall, vectors kept uncompressed
+#   ivfpq - inverted lists + product quantization, compact, for very large corpora
+#   l2    - exact squared-L2 (the original IndexFlatL2)
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")
+INDEX_META_FILE_NAME = "index_meta.json"
+
+# "auto" picks flat below HNSW_MIN_VECTORS, hnsw below IVFPQ_MIN_VECTORS, ivfpq above
+HNSW_MIN_VECTORS = int(os.getenv("INDEX_HNSW_MIN_VECTORS", "50000"))
+IVFPQ_MIN_VECTORS = int(os.getenv("INDEX_IVFPQ_MIN_VECTORS", "1000000"))
+
+HNSW_M = int(os.getenv("INDEX_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("INDEX_HNSW_EF_CONSTRUCTION", "200"))
+HNSW_EF_SEARCH = int(os.getenv("INDEX_HNSW_EF_SEARCH", "64"))
+IVF_NLIST = int(os.getenv("INDEX_IVF_NLIST", "0"))  # 0 = about 4 * sqrt(n), capped by training size
+IVF_NPROBE = int(os.getenv("INDEX_IVF_NPROBE", "16"))
+PQ_M = int(os.getenv("INDEX_PQ_M", "64"))
+IVF_TRAIN_SAMPLE = int(os.getenv("INDEX_IVF_TRAIN_SAMPLE", "200000"))
+
+METRICS = {"ip": faiss.METRIC_INNER_PRODUCT, "l2": faiss.METRIC_L2}
+
+def choose_index_type(ntotal, kind=INDEX_TYPE):
+    if kind != "auto":
+        return kind
+    if ntotal < HNSW_MIN_VECTORS:
+        return "flat"
+    if ntotal < IVFPQ_MIN_VECTORS:
+        return "hnsw"
+    return "ivfpq"
+
+# k-means wants at least 39 training points per list
+def ivf_nlist(ntotal):
+    return IVF_NLIST or max(1, min(int(4 * np.sqrt(ntotal)), min(ntotal, IVF_TRAIN_SAMPLE) // 39))
+
+# Function to pick the largest PQ sub-quantizer count <= PQ_M that divides the dimension
+def pq_m(dimension):
+    return next(m for m in range(min(PQ_M, dimension), 0, -1) if dimension % m == 0)
+
+# Bits per PQ code: 8 (256 centroids per sub-quantizer) once there is enough data to train them
+def pq_nbits(ntotal):
+    return max(1, min(8, int(np.log2(max(2, min(ntotal, IVF_TRAIN_SAMPLE) // 39)))))
+
+# Function to build an index of the given type over the vectors.
+# Returns the index and its metadata (type, metric, build and search parameters).
+def build_index(vectors, kind=INDEX_TYPE):
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    faiss.normalize_L2(vectors)
+    ntotal, dimension = vectors.shape
+    kind = choose_index_type(ntotal, kind)
+    meta = {"type": kind, "metric": "l2" if kind == "l2" else "ip", "normalized": True, "dimension": dimension, "ntotal": ntotal, "search": {}}
+
+    if kind in ("flat", "l2"):
+        factory = "Flat"
+    elif kind == "hnsw":
+        factory = f"HNSW{HNSW_M},Flat"
+        meta["search"]["efSearch"] = HNSW_EF_SEARCH
+    elif kind == "ivfpq":
+        nlist = ivf_nlist(ntotal)
+        factory = f"IVF{nlist},PQ{pq_m(dimension)}x{pq_nbits(ntotal)}"
+        meta["search"]["nprobe"] = min(IVF_NPROBE, nlist)
+    else:
+        raise ValueError(f"Unknown index type '{kind}'")
+    meta["factory"] = factory
+
+    index = faiss.index_factory(dimension, factory, METRICS[meta["metric"]])
+    if kind == "hnsw":
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        sample = vectors
+        if ntotal > IVF_TRAIN_SAMPLE:
+            sample = vectors[np.random.default_rng(1234).choice(ntotal, IVF_TRAIN_SAMPLE, replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    if kind == "ivfpq":
+        # Lets reconstruct_n work (the domain model is rebuilt from the index when missing)
+        faiss.extract_index_ivf(index).make_direct_map()
+    apply_search_params(index, meta)
+    return index, meta
+
+def save_index_meta(path, meta):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+# Function to load the index metadata, or derive it from the index itself for older artifacts
+# (a bare IndexFlatL2 over the normalized Azure OpenAI embeddings)
+def load_index_meta(path, index):
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("ntotal") == index.ntotal and meta.get("dimension") == index.d:
+            return meta
+        print("⚠️ Index metadata does not match the index, deriving it from the index")
+    metric = "ip" if index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+    return {"type": "flat" if metric == "ip" else "l2", "metric": metric, "normalized": True, "dimension": index.d, "ntotal": index.ntotal, "search": {}}
+
+# Function to apply search-time knobs (efSearch, nprobe); environment settings win over the artifact
+def apply_search_params(index, meta):
+    params = dict(meta.get("search", {}))
+    if "efSearch" in params and os.getenv("INDEX_HNSW_EF_SEARCH"):
+        params["efSearch"] = HNSW_EF_SEARCH
+    if "nprobe" in params and os.getenv("INDEX_IVF_NPROBE"):
+        params["nprobe"] = IVF_NPROBE
+    space = faiss.ParameterSpace()
+    for name, value in params.items():
+        space.set_index_parameter(index, name, value)
+    return params
+
+# Function to convert raw search scores to cosine similarity for the index metric.
+# Inner product over unit vectors is the cosine; squared L2 between unit vectors is 2 - 2 * cosine.
+def to_similarity(scores, metric):
+    scores = np.asarray(scores, dtype="float32")
+    if metric == "ip":
+        return scores
+    if metric == "l2":
+        return 1.0 - scores / 2.0
+    raise ValueError(f"Unknown index metric '{metric}'")
+
+# Function to build per-call search parameters restricting a search to selected ids,
+# keeping the efSearch/nprobe already applied to the index
+def search_parameters(index, selector):
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    return faiss.SearchParameters(sel=selector)
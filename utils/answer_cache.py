@@ -0,0 +1,126 @@
+import os
+import copy
+import glob
+import time
+import threading
+import numpy as np
+from utils.artifacts import file_fingerprint
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_CHECK_INTERVAL = float(os.getenv("ANSWER_CACHE_CHECK_INTERVAL", "5"))
+
+PROMPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'prompts'))
+
+
+# Semantic answer cache: a small in-memory vector index of previous queries and their answers.
+# A lookup hits when cosine similarity is above the threshold and prompt version, strategy
+# and index version all match. The index version is that of the generation serving the request, so
+# entries of a swapped-out generation never match again and age out. Everything is dropped when a
+# prompt file changes.
+class SemanticAnswerCache:
+    def __init__(self, threshold=ANSWER_CACHE_THRESHOLD, max_size=ANSWER_CACHE_SIZE,
+                 ttl=ANSWER_CACHE_TTL_SECONDS, check_interval=ANSWER_CACHE_CHECK_INTERVAL):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._reset()
+        self.fingerprint = self._current_fingerprint()
+        self.last_check = time.time()
+
+    def _reset(self):
+        self.vectors = None
+        self.keys = []
+        self.results = []
+        self.created = np.zeros(0)
+        self.last_used = np.zeros(0)
+
+    def _current_fingerprint(self):
+        return file_fingerprint(glob.glob(os.path.join(PROMPTS_DIR, "*_prompts.json")))
+
+    # Function to drop every entry if a prompt file changed since the last check
+    def _check_artifacts(self, now):
+        if now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        fingerprint = self._current_fingerprint()
+        if fingerprint != self.fingerprint:
+            self.fingerprint = fingerprint
+            self._reset()
+            self.invalidations += 1
+
+    def _remove(self, positions):
+        keep = np.ones(len(self.keys), dtype=bool)
+        keep[positions] = False
+        self.vectors = self.vectors[keep] if keep.any() else None
+        self.keys = [key for key, k in zip(self.keys, keep) if k]
+        self.results = [result for result, k in zip(self.results, keep) if k]
+        self.created = self.created[keep]
+        self.last_used = self.last_used[keep]
+
+    def lookup(self, query_vec, prompt_version, strategy, index_version):
+        now = time.time()
+        key = (prompt_version, strategy, index_version)
+        with self.lock:
+            self._check_artifacts(now)
+            if self.vectors is None:
+                self.misses += 1
+                return None
+
+            expired = np.flatnonzero(now - self.created > self.ttl)
+            if len(expired):
+                self._remove(expired)
+                if self.vectors is None:
+                    self.misses += 1
+                    return None
+
+            sims = self.vectors @ np.asarray(query_vec, dtype="float32").reshape(-1)
+            sims[[i for i, k in enumerate(self.keys) if k != key]] = -1.0
+            best = int(np.argmax(sims))
+            if sims[best] < self.threshold:
+                self.misses += 1
+                return None
+
+            self.last_used[best] = now
+            self.hits += 1
+            return copy.deepcopy(self.results[best])
+
+    def store(self, query_vec, prompt_version, strategy, index_version, result):
+        now = time.time()
+        vec = np.asarray(query_vec, dtype="float32").reshape(1, -1)
+        with self.lock:
+            self._check_artifacts(now)
+            if self.vectors is not None and len(self.keys) >= self.max_size:
+                # Evict the least recently used entry
+                self._remove([int(np.argmin(self.last_used))])
+                self.evictions += 1
+            self.vectors = vec if self.vectors is None else np.vstack([self.vectors, vec])
+            self.keys.append((prompt_version, strategy, index_version))
+            self.results.append(copy.deepcopy(result))
+            self.created = np.append(self.created, now)
+            self.last_used = np.append(self.last_used, now)
+
+    def clear(self):
+        with self.lock:
+            self._reset()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.keys),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
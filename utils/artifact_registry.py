@@ -0,0 +1,97 @@
+import os
+import time
+import threading
+import weakref
+
+# Versioned registry for artifacts that can change while the app runs (index, prompt templates).
+#
+#   sync()               - refreshes the sources (conditional downloads, file stats) and returns (version, state)
+#   load(version, state) - builds a generation from them; the result must have a .version
+#
+# A new generation is built off to the side and swapped in with a single assignment, so a request
+# sees either the old or the new one, never a mix. Requests pin the generation they started on;
+# a retired generation stays alive until the last request holding it finishes, and is then released.
+class ArtifactRegistry:
+    def __init__(self, name, sync, load, reload_interval=0, background=False):
+        self.name = name
+        self.sync = sync
+        self.load = load
+        self.reload_interval = reload_interval
+        # Expensive loads (the index) are polled by a background thread; cheap ones are checked
+        # inline at most once per reload_interval
+        self.background = background
+        self.reload_lock = threading.Lock()
+        self.thread_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.last_check = 0.0
+        self.failed_version = None
+        self.draining = weakref.WeakSet()
+        self.current = None
+        self.reload()
+
+    # Function to return the active generation (the caller keeps it for the rest of the request)
+    def get(self):
+        if self.reload_interval > 0:
+            if self.background:
+                self._ensure_watcher()
+            elif time.monotonic() - self.last_check >= self.reload_interval:
+                self._check_inline()
+        return self.current
+
+    # Function to sync the sources and swap in a new generation if the version changed.
+    # Returns True when it swapped. Failures after the first load keep the current generation.
+    def reload(self):
+        with self.reload_lock:
+            return self._reload()
+
+    def _reload(self):
+        self.last_check = time.monotonic()
+        version = None
+        try:
+            version, state = self.sync()
+            # A version that failed to load is not retried until the sources change again
+            if self.current is not None and version in (self.current.version, self.failed_version):
+                return False
+            generation = self.load(version, state)
+        except Exception as e:
+            if self.current is None:
+                raise
+            self.failed_version = version
+            print(f"⚠️ Failed to reload {self.name}, keeping generation {self.current.version}:", e)
+            return False
+
+        previous = self.current
+        self.current = generation
+        if previous is None:
+            print(f"✅ {self.name} generation {generation.version} loaded")
+            return True
+        self.draining.add(previous)
+        weakref.finalize(previous, print, f"✅ {self.name} generation {previous.version} drained")
+        print(f"🔄 {self.name} generation {generation.version} active, draining {previous.version}")
+        return True
+
+    def stats(self):
+        return {"version": self.current.version, "draining": sorted(g.version for g in list(self.draining))}
+
+    def _check_inline(self):
+        # One request does the check; the others carry on with the current generation
+        if not self.reload_lock.acquire(blocking=False):
+            return
+        try:
+            self._reload()
+        finally:
+            self.reload_lock.release()
+
+    def _ensure_watcher(self):
+        # Started lazily so each gunicorn worker gets its own thread after fork
+        with self.thread_lock:
+            if self.thread is None or not self.thread.is_alive() or self.thread_pid != os.getpid():
+                self.thread = threading.Thread(target=self._watch, name=f"{self.name}-reload", daemon=True)
+                self.thread_pid = os.getpid()
+                self.thread.start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.reload_interval)
+            self.reload()
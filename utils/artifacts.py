@@ -0,0 +1,110 @@
+import os
+import shutil
+import hashlib
+import faiss
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError, ResourceNotModifiedError
+from utils.clients import get_blob_service_client
+
+# Where index artifacts come from: "blob" (Azure Storage) or "local" (a directory standing in for it)
+ARTIFACT_STORE = os.getenv("ARTIFACT_STORE", "blob")
+ARTIFACT_LOCAL_DIR = os.getenv("ARTIFACT_LOCAL_DIR", "artifacts")
+DOWNLOAD_CHUNK_BYTES = 4 * 1024 * 1024
+DOWNLOAD_MAX_CONCURRENCY = int(os.getenv("ARTIFACT_DOWNLOAD_CONCURRENCY", "4"))
+
+# Function to fingerprint files by size and modification time (cheap, no reads)
+def file_fingerprint(paths):
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        try:
+            stat = os.stat(path)
+            digest.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns};".encode("utf-8"))
+        except FileNotFoundError:
+            digest.update(f"{path}:missing;".encode("utf-8"))
+    return digest.hexdigest()[:12]
+
+# The version of each local copy is kept in a small sidecar file next to it
+def read_local_etag(local_path):
+    etag_path = local_path + ".etag"
+    if not os.path.exists(local_path) or not os.path.exists(etag_path):
+        return None
+    with open(etag_path, "r", encoding="utf-8") as f:
+        return f.read().strip() or None
+
+def write_local_etag(local_path, etag):
+    with open(local_path + ".etag", "w", encoding="utf-8") as f:
+        f.write(etag)
+
+
+# Azure Blob Storage: conditional download on ETag, streamed to disk in chunks
+class BlobArtifactStore:
+    def __init__(self, container):
+        self.container_client = get_blob_service_client().get_container_client(container)
+
+    # Function to refresh local_path if the blob changed; returns True when it downloaded
+    def fetch(self, name, local_path):
+        blob_client = self.container_client.get_blob_client(name)
+        local_etag = read_local_etag(local_path)
+        try:
+            if local_etag:
+                downloader = blob_client.download_blob(etag=local_etag, match_condition=MatchConditions.IfModified, max_concurrency=DOWNLOAD_MAX_CONCURRENCY)
+            else:
+                downloader = blob_client.download_blob(max_concurrency=DOWNLOAD_MAX_CONCURRENCY)
+        except ResourceNotModifiedError:
+            return False
+        except ResourceNotFoundError as e:
+            raise FileNotFoundError(name) from e
+        except HttpResponseError as e:
+            # The storage SDK re-raises the 304 of a conditional download as a generic error
+            if e.status_code == 304:
+                return False
+            raise
+
+        # Write to a temp file and rename, so a reader never sees a half-written file
+        # and processes that memory-mapped the old file keep a valid mapping.
+        # The part file is per process: every worker refreshes its artifacts on its own.
+        part_path = f"{local_path}.{os.getpid()}.part"
+        with open(part_path, "wb") as f:
+            downloader.readinto(f)
+        os.replace(part_path, local_path)
+        write_local_etag(local_path, downloader.properties.etag)
+        return True
+
+
+# Local filesystem stand-in for the blob store (tests, benchmarks, offline runs).
+# The "ETag" is derived from size and modification time.
+class LocalArtifactStore:
+    def __init__(self, directory=ARTIFACT_LOCAL_DIR):
+        self.directory = directory
+
+    def fetch(self, name, local_path):
+        source_path = os.path.join(self.directory, name)
+        if not os.path.exists(source_path):
+            raise FileNotFoundError(source_path)
+        stat = os.stat(source_path)
+        etag = f"{stat.st_size}-{stat.st_mtime_ns}"
+        if read_local_etag(local_path) == etag:
+            return False
+
+        part_path = f"{local_path}.{os.getpid()}.part"
+        with open(source_path, "rb") as src, open(part_path, "wb") as dst:
+            shutil.copyfileobj(src, dst, DOWNLOAD_CHUNK_BYTES)
+        os.replace(part_path, local_path)
+        write_local_etag(local_path, etag)
+        return True
+
+
+def create_artifact_store(container, kind=ARTIFACT_STORE):
+    if kind == "local":
+        return LocalArtifactStore()
+    return BlobArtifactStore(container)
+
+# Function to open a FAISS index memory-mapped, so startup does not scale with corpus size
+def load_faiss_index(path, mmap=True):
+    if mmap:
+        flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        try:
+            return faiss.read_index(path, flags)
+        except RuntimeError as e:
+            print("⚠️ Memory-mapped index load failed, reading it into memory:", e)
+    return faiss.read_index(path)
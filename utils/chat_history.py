@@ -0,0 +1,175 @@
+import os
+import re
+import hashlib
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+from utils.tokens import count_tokens_batch
+from utils.clients import get_openai_client
+from utils.logger import log_error
+from utils.metrics import traced, record_usage
+
+load_dotenv()
+
+# Chat history sent to the model each turn: the newest messages verbatim within a token budget,
+# everything older folded into a rolling summary. Older messages are summarized a segment at a
+# time and each summary is cached, so a conversation costs one summary call per segment, not per turn.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1500"))
+HISTORY_SEGMENT_MESSAGES = int(os.getenv("HISTORY_SEGMENT_MESSAGES", "6"))
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300"))
+HISTORY_SUMMARY_CACHE_SIZE = int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", "1024"))
+# Summary calls one turn may make; a longer unsummarized history (a re-seeded transcript) is caught up over later turns
+HISTORY_MAX_SUMMARY_SEGMENTS = int(os.getenv("HISTORY_MAX_SUMMARY_SEGMENTS", "4"))
+SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_DEPLOYMENT", os.getenv("DEPLOYMENT_NAME"))
+
+# A user turn that carries a built prompt ("...Context:\n<chunks>\n\nQuestion:\n<query>\n\nAnswer:")
+CONTEXT_BLOCK = re.compile(r"^.*?Context:\n.*?\n\nQuestion:\n(.*?)(?:\n\nAnswer:)?\s*$", re.DOTALL)
+# Reference tags appended to every reply ("... [1] [2] [3]")
+REFERENCE_TAGS = re.compile(r"(?:\s*\[\d+\])+\s*$")
+
+
+# Bounded LRU of rolling summaries, keyed by a hash of the messages they cover.
+# lookup/remember is the interface rolling_summary uses; a stored Conversation provides the same one.
+class SummaryCache:
+    def __init__(self, max_size=HISTORY_SUMMARY_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, summary):
+        with self.lock:
+            self.entries[key] = summary
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    # Function to find the cached summary of the longest segment-aligned prefix of messages[:boundary];
+    # returns (summary, messages covered)
+    def lookup(self, messages, boundary, segment):
+        keys = segment_keys(messages[:boundary], segment)
+        for b in sorted(keys, reverse=True):
+            cached = self.get(keys[b])
+            if cached is not None:
+                return cached, b
+        return None, 0
+
+    def remember(self, messages, covered, segment, summary):
+        key = segment_keys(messages[:covered], segment).get(covered)
+        if key is not None:
+            self.put(key, summary)
+
+summary_cache = SummaryCache()
+
+# Function to reduce a client message to role and content, without injected context or reference tags
+def clean_message(message):
+    role = message.get("role")
+    content = message.get("content") or ""
+    if role == "user":
+        match = CONTEXT_BLOCK.match(content)
+        if match:
+            content = match.group(1)
+    elif role == "assistant":
+        content = REFERENCE_TAGS.sub("", content)
+    return {"role": role, "content": content.strip()}
+
+# Function to clean the client history and drop the current question, which goes into the prompt itself
+def prepare_history(chat_history, query):
+    messages = [clean_message(m) for m in chat_history or [] if m.get("role") in ("user", "assistant") and m.get("content")]
+    if messages and messages[-1]["role"] == "user" and messages[-1]["content"] == query.strip():
+        messages.pop()
+    return messages
+
+# Function to hash every message prefix ending on a segment boundary: keys[b] covers messages[:b]
+def segment_keys(messages, segment):
+    digest = hashlib.sha1()
+    keys = {}
+    for i, message in enumerate(messages, start=1):
+        digest.update(f"{message['role']}\0{message['content']}\0".encode("utf-8"))
+        if i % segment == 0:
+            keys[i] = digest.hexdigest()
+    return keys
+
+# Function to fold one segment of messages into the running summary with the chat model
+@traced("history_summary")
+def summarize_segment(previous_summary, messages):
+    transcript = "\n".join(f"{m['role'].capitalize()}: {m['content']}" for m in messages)
+    prompt = (
+        "Update the summary of this conversation with the new messages. Keep the facts, figures, "
+        "names and open questions the assistant may need later; drop pleasantries.\n\n"
+        f"Summary so far:\n{previous_summary or '(none)'}\n\nNew messages:\n{transcript}\n\nUpdated summary:"
+    )
+    response = get_openai_client().chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0,
+        max_tokens=HISTORY_SUMMARY_MAX_TOKENS
+    )
+    record_usage("history_summary", SUMMARY_MODEL, response.usage)
+    return response.choices[0].message.content.strip()
+
+# Function to extend the cached summary that reaches furthest towards messages[:boundary] (or the
+# given resume point), a segment per call and at most max_segments calls; returns (summary, messages covered)
+def rolling_summary(messages, boundary, segment, summarize=summarize_segment, cache=None,
+                    max_segments=HISTORY_MAX_SUMMARY_SEGMENTS, resume=None):
+    cache = cache or summary_cache
+    summary, covered = resume if resume is not None else cache.lookup(messages, boundary, segment)
+    for _ in range(max_segments):
+        if covered >= boundary:
+            break
+        end = min(covered + segment, boundary)
+        summary = summarize(summary, messages[covered:end])
+        covered = end
+        cache.remember(messages, covered, segment, summary)
+    return summary, covered
+
+# Function to turn the client history into the messages sent with this turn: a summary of the
+# older turns (as a system message) followed by the newest turns that fit the token budget.
+# cache is a stored conversation, which keeps its own summary, or by default the shared summary_cache.
+def compact_history(chat_history, query, budget=HISTORY_TOKEN_BUDGET, segment=HISTORY_SEGMENT_MESSAGES,
+                    summarize=summarize_segment, cache=None):
+    cache = cache or summary_cache
+    messages = prepare_history(chat_history, query)
+    if not messages:
+        return []
+    counts = count_tokens_batch(m["content"] for m in messages)
+
+    # Resume from the summary already made for this history; segments are counted from where it
+    # ends, which after the store trimmed the head is no longer a multiple of the segment size
+    summary, covered = cache.lookup(messages, len(messages), segment)
+
+    # Summarize whole segments after it until the rest fits the budget
+    boundary = covered
+    tail_tokens = sum(counts[covered:])
+    while tail_tokens > budget and boundary + segment <= len(messages):
+        tail_tokens -= sum(counts[boundary:boundary + segment])
+        boundary += segment
+    # A tail still over budget (long replies) loses its oldest messages until it fits;
+    # they are folded into the summary once their segment completes
+    start = boundary
+    while tail_tokens > budget and start < len(messages):
+        tail_tokens -= counts[start]
+        start += 1
+    recent = messages[start:]
+
+    if boundary == 0:
+        return recent
+    try:
+        summary, covered = rolling_summary(messages, boundary, segment, summarize, cache, resume=(summary, covered))
+    except Exception as e:
+        # Without a summary the turn still goes out with the recent messages
+        log_error(str(e), context={"stage": "history_summary", "messages": boundary})
+        return recent
+    # When the per-turn cap stopped the summary short of the tail, the messages in between are
+    # left out of this turn and folded in by the next ones
+    recent = messages[max(start, covered):]
+    return [{"role": "system", "content": f"Summary of the earlier conversation:\n{summary}"}] + recent
@@ -0,0 +1,167 @@
+import os
+import json
+import struct
+import hashlib
+import numpy as np
+
+# Compact chunk store: one file holding a JSON header, per-chunk NumPy columns and the
+# concatenated UTF-8 text. Opened memory-mapped; only the rows a query uses are decoded.
+#
+#   magic (8 bytes) | header length (uint64) | header JSON | columns | text
+#
+# String fields (source, title, ...) are interned: the column holds an int32 id into a table
+# in the header (-1 = missing). Numeric fields are int64 (MISSING_INT = missing) or float64 (NaN).
+
+CHUNK_STORE_FILE_NAME = "chunks.bin"
+MAGIC = b"CHNKST01"
+ALIGNMENT = 64
+MISSING_INT = np.iinfo(np.int64).min
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+# Function to write chunk dicts (as produced by the embedder) to a chunk store file
+def write_chunk_store(path, chunks):
+    texts = [chunk["text"].encode("utf-8") for chunk in chunks]
+    offsets = np.zeros(len(chunks) + 1, dtype="<i8")
+    offsets[1:] = np.cumsum([len(text) for text in texts])
+
+    string_fields = {}
+    numeric_fields = {}
+    for name in dict.fromkeys(key for chunk in chunks for key in chunk if key != "text"):
+        values = [chunk.get(name) for chunk in chunks]
+        present = [value for value in values if value is not None]
+        if all(isinstance(value, str) for value in present):
+            table = list(dict.fromkeys(present))
+            ids = {value: i for i, value in enumerate(table)}
+            string_fields[name] = (table, np.array([ids[v] if v is not None else -1 for v in values], dtype="<i4"))
+        elif all(isinstance(value, (int, np.integer)) and not isinstance(value, bool) for value in present):
+            numeric_fields[name] = np.array([v if v is not None else MISSING_INT for v in values], dtype="<i8")
+        elif all(isinstance(value, (int, float, np.number)) for value in present):
+            numeric_fields[name] = np.array([v if v is not None else np.nan for v in values], dtype="<f8")
+        else:
+            raise ValueError(f"Unsupported chunk field type for '{name}'")
+
+    columns = {"offsets": offsets}
+    columns.update({name: ids for name, (_, ids) in string_fields.items()})
+    columns.update(numeric_fields)
+
+    # The header records column offsets relative to the start of the data section
+    layout = {}
+    position = 0
+    for name, column in columns.items():
+        position = _align(position)
+        layout[name] = {"dtype": column.dtype.str, "offset": position, "length": len(column)}
+        position += column.nbytes
+    text_offset = _align(position)
+
+    header = json.dumps({
+        "count": len(chunks),
+        "strings": {name: table for name, (table, _) in string_fields.items()},
+        "numeric": list(numeric_fields),
+        "columns": layout,
+        "text_offset": text_offset
+    }).encode("utf-8")
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    part_path = path + ".part"
+    with open(part_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, column in columns.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(column.tobytes())
+        f.seek(data_start + text_offset)
+        for text in texts:
+            f.write(text)
+    os.replace(part_path, path)
+
+# Function to fingerprint a build's corpus: the chunk store bytes (texts and metadata in id order) plus the
+# embedding model. Artifacts derived from the corpus record it, so they are never paired with another corpus.
+def corpus_fingerprint(path, model=None):
+    digest = hashlib.sha256(f"{model or ''}\n".encode("utf-8"))
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(4 * 1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+class ChunkStore:
+    def __init__(self, path):
+        self.path = path
+        self.buffer = np.memmap(path, dtype="uint8", mode="r")
+        if bytes(self.buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a chunk store")
+        header_length = struct.unpack("<Q", bytes(self.buffer[len(MAGIC):len(MAGIC) + 8]))[0]
+        header_start = len(MAGIC) + 8
+        header = json.loads(bytes(self.buffer[header_start:header_start + header_length]).decode("utf-8"))
+        data_start = _align(header_start + header_length)
+
+        self.count = header["count"]
+        self.string_tables = header["strings"]
+        self.numeric_fields = header["numeric"]
+        self.columns = {
+            name: np.frombuffer(self.buffer, dtype=spec["dtype"], count=spec["length"], offset=data_start + spec["offset"])
+            for name, spec in header["columns"].items()
+        }
+        self.offsets = self.columns["offsets"]
+        self.text_start = data_start + header["text_offset"]
+
+    def __len__(self):
+        return self.count
+
+    def text(self, i):
+        start = self.text_start + int(self.offsets[i])
+        end = self.text_start + int(self.offsets[i + 1])
+        return bytes(self.buffer[start:end]).decode("utf-8")
+
+    def field(self, name, i):
+        if name in self.string_tables:
+            value_id = int(self.columns[name][i])
+            return self.string_tables[name][value_id] if value_id >= 0 else None
+        value = self.columns[name][i]
+        if value.dtype.kind == "i":
+            return int(value) if value != MISSING_INT else None
+        return float(value) if not np.isnan(value) else None
+
+    # Function to decode one row into the chunk dict the rest of the app uses
+    def __getitem__(self, i):
+        i = int(i)
+        if i < 0 or i >= self.count:
+            raise IndexError(i)
+        chunk = {"text": self.text(i)}
+        for name in list(self.string_tables) + self.numeric_fields:
+            value = self.field(name, i)
+            if value is not None:
+                chunk[name] = value
+        chunk["chunk_id"] = i
+        return chunk
+
+    def __iter__(self):
+        return (self[i] for i in range(self.count))
+
+    # Interned ids of a string field for every chunk (e.g. to count documents without decoding rows),
+    # or None if no chunk has the field
+    def ids(self, name):
+        return self.columns.get(name) if name in self.string_tables else None
+
+    def numeric(self, name):
+        return self.columns.get(name) if name in self.numeric_fields else None
+
+    # Function to flag the chunks in [start, end) whose field equals one of the values, from the columns alone
+    def matching(self, name, values, start=0, end=None):
+        end = self.count if end is None else end
+        if name in self.string_tables:
+            table = self.string_tables[name]
+            value_ids = [table.index(value) for value in map(str, values) if value in table]
+            return np.isin(self.columns[name][start:end], value_ids)
+        if name in self.numeric_fields:
+            numbers = []
+            for value in values:
+                try:
+                    numbers.append(float(value))
+                except (TypeError, ValueError):
+                    pass
+            return np.isin(self.columns[name][start:end], numbers)
+        return np.zeros(end - start, dtype=bool)
@@ -2,66 +2,192 @@ import fitz  # PyMuPDF
 import os
 import json
 import re
-from io import BytesIO
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from statistics import median
 from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.storage.blob import ContentSettings
+import sys
+# Ensure the parent directory is in the path for imports
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.clients import get_blob_service_client
+from utils.tokens import count_tokens_batch
 
 # Load environment variables
 load_dotenv()
-conn_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 source_container = os.getenv("BLOB_CONTAINER_NAME")
-source_blob_name = os.getenv("BLOB_FILE_NAME")
+source_blob_name = os.getenv("BLOB_FILE_NAME")  # one PDF, or several separated by commas
+source_blob_prefix = os.getenv("BLOB_PREFIX")  # alternatively: every PDF under this prefix
 chunks_container = os.getenv("CHUNKS_CONTAINER_NAME")
 
+CHUNKER_WORKERS = int(os.getenv("CHUNKER_WORKERS", str(os.cpu_count() or 1)))
+PAGES_PER_TASK = int(os.getenv("CHUNKER_PAGES_PER_TASK", "8"))
+# A short block set this much larger than the page's body text counts as a section heading
+HEADING_SIZE_RATIO = 1.2
+HEADING_MAX_CHARS = 120
+
 def split_into_sentences(text):
     return re.split(r'(?<=[.!?]) +', text)
 
-def semantic_chunk_pdf_from_blob(max_tokens=500, overlap=1):
-    # Connect to blob and download PDF
-    blob_service_client = BlobServiceClient.from_connection_string(conn_str)
-    blob_client = blob_service_client.get_blob_client(container=source_container, blob=source_blob_name)
-    stream = blob_client.download_blob()
-    pdf_stream = BytesIO(stream.readall())
-
-    # Extract text from PDF
-    doc = fitz.open(stream=pdf_stream, filetype="pdf")
-    all_text = " ".join(page.get_text() for page in doc)
-
-    # Chunking logic
-    sentences = split_into_sentences(all_text)
-    chunks = []
-    current_chunk = []
+# Function to list the PDFs to chunk in this run; raises ValueError when the configuration names none
+def list_source_pdfs():
+    if source_blob_prefix:
+        container_client = get_blob_service_client().get_container_client(source_container)
+        names = [blob.name for blob in container_client.list_blobs(name_starts_with=source_blob_prefix) if blob.name.lower().endswith(".pdf")]
+        if not names:
+            raise ValueError(f"No PDFs found under BLOB_PREFIX '{source_blob_prefix}' in container '{source_container}'")
+        return names
+    names = [name.strip() for name in (source_blob_name or "").split(",") if name.strip()]
+    if not names:
+        raise ValueError("No source PDFs configured: set BLOB_FILE_NAME (comma-separated names) or BLOB_PREFIX")
+    return names
+
+# Function to name a document the way the chunks and references show it ("Consumer_Report.pdf" -> "Consumer Report")
+def source_name_for(blob_name):
+    return os.path.splitext(os.path.basename(blob_name))[0].replace("_", " ")
+
+# Function to find the report year: from the file name ("Consumer_Report_2024.pdf"), else the PDF creation date
+def document_year(blob_name, pdf_metadata):
+    match = re.search(r"(?<!\d)(?:19|20)\d{2}(?!\d)", os.path.basename(blob_name))
+    if match:
+        return int(match.group(0))
+    # PDF dates look like "D:20240115120000"
+    match = re.match(r"(?:D:)?((?:19|20)\d{2})", (pdf_metadata or {}).get("creationDate") or "")
+    return int(match.group(1)) if match else None
+
+# Function to stream a PDF blob to a local file without holding it in memory
+def download_pdf(blob_name, local_path):
+    blob_client = get_blob_service_client().get_blob_client(container=source_container, blob=blob_name)
+    with open(local_path, "wb") as f:
+        blob_client.download_blob().readinto(f)
+
+# Function to extract pages [start, end) as text blocks flagged as heading or body.
+# Runs in a worker process, which opens the file itself; only page text crosses the process boundary.
+def extract_pages(path, start, end):
+    pages = []
+    with fitz.open(path) as doc:
+        for page_number in range(start, end):
+            blocks = []
+            for block in doc[page_number].get_text("dict")["blocks"]:
+                spans = [span for line in block.get("lines", []) for span in line["spans"] if span["text"].strip()]
+                if spans:
+                    blocks.append((" ".join(" ".join(span["text"] for span in spans).split()), max(span["size"] for span in spans), len(block["lines"])))
+            body_size = median(size for _, size, _ in blocks) if blocks else 0
+            pages.append({
+                "page": page_number + 1,
+                "blocks": [
+                    (text, size >= body_size * HEADING_SIZE_RATIO and n_lines <= 2 and len(text) <= HEADING_MAX_CHARS and any(c.isalpha() for c in text))
+                    for text, size, n_lines in blocks
+                ]
+            })
+    return pages
+
+# Function to yield a PDF's pages in order, extracted in a process pool.
+# At most 2 * workers page ranges are in flight, so memory stays bounded for long reports.
+def iter_pages(path, workers=CHUNKER_WORKERS, pages_per_task=PAGES_PER_TASK):
+    with fitz.open(path) as doc:
+        page_count = doc.page_count
+    ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+    if workers <= 1:
+        for start, end in ranges:
+            yield from extract_pages(path, start, end)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for start, end in ranges:
+            in_flight.append(executor.submit(extract_pages, path, start, end))
+            if len(in_flight) >= 2 * workers:
+                yield from in_flight.popleft().result()
+        while in_flight:
+            yield from in_flight.popleft().result()
+
+# Function to group page text into overlapping chunks of at most max_tokens tokenizer tokens.
+# Yields chunk dicts with the pages they span, the section heading they start under and the report year.
+def iter_chunks(pages, source, toc=None, max_tokens=500, overlap=1, year=None):
+    toc_sections = {}
+    for _, title, page in toc or []:
+        toc_sections.setdefault(page, title)
+    section = None
+    current_chunk = []  # (sentence, token_count, page, section)
     current_length = 0
 
-    for sentence in sentences:
-        token_count = len(sentence.split())
-        if current_length + token_count > max_tokens:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = current_chunk[-overlap:]
-            current_length = sum(len(s.split()) for s in current_chunk)
-        current_chunk.append(sentence)
-        current_length += token_count
+    def make_chunk():
+        chunk = {
+            "text": " ".join(sentence for sentence, _, _, _ in current_chunk),
+            "source": source,
+            "page_start": current_chunk[0][2],
+            "page_end": current_chunk[-1][2]
+        }
+        if year is not None:
+            chunk["year"] = year
+        if current_chunk[0][3]:
+            chunk["section"] = current_chunk[0][3]
+        return chunk
+
+    for page in pages:
+        # The document outline, when there is one, is more reliable than font sizes
+        if toc_sections:
+            section = toc_sections.get(page["page"], section)
+        sentences = []
+        for text, is_heading in page["blocks"]:
+            if is_heading and not toc_sections:
+                section = text
+            sentences.extend((sentence, section) for sentence in split_into_sentences(text) if sentence)
+        token_counts = count_tokens_batch(sentence for sentence, _ in sentences)
+
+        for (sentence, sentence_section), token_count in zip(sentences, token_counts):
+            if current_length + token_count > max_tokens and current_chunk:
+                yield make_chunk()
+                current_chunk = current_chunk[-overlap:] if overlap else []
+                current_length = sum(count for _, count, _, _ in current_chunk)
+            current_chunk.append((sentence, token_count, page["page"], sentence_section))
+            current_length += token_count
 
     if current_chunk:
-        chunks.append(" ".join(current_chunk))
+        yield make_chunk()
 
-    return chunks
+# Function to chunk one PDF blob, yielding chunks as pages are extracted
+def semantic_chunk_pdf_from_blob(blob_name=None, max_tokens=500, overlap=1):
+    blob_name = blob_name or list_source_pdfs()[0]
+    fd, local_path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    try:
+        download_pdf(blob_name, local_path)
+        with fitz.open(local_path) as doc:
+            toc = doc.get_toc()
+            year = document_year(blob_name, doc.metadata)
+        yield from iter_chunks(iter_pages(local_path), source_name_for(blob_name), toc, max_tokens, overlap, year)
+    finally:
+        os.remove(local_path)
 
+# Function to write chunks to the chunks container as one JSON array, spooled through a temp file
 def upload_chunks_to_chunks_container(chunks, output_blob_name):
-    blob_service_client = BlobServiceClient.from_connection_string(conn_str)
-    blob_client = blob_service_client.get_blob_client(container=chunks_container, blob=output_blob_name)
+    count = 0
+    with tempfile.TemporaryFile("w+b") as f:
+        f.write(b"[\n")
+        for chunk in chunks:
+            if count:
+                f.write(b",\n")
+            f.write(json.dumps(chunk).encode("utf-8"))
+            count += 1
+        f.write(b"\n]")
+        f.seek(0)
+        blob_service_client = get_blob_service_client()
+        blob_client = blob_service_client.get_blob_client(container=chunks_container, blob=output_blob_name)
+        blob_client.upload_blob(
+            f,
+            overwrite=True,
+            content_settings=ContentSettings(content_type='application/json')
+        )
+    print(f"✅ Uploaded {count} chunks to blob: {chunks_container}/{output_blob_name}")
 
-    json_data = json.dumps(chunks, indent=2)
-    blob_client.upload_blob(
-        json_data,
-        overwrite=True,
-        content_settings=ContentSettings(content_type='application/json')
-    )
-    print(f"✅ Uploaded {len(chunks)} chunks to blob: {chunks_container}/{output_blob_name}")
+def iter_all_chunks(blob_names, max_tokens=500, overlap=1):
+    for blob_name in blob_names:
+        print(f"📄 Chunking {blob_name}")
+        yield from semantic_chunk_pdf_from_blob(blob_name, max_tokens, overlap)
 
 if __name__ == "__main__":
-    chunks = semantic_chunk_pdf_from_blob()
-    # Generate output blob name based on source PDF name
-    base_name = os.path.splitext(os.path.basename(source_blob_name))[0]
+    # All PDFs of the run go into one chunks file; each chunk records its own source and pages
     output_blob_name = "chunks.json"
-    upload_chunks_to_chunks_container(chunks, output_blob_name)
\ No newline at end of file
+    upload_chunks_to_chunks_container(iter_all_chunks(list_source_pdfs()), output_blob_name)
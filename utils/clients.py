@@ -0,0 +1,138 @@
+import os
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from openai import AzureOpenAI, AsyncAzureOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+from utils.metrics import upstream_responses, upstream_retries
+
+# Load environment variables
+load_dotenv()
+
+AZURE_OPENAI_API_VERSION = os.getenv("AZURE_OPENAI_API_VERSION", "2023-05-15")
+
+# Transport tuning shared by every client in the process
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "60"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY_SECONDS = float(os.getenv("HTTP_KEEPALIVE_EXPIRY_SECONDS", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+BLOB_MAX_RETRIES = int(os.getenv("BLOB_MAX_RETRIES", "3"))
+BLOB_RETRY_BACKOFF_SECONDS = float(os.getenv("BLOB_RETRY_BACKOFF_SECONDS", "0.8"))
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _httpx_limits():
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY_SECONDS
+    )
+
+def _httpx_timeout():
+    return httpx.Timeout(HTTP_READ_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS)
+
+# Event hooks counting every HTTP attempt to Azure OpenAI by status, and the SDK's retries
+# (it numbers attempts in the x-stainless-retry-count header)
+def _count_openai_request(request):
+    if request.headers.get("x-stainless-retry-count", "0") != "0":
+        upstream_retries.inc("openai")
+
+def _count_openai_response(response):
+    upstream_responses.inc("openai", str(response.status_code))
+
+async def _count_openai_request_async(request):
+    _count_openai_request(request)
+
+async def _count_openai_response_async(response):
+    _count_openai_response(response)
+
+def _count_blob_response(response, *args, **kwargs):
+    upstream_responses.inc("blob", str(response.status_code))
+
+def _create_openai_client():
+    return AzureOpenAI(
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=AZURE_OPENAI_API_VERSION,
+        max_retries=OPENAI_MAX_RETRIES,
+        timeout=_httpx_timeout(),
+        http_client=DefaultHttpxClient(
+            limits=_httpx_limits(),
+            timeout=_httpx_timeout(),
+            event_hooks={"request": [_count_openai_request], "response": [_count_openai_response]}
+        )
+    )
+
+def _create_async_openai_client():
+    return AsyncAzureOpenAI(
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=AZURE_OPENAI_API_VERSION,
+        max_retries=OPENAI_MAX_RETRIES,
+        timeout=_httpx_timeout(),
+        http_client=DefaultAsyncHttpxClient(
+            limits=_httpx_limits(),
+            timeout=_httpx_timeout(),
+            event_hooks={"request": [_count_openai_request_async], "response": [_count_openai_response_async]}
+        )
+    )
+
+def _create_blob_service_client():
+    # One pooled requests session so blob calls reuse TCP/TLS connections
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS, pool_maxsize=HTTP_MAX_CONNECTIONS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks["response"].append(_count_blob_response)
+    return BlobServiceClient.from_connection_string(
+        os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
+        transport=RequestsTransport(session=session, session_owner=False),
+        connection_timeout=HTTP_CONNECT_TIMEOUT_SECONDS,
+        read_timeout=HTTP_READ_TIMEOUT_SECONDS,
+        retry_total=BLOB_MAX_RETRIES,
+        retry_backoff_factor=BLOB_RETRY_BACKOFF_SECONDS
+    )
+
+_factories = {
+    "openai": _create_openai_client,
+    "async_openai": _create_async_openai_client,
+    "blob": _create_blob_service_client
+}
+
+# Function to return the shared client, creating it on first use
+def _get(name):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = _factories[name]()
+    return client
+
+def get_openai_client():
+    return _get("openai")
+
+def get_async_openai_client():
+    return _get("async_openai")
+
+def get_blob_service_client():
+    return _get("blob")
+
+# Function to swap in stand-in clients (e.g. pointed at local fake servers) for tests and benchmarks
+def override_clients(openai=None, async_openai=None, blob=None):
+    with _lock:
+        for name, client in (("openai", openai), ("async_openai", async_openai), ("blob", blob)):
+            if client is not None:
+                _clients[name] = client
+
+# Function to drop cached clients so the next call rebuilds them from the environment
+def reset_clients():
+    with _lock:
+        _clients.clear()
@@ -0,0 +1,206 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Server-side conversations, so a client sends only its new message with a conversation id.
+# A bounded in-process LRU, written through to an optional SQLite file that several gunicorn
+# workers can share. Without it a worker that does not know an id answers "conversation not
+# found" and the client re-sends the whole transcript once.
+CONVERSATION_STORE_SIZE = int(os.getenv("CONVERSATION_STORE_SIZE", "1024"))
+CONVERSATION_TTL_SECONDS = float(os.getenv("CONVERSATION_TTL_SECONDS", str(7 * 24 * 3600)))
+CONVERSATION_DB_PATH = os.getenv("CONVERSATION_DB_PATH")  # optional: enables the SQLite backend
+CONVERSATION_MAX_MESSAGES = int(os.getenv("CONVERSATION_MAX_MESSAGES", "500"))
+
+# Function to fingerprint a run of messages by role and content
+def messages_key(messages):
+    digest = hashlib.sha1()
+    for message in messages:
+        digest.update(f"{message['role']}\0{message['content']}\0".encode("utf-8"))
+    return digest.hexdigest()
+
+# Function to keep the fields of a client message the server needs
+def stored_message(message):
+    stored = {"role": message.get("role"), "content": message.get("content") or ""}
+    if message.get("references"):
+        stored["references"] = message["references"]
+    return stored
+
+
+class Conversation:
+    def __init__(self, conversation_id, messages=None, summary_key=None, summary=None, updated=None, store=None, summary_count=0):
+        self.id = conversation_id
+        self.messages = messages or []
+        self.summary_key = summary_key
+        self.summary = summary
+        self.summary_count = summary_count or 0
+        self.updated = updated or time.time()
+        self.store = store
+
+    # Summary cache interface used by utils.chat_history (lookup/remember). The conversation keeps its newest
+    # rolling summary, anchored on the key of the last segment it covers rather than on the whole prefix,
+    # so trimming the head or re-seeding the same transcript only moves the anchor left and the summary
+    # is still extended instead of rebuilt
+    def lookup(self, messages, boundary, segment):
+        if self.summary is None:
+            return None, 0
+        for covered in range(min(self.summary_count, len(messages)), 0, -1):
+            if messages_key(messages[max(0, covered - segment):covered]) == self.summary_key:
+                return self.summary, covered
+        return None, 0
+
+    def remember(self, messages, covered, segment, summary):
+        self.summary_key = messages_key(messages[max(0, covered - segment):covered])
+        self.summary = summary
+        self.summary_count = covered
+        if self.store is not None:
+            self.store.save_summary(self)
+
+
+# SQLite backend: one row per conversation, one per message, so a turn appends instead of rewriting
+class SqliteConversationBackend:
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS conversations (id TEXT PRIMARY KEY, updated REAL, summary_key TEXT, summary TEXT)")
+        if "summary_count" not in [column[1] for column in self.db.execute("PRAGMA table_info(conversations)")]:
+            self.db.execute("ALTER TABLE conversations ADD COLUMN summary_count INTEGER")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (conversation_id TEXT, seq INTEGER, message TEXT, PRIMARY KEY (conversation_id, seq))")
+        self.db.commit()
+        self.lock = threading.Lock()
+
+    def load(self, conversation_id):
+        with self.lock:
+            row = self.db.execute("SELECT updated, summary_key, summary, summary_count FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+            if row is None:
+                return None
+            messages = [json.loads(m) for (m,) in self.db.execute("SELECT message FROM messages WHERE conversation_id = ? ORDER BY seq", (conversation_id,))]
+        return Conversation(conversation_id, messages, row[1], row[2], row[0], summary_count=row[3])
+
+    def updated(self, conversation_id):
+        with self.lock:
+            row = self.db.execute("SELECT updated FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return row[0] if row else None
+
+    def replace(self, conversation):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO conversations (id, updated, summary_key, summary, summary_count) VALUES (?, ?, ?, ?, ?)",
+                (conversation.id, conversation.updated, conversation.summary_key, conversation.summary, conversation.summary_count)
+            )
+            self.db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation.id,))
+            self.db.executemany("INSERT INTO messages VALUES (?, ?, ?)", [(conversation.id, seq, json.dumps(m)) for seq, m in enumerate(conversation.messages)])
+
+    # Function to write the last len(messages) messages of the conversation in one transaction
+    def append(self, conversation, messages):
+        first_seq = len(conversation.messages) - len(messages)
+        with self.lock, self.db:
+            self.db.execute("UPDATE conversations SET updated = ? WHERE id = ?", (conversation.updated, conversation.id))
+            self.db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?)", [(conversation.id, first_seq + i, json.dumps(m)) for i, m in enumerate(messages)])
+
+    def save_summary(self, conversation):
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE conversations SET summary_key = ?, summary = ?, summary_count = ? WHERE id = ?",
+                (conversation.summary_key, conversation.summary, conversation.summary_count, conversation.id)
+            )
+
+    def delete_expired(self, before):
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM messages WHERE conversation_id IN (SELECT id FROM conversations WHERE updated < ?)", (before,))
+            self.db.execute("DELETE FROM conversations WHERE updated < ?", (before,))
+
+
+class ConversationStore:
+    def __init__(self, max_size=CONVERSATION_STORE_SIZE, ttl=CONVERSATION_TTL_SECONDS, db_path=CONVERSATION_DB_PATH,
+                 max_messages=CONVERSATION_MAX_MESSAGES):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_messages = max_messages
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.backend = SqliteConversationBackend(db_path) if db_path else None
+        if self.backend is not None:
+            self.backend.delete_expired(time.time() - ttl)
+
+    # Function to look a conversation up by id, from memory or the backend; None if unknown or expired
+    def get(self, conversation_id):
+        if not conversation_id:
+            return None
+        with self.lock:
+            conversation = self.entries.get(conversation_id)
+            if conversation is not None and time.time() - conversation.updated > self.ttl:
+                del self.entries[conversation_id]
+                conversation = None
+            if conversation is not None:
+                self.entries.move_to_end(conversation_id)
+        if self.backend is None:
+            return conversation
+
+        try:
+            # Another worker sharing the backend may have added turns since this copy was cached
+            if conversation is not None and self.backend.updated(conversation_id) == conversation.updated:
+                return conversation
+            conversation = self.backend.load(conversation_id)
+        except Exception as e:
+            print("⚠️ Conversation store read failed:", e)
+            return conversation
+        if conversation is None or time.time() - conversation.updated > self.ttl:
+            return None
+        conversation.store = self
+        with self.lock:
+            self._remember(conversation)
+        return conversation
+
+    # Function to store a full transcript sent by the client, under its conversation id when the
+    # store knows it, else as a new conversation (ids are always issued by the server)
+    def replace(self, conversation_id, messages):
+        conversation = self.get(conversation_id) or Conversation(uuid.uuid4().hex, store=self)
+        conversation.messages = [stored_message(m) for m in messages][-self.max_messages:]
+        conversation.updated = time.time()
+        with self.lock:
+            self._remember(conversation)
+        self._write(self.backend.replace if self.backend else None, conversation)
+        return conversation
+
+    # Function to add messages to a conversation together (a user turn and its reply)
+    def append(self, conversation, *messages):
+        added = [stored_message(message) for message in messages]
+        conversation.messages.extend(added)
+        conversation.updated = time.time()
+        if len(conversation.messages) > self.max_messages:
+            # Trimming the head renumbers the stored rows, so rewrite them
+            conversation.messages = conversation.messages[-self.max_messages:]
+            self._write(self.backend.replace if self.backend else None, conversation)
+            return
+        self._write(self.backend.append if self.backend else None, conversation, added)
+
+    def save_summary(self, conversation):
+        self._write(self.backend.save_summary if self.backend else None, conversation)
+
+    def _write(self, operation, *args):
+        if operation is None:
+            return
+        try:
+            operation(*args)
+        except Exception as e:
+            print("⚠️ Conversation store write failed:", e)
+
+    def _remember(self, conversation):
+        self.entries[conversation.id] = conversation
+        self.entries.move_to_end(conversation.id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "max_size": self.max_size, "backend": "sqlite" if self.backend else None}
+
+conversation_store = ConversationStore()
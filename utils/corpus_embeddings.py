@@ -0,0 +1,115 @@
+import os
+import time
+import random
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import openai
+import numpy as np
+
+# Chunk embeddings from the last build, keyed by content hash, so a re-run only embeds changed chunks
+EMBEDDINGS_FILE_NAME = "embeddings.npz"
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "4"))  # embedding requests in flight at once
+EMBED_MAX_ATTEMPTS = int(os.getenv("EMBED_MAX_ATTEMPTS", "8"))
+EMBED_BACKOFF_SECONDS = float(os.getenv("EMBED_BACKOFF_SECONDS", "1"))
+EMBED_MAX_BACKOFF_SECONDS = float(os.getenv("EMBED_MAX_BACKOFF_SECONDS", "60"))
+
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+# Function to load the stored vectors as {hash: row} plus the matrix, or empty if missing or built with another model
+def load_embedding_store(path, model):
+    if not path or not os.path.exists(path):
+        return {}, None
+    try:
+        with np.load(path) as data:
+            if str(data["model"]) != model:
+                print(f"⚠️ Stored embeddings were built with '{data['model']}', re-embedding everything")
+                return {}, None
+            hashes = data["hashes"].astype(str)
+            vectors = data["vectors"]
+    except Exception as e:
+        print("⚠️ Failed to load stored embeddings:", e)
+        return {}, None
+    return {h: i for i, h in enumerate(hashes)}, vectors
+
+def save_embedding_store(path, hashes, vectors, model):
+    with open(path, "wb") as f:
+        np.savez(f, hashes=np.array(hashes, dtype="S64"), vectors=vectors.astype("float32"), model=np.array(model))
+
+# Seconds to wait before retrying: the server's Retry-After when it sends one, else capped exponential backoff with jitter
+def retry_delay(error, attempt):
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    try:
+        if headers.get("retry-after-ms") is not None:
+            return min(float(headers["retry-after-ms"]) / 1000, EMBED_MAX_BACKOFF_SECONDS)
+        if headers.get("retry-after") is not None:
+            return min(float(headers["retry-after"]), EMBED_MAX_BACKOFF_SECONDS)
+    except ValueError:
+        pass
+    return min(EMBED_BACKOFF_SECONDS * 2 ** attempt, EMBED_MAX_BACKOFF_SECONDS) * (0.5 + random.random() / 2)
+
+# Function to embed one batch, retrying throttled and transient failures
+def embed_batch(client, texts, model):
+    for attempt in range(EMBED_MAX_ATTEMPTS):
+        try:
+            response = client.embeddings.create(input=texts, model=model)
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except RETRYABLE_ERRORS as e:
+            if attempt == EMBED_MAX_ATTEMPTS - 1:
+                raise
+            delay = retry_delay(e, attempt)
+            print(f"⏳ Embedding batch failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+# Function to embed the chunk texts, reusing stored vectors for unchanged chunks.
+# Batches run concurrently (at most EMBED_CONCURRENCY in flight) and each result is written
+# straight into its rows of one preallocated float32 array. Returns (vectors, hashes, n_embedded).
+def embed_texts_incremental(client, texts, model, stored_rows=None, stored_vectors=None,
+                            batch_size=EMBED_BATCH_SIZE, concurrency=EMBED_CONCURRENCY):
+    stored_rows = stored_rows or {}
+    hashes = [content_hash(text) for text in texts]
+
+    # Identical chunks share one request; rows_for maps each new hash to every row holding it
+    rows_for = {}
+    for row, h in enumerate(hashes):
+        if h not in stored_rows:
+            rows_for.setdefault(h, []).append(row)
+    pending = list(rows_for)
+    batches = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+
+    # The client's own retries are disabled so embed_batch owns the backoff
+    client = client.with_options(max_retries=0)
+
+    def run(batch):
+        return batch, embed_batch(client, [texts[rows_for[h][0]] for h in batch], model)
+
+    if stored_vectors is not None:
+        dimension = stored_vectors.shape[1]
+        first = []
+    elif batches:
+        # Nothing stored yet: the first batch tells us the embedding dimension
+        first = [run(batches.pop(0))]
+        dimension = len(first[0][1][0])
+    else:
+        raise ValueError("No chunks to embed")
+
+    vectors = np.empty((len(texts), dimension), dtype="float32")
+    for row, h in enumerate(hashes):
+        if h in stored_rows:
+            vectors[row] = stored_vectors[stored_rows[h]]
+
+    def fill(batch, embeddings):
+        for h, embedding in zip(batch, embeddings):
+            vectors[rows_for[h]] = embedding
+
+    for batch, embeddings in first:
+        fill(batch, embeddings)
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for batch, embeddings in executor.map(run, batches):
+            fill(batch, embeddings)
+
+    return vectors, hashes, len(pending)
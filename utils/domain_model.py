@@ -0,0 +1,71 @@
+import os
+import numpy as np
+import faiss
+
+DOMAIN_MODEL_FILE_NAME = "domain_model.npz"
+MAX_DOMAIN_CLUSTERS = int(os.getenv("DOMAIN_MAX_CLUSTERS", "16"))
+DOMAIN_THRESHOLD = float(os.getenv("DOMAIN_THRESHOLD", "0.55"))  # queries less similar than this to every centroid are out of domain
+
+# Function to L2-normalize each row, leaving zero rows untouched
+def normalize_rows(vectors):
+    vectors = np.asarray(vectors, dtype="float32")
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+# Function to build the domain model from the corpus vectors.
+# One normalized centroid for a single document, k-means centroids (one per document, capped) otherwise.
+def build_domain_centroids(vectors, sources=None, max_clusters=MAX_DOMAIN_CLUSTERS):
+    vectors = normalize_rows(vectors)
+    n_docs = len(np.unique(np.asarray(sources))) if sources is not None and len(sources) else 1
+    n_clusters = max(1, min(n_docs, max_clusters, len(vectors)))
+
+    if n_clusters == 1:
+        centroids = vectors.mean(axis=0, keepdims=True)
+    else:
+        kmeans = faiss.Kmeans(vectors.shape[1], n_clusters, niter=20, seed=1234, verbose=False)
+        kmeans.train(vectors)
+        centroids = kmeans.centroids
+
+    return normalize_rows(centroids)
+
+# Function to build the domain model straight from a FAISS index (one reconstruct, at load time only)
+def build_domain_centroids_from_index(index, sources=None, max_clusters=MAX_DOMAIN_CLUSTERS):
+    vectors = index.reconstruct_n(0, index.ntotal)
+    return build_domain_centroids(vectors, sources, max_clusters=max_clusters)
+
+# fingerprint identifies the corpus the centroids were built from (see utils.chunk_store.corpus_fingerprint)
+def save_domain_model(path, centroids, ntotal, fingerprint=None):
+    with open(path, "wb") as f:
+        np.savez(f, centroids=centroids.astype("float32"), ntotal=np.int64(ntotal), fingerprint=np.str_(fingerprint or ""))
+
+# Function to load a persisted domain model, or None if missing or built for a different index.
+# With a fingerprint, a model built from another corpus is stale even when the sizes match.
+def load_domain_model(path, index, fingerprint=None):
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            centroids = data["centroids"].astype("float32")
+            ntotal = int(data["ntotal"])
+            stored_fingerprint = str(data["fingerprint"]) if "fingerprint" in data else ""
+    except Exception as e:
+        print("⚠️ Failed to load domain model:", e)
+        return None
+    if fingerprint is not None and stored_fingerprint != fingerprint:
+        return None
+    if ntotal != index.ntotal or centroids.ndim != 2 or centroids.shape[1] != index.d:
+        return None
+    return centroids
+
+# Function to load the persisted domain model, rebuilding and saving it when stale
+def load_or_build_domain_model(path, index, sources=None, fingerprint=None):
+    centroids = load_domain_model(path, index, fingerprint)
+    if centroids is None:
+        centroids = build_domain_centroids_from_index(index, sources)
+        save_domain_model(path, centroids, index.ntotal, fingerprint)
+    return centroids
+
+# Function to score a normalized query vector against the domain centroids
+def domain_similarity(query_vec, centroids):
+    return float(np.max(centroids @ np.asarray(query_vec, dtype="float32").reshape(-1)))
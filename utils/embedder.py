@@ -1,69 +1,155 @@
 import os
 import json
-from openai import AzureOpenAI
 import faiss
 import numpy as np
 from dotenv import load_dotenv
-from azure.storage.blob import BlobServiceClient, ContentSettings
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import ContentSettings
 from io import BytesIO
+import sys
+# Ensure the parent directory is in the path for imports
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.domain_model import DOMAIN_MODEL_FILE_NAME, build_domain_centroids, save_domain_model
+from utils.tokens import count_tokens_batch
+from utils.clients import get_openai_client, get_blob_service_client
+from utils.chunk_store import CHUNK_STORE_FILE_NAME, write_chunk_store, corpus_fingerprint
+from utils.ann_index import build_index
+from utils.shards import (
+    SHARD_MANIFEST_FILE_NAME, GENERATIONS_PREFIX, LEGACY_SHARDS_PREFIX, group_chunks_by_shard, shard_entry,
+    save_shard_manifest, manifest_blob_names, new_generation_id, generation_blob_name
+)
+from utils.lexical_index import LEXICAL_INDEX_FILE_NAME, build_lexical_index
+from utils.corpus_embeddings import EMBEDDINGS_FILE_NAME, load_embedding_store, save_embedding_store, embed_texts_incremental
+from utils.artifacts import create_artifact_store
 
 # Load environment variables
 load_dotenv()
-conn_str = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 chunks_container = os.getenv("CHUNKS_CONTAINER_NAME")
 chunks_blob_name = os.getenv("CHUNKS_BLOB_NAME")
 embeddings_container = os.getenv("EMBEDDINGS_CONTAINER_NAME")
 deployment_name = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
 
 # Initialize Azure Blob client
-blob_service_client = BlobServiceClient.from_connection_string(conn_str)
+blob_service_client = get_blob_service_client()
 
 # Download chunked JSON from blob
 chunks_blob_client = blob_service_client.get_blob_client(container=chunks_container, blob=chunks_blob_name)
 chunks_data = json.loads(chunks_blob_client.download_blob().readall())
 
-# Wrap each chunk with metadata
+# Wrap each chunk with metadata (the chunker writes dicts with source, pages and section; older files hold plain strings)
 source_name = os.path.splitext(os.path.basename(chunks_blob_name))[0].replace("_", " ")
-chunks = [{"text": chunk, "source": source_name} for chunk in chunks_data]
+chunks = [chunk if isinstance(chunk, dict) else {"text": chunk, "source": source_name} for chunk in chunks_data]
+
+# Store each chunk's token count so the retriever never re-tokenizes chunks per request
+for chunk, token_count in zip(chunks, count_tokens_batch(chunk["text"] for chunk in chunks)):
+    chunk["token_count"] = token_count
 
-# Initialize Azure OpenAI client
-client = AzureOpenAI(
-    azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-    api_version="2023-05-15"
+# Vectors from the previous build, keyed by chunk content hash (missing on the first run)
+embeddings_local_path = EMBEDDINGS_FILE_NAME
+try:
+    create_artifact_store(embeddings_container).fetch(EMBEDDINGS_FILE_NAME, embeddings_local_path)
+except FileNotFoundError:
+    print("ℹ️ No stored embeddings found, embedding the full corpus")
+stored_rows, stored_vectors = load_embedding_store(embeddings_local_path, deployment_name)
+
+# Embed only new or changed chunks, concurrently, straight into one float32 array
+embeddings, chunk_hashes, n_embedded = embed_texts_incremental(
+    get_openai_client(),
+    [chunk["text"] for chunk in chunks],
+    deployment_name,
+    stored_rows,
+    stored_vectors
 )
+print(f"🧮 Embedded {n_embedded} new chunk texts, reused {sum(h in stored_rows for h in chunk_hashes)} stored vectors")
+
+# Upload the updated vector store so the next run can reuse it
+save_embedding_store(embeddings_local_path, chunk_hashes, embeddings, deployment_name)
+with open(embeddings_local_path, "rb") as f:
+    embeddings_blob_client = blob_service_client.get_blob_client(container=embeddings_container, blob=EMBEDDINGS_FILE_NAME)
+    embeddings_blob_client.upload_blob(f, overwrite=True, content_settings=ContentSettings(content_type='application/octet-stream'))
+
+# Group chunks into index shards (SHARD_BY: document, year or none); each shard is a contiguous id range
+order, shard_groups = group_chunks_by_shard(chunks)
+chunks = [chunks[i] for i in order]
+embeddings = embeddings[order]
+
+# This build's files go under their own generation prefix, so the files a retriever is reading are never overwritten
+generation = new_generation_id()
+embeddings_container_client = blob_service_client.get_container_client(embeddings_container)
+
+# Build one FAISS index per shard (type from INDEX_TYPE: auto, flat, hnsw, ivfpq or l2) and upload it
+shard_entries = []
+for shard_name, start, end in shard_groups:
+    shard_index, shard_meta = build_index(embeddings[start:end])
+    entry = shard_entry(shard_name, start, end, chunks[start:end], shard_meta, generation)
+    print(f"🧭 Built {shard_meta['type']} shard '{shard_name}' ({shard_meta['factory']}, {shard_meta['metric']}) over {shard_index.ntotal} vectors")
+    faiss_index_path = "shard.faiss"
+    faiss.write_index(shard_index, faiss_index_path)
+    with open(faiss_index_path, "rb") as f:
+        index_blob_client = blob_service_client.get_blob_client(container=embeddings_container, blob=entry["index"])
+        index_blob_client.upload_blob(f, overwrite=True, content_settings=ContentSettings(content_type='application/octet-stream'))
+    os.remove(faiss_index_path)
+    shard_entries.append(entry)
+
+# The chunk store, lexical index and domain model of this build, by blob name, for the manifest
+artifacts = {
+    "chunk_store": generation_blob_name(generation, CHUNK_STORE_FILE_NAME),
+    "lexical_index": generation_blob_name(generation, LEXICAL_INDEX_FILE_NAME),
+    "domain_model": generation_blob_name(generation, DOMAIN_MODEL_FILE_NAME)
+}
+
+# Write chunk text and metadata to the compact chunk store and upload it next to the index
+write_chunk_store(CHUNK_STORE_FILE_NAME, chunks)
+fingerprint = corpus_fingerprint(CHUNK_STORE_FILE_NAME, deployment_name)
+with open(CHUNK_STORE_FILE_NAME, "rb") as f:
+    chunk_store_blob_client = blob_service_client.get_blob_client(container=embeddings_container, blob=artifacts["chunk_store"])
+    chunk_store_blob_client.upload_blob(f, overwrite=True, content_settings=ContentSettings(content_type='application/octet-stream'))
+
+# Build the BM25 inverted index (postings arrays) over the same chunk ids and upload it next to the index
+lexical_index = build_lexical_index((chunk["text"] for chunk in chunks), fingerprint)
+lexical_index.save(LEXICAL_INDEX_FILE_NAME)
+with open(LEXICAL_INDEX_FILE_NAME, "rb") as f:
+    lexical_blob_client = blob_service_client.get_blob_client(container=embeddings_container, blob=artifacts["lexical_index"])
+    lexical_blob_client.upload_blob(f, overwrite=True, content_settings=ContentSettings(content_type='application/octet-stream'))
+
+# Build the domain model (corpus centroids) once and upload it next to the index
+domain_model_path = DOMAIN_MODEL_FILE_NAME
+domain_centroids = build_domain_centroids(embeddings, [chunk["source"] for chunk in chunks])
+save_domain_model(domain_model_path, domain_centroids, len(embeddings), fingerprint)
+with open(domain_model_path, "rb") as f:
+    domain_blob_client = blob_service_client.get_blob_client(container=embeddings_container, blob=artifacts["domain_model"])
+    domain_blob_client.upload_blob(f, overwrite=True, content_settings=ContentSettings(content_type='application/octet-stream'))
+
+# Upload the shard manifest last: it is the only file with a fixed name, so the retriever switches over
+# only once every file it lists is in place
+manifest_blob_client = blob_service_client.get_blob_client(container=embeddings_container, blob=SHARD_MANIFEST_FILE_NAME)
+try:
+    previous_manifest = json.loads(manifest_blob_client.download_blob().readall())
+except ResourceNotFoundError:
+    previous_manifest = None
+manifest = save_shard_manifest(SHARD_MANIFEST_FILE_NAME, shard_entries, generation, artifacts, fingerprint)
+with open(SHARD_MANIFEST_FILE_NAME, "rb") as f:
+    manifest_blob_client.upload_blob(f, overwrite=True, content_settings=ContentSettings(content_type='application/json'))
+
+# Delete the files of older builds (and shards of documents no longer in the corpus). The previous
+# build's files stay until the next run, for retrievers that are still syncing it.
+keep = manifest_blob_names(manifest) | manifest_blob_names(previous_manifest)
+pruned = 0
+for prefix in (GENERATIONS_PREFIX, LEGACY_SHARDS_PREFIX):
+    for blob in embeddings_container_client.list_blobs(name_starts_with=prefix):
+        if blob.name not in keep:
+            embeddings_container_client.delete_blob(blob.name)
+            pruned += 1
+if pruned:
+    print(f"🧹 Deleted {pruned} files of older index builds")
+
+# Clean up local manifest, chunk store, lexical index and domain model files
+os.remove(SHARD_MANIFEST_FILE_NAME)
+os.remove(CHUNK_STORE_FILE_NAME)
+os.remove(LEXICAL_INDEX_FILE_NAME)
+os.remove(domain_model_path)
+os.remove(embeddings_local_path)
+if os.path.exists(embeddings_local_path + ".etag"):
+    os.remove(embeddings_local_path + ".etag")
 
-# Embed the chunks in batches
-embeddings = []
-batch_size = 10
-for i in range(0, len(chunks), batch_size):
-    batch = chunks[i:i + batch_size]
-    response = client.embeddings.create(
-        input=[item["text"] for item in batch],
-        model=deployment_name
-    )
-    batch_embeddings = [item.embedding for item in response.data]
-    embeddings.extend(batch_embeddings)
-
-# Convert to FAISS index
-dimension = len(embeddings[0])
-index = faiss.IndexFlatL2(dimension)
-index.add(np.array(embeddings).astype("float32"))
-
-# Serialize FAISS index
-faiss_index_path = "index.faiss"
-faiss.write_index(index, faiss_index_path)
-
-# Upload FAISS index to embeddings container
-with open(faiss_index_path, "rb") as f:
-    index_blob_client = blob_service_client.get_blob_client(container=embeddings_container, blob="index.faiss")
-    index_blob_client.upload_blob(f, overwrite=True, content_settings=ContentSettings(content_type='application/octet-stream'))
-
-# Upload enriched metadata to embeddings container
-metadata_blob_client = blob_service_client.get_blob_client(container=embeddings_container, blob="metadata.json")
-metadata_blob_client.upload_blob(json.dumps(chunks, indent=2), overwrite=True, content_settings=ContentSettings(content_type='application/json'))
-
-# Clean up local FAISS file
-os.remove(faiss_index_path)
-
-print("✅ Embeddings and enriched metadata uploaded to 'embeddings' container.")
\ No newline at end of file
+print(f"✅ Generation {generation}: {len(shard_entries)} index shards, chunk store, lexical index and domain model uploaded to 'embeddings' container.")
\ No newline at end of file
@@ -0,0 +1,199 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))
+EMBED_CACHE_TTL_SECONDS = float(os.getenv("EMBED_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+EMBED_CACHE_DIR = os.getenv("EMBED_CACHE_DIR")  # optional: enables the on-disk store shared by workers
+EMBED_CACHE_DISK_SIZE = int(os.getenv("EMBED_CACHE_DISK_SIZE", "50000"))
+
+# Function to normalize query text so trivial variations share a cache entry
+def normalize_text(text):
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+def make_key(text, deployment):
+    return hashlib.sha1(f"{deployment}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+# On-disk store: a memory-mapped float32 ring buffer of vectors plus a SQLite key index.
+# SQLite handles locking, so several gunicorn workers can share one store. The meta table records the
+# layout (dim, capacity) and an epoch that changes whenever the store is rebuilt.
+class DiskEmbeddingStore:
+    def __init__(self, directory, capacity=EMBED_CACHE_DISK_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.capacity = capacity
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.db = sqlite3.connect(os.path.join(directory, "keys.sqlite"), timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, slot INTEGER UNIQUE, created REAL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER)")
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.epoch = None
+
+    def _meta(self, name):
+        row = self.db.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def _layout_matches(self, dim):
+        if (self._meta("dim"), self._meta("capacity")) != (dim, self.capacity):
+            return False
+        try:
+            return os.path.getsize(self.vectors_path) == self.capacity * dim * 4
+        except FileNotFoundError:
+            return False
+
+    # Function to map the vectors file for vectors of this dim. A store laid out for another dim or
+    # capacity (EMBED_CACHE_DISK_SIZE changed) is rebuilt empty when rebuild is set; returns True when mapped
+    def _open_vectors(self, dim, rebuild=True):
+        epoch = self._meta("epoch")
+        if self.vectors is not None and self.epoch == epoch and self.vectors.shape[1] == dim:
+            return True
+        self.vectors = None
+        if not self._layout_matches(dim):
+            if not rebuild:
+                return False
+            epoch = self._rebuild(dim)
+        self.vectors = np.memmap(self.vectors_path, dtype="float32", mode="r+", shape=(self.capacity, dim))
+        self.epoch = epoch
+        return True
+
+    # Function to start an empty store for this dim and capacity. The new file replaces the old one by
+    # rename, so a process still mapping the old file keeps a valid mapping until it sees the new epoch.
+    def _rebuild(self, dim):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            # Another worker may have rebuilt it for the same layout meanwhile
+            if self._layout_matches(dim):
+                return self._meta("epoch")
+            if self._meta("dim") is not None:
+                print(f"⚠️ Embedding disk cache was laid out for dim {self._meta('dim')} and capacity {self._meta('capacity')}; "
+                      f"rebuilding it empty for dim {dim} and capacity {self.capacity}")
+            part_path = f"{self.vectors_path}.{os.getpid()}.part"
+            with open(part_path, "wb") as f:
+                f.truncate(self.capacity * dim * 4)
+            os.replace(part_path, self.vectors_path)
+            epoch = (self._meta("epoch") or 0) + 1
+            self.db.execute("DELETE FROM entries")
+            self.db.executemany(
+                "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [("dim", dim), ("capacity", self.capacity), ("next_slot", 0), ("epoch", epoch)]
+            )
+        return epoch
+
+    def get(self, key, ttl):
+        with self.lock:
+            row = self.db.execute("SELECT slot, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > ttl:
+                return None
+            dim = self._meta("dim")
+            if dim is None or not self._open_vectors(dim, rebuild=False):
+                return None
+            return np.array(self.vectors[row[0]])
+
+    def put(self, key, vec):
+        with self.lock:
+            self._open_vectors(vec.shape[0])
+            with self.db:
+                self.db.execute("BEGIN IMMEDIATE")
+                if self._meta("epoch") != self.epoch:
+                    # Rebuilt by another worker since it was mapped; the next call maps the new file
+                    self.vectors = None
+                    return
+                existing = self.db.execute("SELECT slot FROM entries WHERE key = ?", (key,)).fetchone()
+                if existing is not None:
+                    slot = existing[0]
+                else:
+                    slot = self._meta("next_slot")
+                    self.db.execute("UPDATE meta SET value = ? WHERE name = 'next_slot'", ((slot + 1) % self.capacity,))
+                    # Oldest entry in the ring is overwritten
+                    self.db.execute("DELETE FROM entries WHERE slot = ?", (slot,))
+                self.vectors[slot] = vec
+                self.vectors.flush()
+                self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, slot, time.time()))
+
+
+# Bounded in-process LRU of query embeddings with TTL, backed by an optional disk store
+class EmbeddingCache:
+    def __init__(self, max_size=EMBED_CACHE_SIZE, ttl=EMBED_CACHE_TTL_SECONDS, disk_dir=EMBED_CACHE_DIR):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk = DiskEmbeddingStore(disk_dir) if disk_dir else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, text, deployment):
+        key = make_key(text, deployment)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                vec, created = entry
+                if time.time() - created <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return vec
+                del self.entries[key]
+                self.expirations += 1
+
+        if self.disk is not None:
+            try:
+                vec = self.disk.get(key, self.ttl)
+            except Exception as e:
+                print("⚠️ Embedding disk cache read failed:", e)
+                vec = None
+            if vec is not None:
+                with self.lock:
+                    self.disk_hits += 1
+                    self._store(key, vec)
+                return vec
+
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, text, deployment, vec):
+        key = make_key(text, deployment)
+        vec = np.asarray(vec, dtype="float32").reshape(-1)
+        with self.lock:
+            self._store(key, vec)
+        if self.disk is not None:
+            try:
+                self.disk.put(key, vec)
+            except Exception as e:
+                print("⚠️ Embedding disk cache write failed:", e)
+
+    def _store(self, key, vec):
+        self.entries[key] = (vec, time.time())
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_ratio": (self.hits + self.disk_hits) / lookups if lookups else 0.0
+            }
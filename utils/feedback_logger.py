@@ -1,16 +1,38 @@
 import os
-import json
+import io
+import csv
+import glob
+import time
+import uuid
+import queue
+import atexit
+import threading
 from datetime import datetime
-from azure.storage.blob import BlobServiceClient
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError
 from dotenv import load_dotenv
+from utils.clients import get_blob_service_client
 
 # Load environment variables from .env file
 load_dotenv()
 
 # Azure Blob Storage configuration
-AZURE_CONNECTION_STRING = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 CONTAINER_NAME = os.getenv("FEEDBACK_CONTAINER_NAME")
-BLOB_NAME = "feedback.csv"
+BLOB_NAME = "feedback.csv"  # legacy single-file layout, still read by read_feedback
+# feedback_id is unique per record, so readers can drop rows a retried append wrote twice (empty in older rows)
+FEEDBACK_HEADER = ["timestamp", "strategy", "prompt_version", "model_name", "feedback", "title", "chat_history", "feedback_id"]
+
+# Sink configuration: "blob" (append blobs) or "local" (segment files, for testing)
+FEEDBACK_BACKEND = os.getenv("FEEDBACK_BACKEND", "blob")
+FEEDBACK_PREFIX = os.getenv("FEEDBACK_PREFIX", "feedback/")
+FEEDBACK_LOCAL_DIR = os.getenv("FEEDBACK_LOCAL_DIR", "feedback")
+FEEDBACK_SPOOL_DIR = os.getenv("FEEDBACK_SPOOL_DIR", os.path.join("logs", "feedback_spool"))
+FEEDBACK_BATCH_SIZE = int(os.getenv("FEEDBACK_BATCH_SIZE", "50"))
+FEEDBACK_FLUSH_SECONDS = float(os.getenv("FEEDBACK_FLUSH_SECONDS", "5"))
+FEEDBACK_WRITE_ATTEMPTS = 3
+
+# Azure append blocks are limited to 4 MiB
+MAX_APPEND_BLOCK_BYTES = 4 * 1024 * 1024
 
 # Convert feedback data to a CSV row
 def feedback_to_csv_row(data):
@@ -21,41 +43,250 @@ def feedback_to_csv_row(data):
         data["model_name"],
         data["feedback"],
         data.get("title", ""),
-        data.get("messages", "") # Full chat history as a plain text
+        data.get("messages", ""), # Full chat history as a plain text
+        data.get("feedback_id", "")
     ]
 
-# Upload or append feedback to Azure Blob Storage
-def log_feedback_to_blob(feedback_data):
-    blob_service_client = BlobServiceClient.from_connection_string(AZURE_CONNECTION_STRING)
-    container_client = blob_service_client.get_container_client(CONTAINER_NAME)
-    blob_client = container_client.get_blob_client(BLOB_NAME)
-
-    # Prepare CSV row
-    csv_row = feedback_to_csv_row(feedback_data)
-    csv_line = ",".join(f'"{item}"' for item in csv_row) + "\n"
-
-    # Check if blob exists
-    try:
-        existing_data = blob_client.download_blob().readall().decode("utf-8")
-        updated_data = existing_data + csv_line
-    except Exception:
-        # If blob doesn't exist, create with header
-        header = ["timestamp", "strategy", "prompt_version", "model_name", "feedback", "title", "chat_history"]
-        updated_data = ",".join(header) + "\n" + csv_line
-
-    # Upload updated content
-    blob_client.upload_blob(updated_data, overwrite=True)
-    print("✅ Feedback logged to Azure Blob Storage.")
-
-# Public function to be imported
-def log_feedback(strategy, prompt_version, model_name, feedback, title, messages):
-    feedback_data = {
+# Function to render records as properly quoted CSV text (transcripts contain quotes and newlines)
+def feedback_to_csv(records):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    writer.writerows(feedback_to_csv_row(record) for record in records)
+    return buffer.getvalue()
+
+# Function to tell a header row apart from data, including the legacy feedback.csv header,
+# which predates feedback_id and so has fewer columns
+def is_header_row(row):
+    return bool(row) and row == FEEDBACK_HEADER[:len(row)]
+
+# Function to pack records into CSV blocks of whole rows that each fit in one append block
+def feedback_blocks(records):
+    blocks, current, size = [], [], 0
+    for record in records:
+        row = feedback_to_csv([record])
+        row_size = len(row.encode("utf-8"))
+        if current and size + row_size > MAX_APPEND_BLOCK_BYTES:
+            blocks.append("".join(current))
+            current, size = [], 0
+        current.append(row)
+        size += row_size
+    if current:
+        blocks.append("".join(current))
+    return blocks
+
+# Function to drop repeated feedback_ids from a DataFrame of feedback rows, keeping the first
+def drop_duplicate_feedback(df):
+    if "feedback_id" not in df:
+        return df
+    ids = df["feedback_id"].fillna("")
+    return df[(ids == "") | ~ids.duplicated()]
+
+# Function to pick the time partition for a record, e.g. "date=2025-06-17/hour=09"
+def partition_for(record):
+    timestamp = datetime.fromisoformat(record["timestamp"])
+    return timestamp.strftime("date=%Y-%m-%d/hour=%H")
+
+
+# Append-only partitions in blob storage: one append blob per hour, shared by all workers.
+# Appending a block is atomic, so concurrent writers never lose rows.
+class BlobAppendBackend:
+    def __init__(self, container=CONTAINER_NAME, prefix=FEEDBACK_PREFIX):
+        self.container_client = get_blob_service_client().get_container_client(container)
+        self.prefix = prefix
+        self.created = set()
+
+    def append(self, partition, data):
+        blob_client = self.container_client.get_blob_client(f"{self.prefix}{partition}.csv")
+        if partition not in self.created:
+            try:
+                blob_client.create_append_blob(etag="*", match_condition=MatchConditions.IfMissing)
+            except HttpResponseError as e:
+                if e.status_code not in (409, 412):
+                    raise
+            self.created.add(partition)
+        payload = data.encode("utf-8")
+        # Callers pass one block of whole rows; only a single row over the limit takes several calls
+        for start in range(0, len(payload), MAX_APPEND_BLOCK_BYTES):
+            blob_client.append_block(payload[start:start + MAX_APPEND_BLOCK_BYTES])
+
+    # Segments plus the legacy feedback.csv, oldest first
+    def list_segments(self):
+        return sorted(self.segment_sizes())
+
+    # Function to list segments with their sizes in bytes, so readers can fetch only what was appended
+    def segment_sizes(self):
+        blobs = self.container_client.list_blobs(name_starts_with=self.prefix.rstrip("/"))
+        return {blob.name: blob.size for blob in blobs if blob.name.endswith(".csv")}
+
+    def read_segment(self, name, offset=0):
+        return self.read_segment_bytes(name, offset).decode("utf-8")
+
+    def read_segment_bytes(self, name, offset=0):
+        return self.container_client.get_blob_client(name).download_blob(offset=offset or None).readall()
+
+
+# Same layout as segment files on local disk, for tests and offline runs
+class LocalFileBackend:
+    def __init__(self, directory=FEEDBACK_LOCAL_DIR):
+        self.directory = directory
+
+    def append(self, partition, data):
+        path = os.path.join(self.directory, f"{partition}.csv")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a", encoding="utf-8", newline="") as f:
+            f.write(data)
+
+    def list_segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, "**", "*.csv"), recursive=True))
+
+    def segment_sizes(self):
+        return {name: os.path.getsize(name) for name in self.list_segments()}
+
+    def read_segment(self, name, offset=0):
+        return self.read_segment_bytes(name, offset).decode("utf-8")
+
+    def read_segment_bytes(self, name, offset=0):
+        with open(name, "rb") as f:
+            f.seek(offset)
+            return f.read()
+
+
+def create_backend(kind=FEEDBACK_BACKEND):
+    if kind == "local":
+        return LocalFileBackend()
+    return BlobAppendBackend()
+
+
+# In-process queue drained by a background thread that writes batches on size/time thresholds.
+# Callers only enqueue, so the HTTP handler returns immediately.
+class FeedbackSink:
+    def __init__(self, backend_factory=create_backend, batch_size=FEEDBACK_BATCH_SIZE, flush_seconds=FEEDBACK_FLUSH_SECONDS):
+        self.backend_factory = backend_factory
+        self.backend = None
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, record):
+        self._ensure_started()
+        self.queue.put(record)
+
+    # Function to block until everything queued so far has been written
+    def flush(self, timeout=30):
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def _ensure_started(self):
+        # Started lazily so each gunicorn worker gets its own thread after fork
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="feedback-sink", daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        batch = []
+        deadline = None
+        while True:
+            timeout = None if not batch else max(0.0, deadline - time.monotonic())
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, threading.Event):
+                self._write(batch)
+                batch, deadline = [], None
+                item.set()
+                continue
+            if item is not None:
+                batch.append(item)
+                deadline = deadline or time.monotonic() + self.flush_seconds
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self._write(batch)
+                batch, deadline = [], None
+
+    def _write(self, batch):
+        if not batch:
+            return
+        partitions = {}
+        for record in batch:
+            partitions.setdefault(partition_for(record), []).append(record)
+
+        for partition, records in partitions.items():
+            # Blocks already appended are never sent again, so a failure part way through only
+            # retries (or spools) the rest of the batch
+            blocks = feedback_blocks(records)
+            committed = 0
+            for attempt in range(FEEDBACK_WRITE_ATTEMPTS):
+                try:
+                    if self.backend is None:
+                        self.backend = self.backend_factory()
+                    while committed < len(blocks):
+                        self.backend.append(partition, blocks[committed])
+                        committed += 1
+                    print(f"✅ Logged {len(records)} feedback records to {partition}.")
+                    break
+                except Exception as e:
+                    print(f"⚠️ Feedback write failed (attempt {attempt + 1}):", e)
+                    # Back off only before another attempt; after the last one the rows are spooled at once
+                    if attempt + 1 < FEEDBACK_WRITE_ATTEMPTS:
+                        time.sleep(2 ** attempt)
+            else:
+                # Keep the remaining rows on local disk rather than dropping them
+                spool = LocalFileBackend(FEEDBACK_SPOOL_DIR)
+                for block in blocks[committed:]:
+                    spool.append(partition, block)
+                print(f"❌ Spooled {len(blocks) - committed} of {len(blocks)} feedback blocks for {partition} to {FEEDBACK_SPOOL_DIR}.")
+
+
+feedback_sink = FeedbackSink()
+atexit.register(feedback_sink.flush, 10)
+
+def build_feedback_record(strategy, prompt_version, model_name, feedback, title, messages):
+    return {
         "timestamp": datetime.utcnow().isoformat(),
         "strategy": strategy,
         "prompt_version": prompt_version,
         "model_name": model_name,
         "feedback": feedback,
         "title": title,
-        "messages": messages  # full chat history
+        "messages": messages,  # full chat history
+        "feedback_id": uuid.uuid4().hex
     }
-    log_feedback_to_blob(feedback_data)
\ No newline at end of file
+
+# Public function to be imported; only enqueues
+def log_feedback(strategy, prompt_version, model_name, feedback, title, messages):
+    feedback_sink.submit(build_feedback_record(strategy, prompt_version, model_name, feedback, title, messages))
+
+# Enqueueing never blocks, so the ASGI app can call this directly. Batches are written by the same
+# sink thread as the Flask app's (sync blob client), which keeps retries, resume and spooling in one place
+async def log_feedback_async(strategy, prompt_version, model_name, feedback, title, messages):
+    log_feedback(strategy, prompt_version, model_name, feedback, title, messages)
+
+# Function to read every partition (and the legacy feedback.csv) as one table
+def read_feedback(backend=None):
+    import pandas as pd
+
+    backend = backend or create_backend()
+    rows = []
+    for name in backend.list_segments():
+        for row in csv.reader(io.StringIO(backend.read_segment(name))):
+            if not row or is_header_row(row):
+                continue
+            rows.append((row + [""] * len(FEEDBACK_HEADER))[:len(FEEDBACK_HEADER)])
+    df = drop_duplicate_feedback(pd.DataFrame(rows, columns=FEEDBACK_HEADER))
+    return df.sort_values("timestamp", kind="stable").reset_index(drop=True)
+
+# Compact all partitions into a single CSV
+if __name__ == "__main__":
+    import sys
+
+    output_path = sys.argv[1] if len(sys.argv) > 1 else "feedback_compacted.csv"
+    df = read_feedback()
+    df.to_csv(output_path, index=False)
+    print(f"✅ Compacted {len(df)} feedback records to {output_path}")
@@ -0,0 +1,160 @@
+import os
+from collections import Counter
+import numpy as np
+from utils.rerankers import tokenize
+
+# BM25 inverted index over the chunk texts, stored as compact postings arrays:
+#   terms        - sorted vocabulary ("\n"-joined UTF-8; tokens never contain a newline)
+#   term_offsets - postings of term t are doc_ids/tfs[term_offsets[t]:term_offsets[t + 1]]
+#   doc_ids      - int32 chunk ids, ascending within each term
+#   tfs          - uint16 term frequencies
+#   doc_lens     - int32 token count per chunk
+LEXICAL_INDEX_FILE_NAME = "lexical_index.npz"
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+
+class LexicalIndex:
+    # fingerprint identifies the corpus the postings were built from (see utils.chunk_store.corpus_fingerprint)
+    def __init__(self, terms, term_offsets, doc_ids, tfs, doc_lens, k1=BM25_K1, b=BM25_B, fingerprint=None):
+        self.fingerprint = fingerprint
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        self.k1 = k1
+        n_docs = len(doc_lens)
+        avgdl = float(doc_lens.mean()) if n_docs else 1.0
+        # Per-document part of the BM25 denominator, so a query only does lookups and adds
+        self.length_norm = (k1 * (1 - b + b * doc_lens / max(avgdl, 1e-9))).astype("float32")
+        df = np.diff(term_offsets).astype("float32")
+        self.idf = np.log1p((n_docs - df + 0.5) / (df + 0.5)).astype("float32")
+
+    def __len__(self):
+        return len(self.doc_lens)
+
+    def query_terms(self, query):
+        return [self.term_ids[term] for term in dict.fromkeys(tokenize(query)) if term in self.term_ids]
+
+    def postings(self, term_id):
+        start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+        return self.doc_ids[start:end], self.tfs[start:end]
+
+    def term_scores(self, term_id, docs, tfs):
+        tfs = tfs.astype("float32")
+        return self.idf[term_id] * tfs * (self.k1 + 1) / (tfs + self.length_norm[docs])
+
+    # Function to return the top-n chunks for a query by BM25, as (scores, chunk ids), best first.
+    # allowed (sorted chunk ids) restricts the postings to the chunks in scope of a filter.
+    def search(self, query, n, allowed=None):
+        term_ids = self.query_terms(query)
+        if not term_ids or (allowed is not None and len(allowed) == 0):
+            return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+        docs = []
+        scores = []
+        for term_id in term_ids:
+            term_docs, term_tfs = self.postings(term_id)
+            if allowed is not None:
+                positions = np.minimum(np.searchsorted(allowed, term_docs), len(allowed) - 1)
+                in_scope = allowed[positions] == term_docs
+                term_docs, term_tfs = term_docs[in_scope], term_tfs[in_scope]
+            docs.append(term_docs)
+            scores.append(self.term_scores(term_id, term_docs, term_tfs))
+        if not any(len(term_docs) for term_docs in docs):
+            return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+        unique_docs, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores)).astype("float32")
+        if len(totals) > n:
+            top = np.argpartition(-totals, n - 1)[:n]
+        else:
+            top = np.arange(len(totals))
+        top = top[np.lexsort((unique_docs[top], -totals[top]))]
+        return totals[top], unique_docs[top].astype("int64")
+
+    # Function to BM25-score given candidate chunks (used by the local reranker).
+    # texts is accepted for compatibility with scorers that tokenize on the fly; postings are used instead.
+    def score(self, query, doc_ids, texts=None):
+        doc_ids = np.asarray(doc_ids, dtype="int64")
+        totals = np.zeros(len(doc_ids), dtype="float32")
+        if len(doc_ids) == 0:
+            return totals
+        for term_id in self.query_terms(query):
+            term_docs, term_tfs = self.postings(term_id)
+            positions = np.minimum(np.searchsorted(term_docs, doc_ids), len(term_docs) - 1)
+            found = term_docs[positions] == doc_ids
+            if found.any():
+                totals[found] += self.term_scores(term_id, doc_ids[found], term_tfs[positions[found]])
+        return totals
+
+    def save(self, path):
+        terms = sorted(self.term_ids, key=self.term_ids.get)
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                terms=np.frombuffer("\n".join(terms).encode("utf-8"), dtype="uint8"),
+                term_offsets=self.term_offsets,
+                doc_ids=self.doc_ids,
+                tfs=self.tfs,
+                doc_lens=self.doc_lens,
+                fingerprint=np.str_(self.fingerprint or "")
+            )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            terms_blob = data["terms"].tobytes().decode("utf-8")
+            return cls(
+                terms_blob.split("\n") if terms_blob else [],
+                data["term_offsets"],
+                data["doc_ids"],
+                data["tfs"],
+                data["doc_lens"],
+                fingerprint=str(data["fingerprint"]) if "fingerprint" in data else None
+            )
+
+
+# Function to build the inverted index from the chunk texts, in chunk-id order
+def build_lexical_index(texts, fingerprint=None):
+    postings = {}
+    doc_lens = []
+    for doc_id, text in enumerate(texts):
+        tokens = tokenize(text)
+        doc_lens.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            postings.setdefault(term, []).append((doc_id, tf))
+
+    terms = sorted(postings)
+    term_offsets = np.zeros(len(terms) + 1, dtype="int64")
+    term_offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+    doc_ids = np.empty(term_offsets[-1], dtype="int32")
+    tfs = np.empty(term_offsets[-1], dtype="uint16")
+    for i, term in enumerate(terms):
+        entries = np.array(postings[term], dtype="int64")
+        doc_ids[term_offsets[i]:term_offsets[i + 1]] = entries[:, 0]
+        tfs[term_offsets[i]:term_offsets[i + 1]] = np.minimum(entries[:, 1], np.iinfo(np.uint16).max)
+    return LexicalIndex(terms, term_offsets, doc_ids, tfs, np.array(doc_lens, dtype="int32"), fingerprint=fingerprint)
+
+# Function to load the persisted lexical index, rebuilding and saving it when missing or stale.
+# With a fingerprint, an index built from another corpus is stale even when the chunk count matches.
+def load_or_build_lexical_index(path, texts, n_docs, fingerprint=None):
+    if os.path.exists(path):
+        try:
+            lexical_index = LexicalIndex.load(path)
+            if len(lexical_index) == n_docs and (fingerprint is None or lexical_index.fingerprint == fingerprint):
+                return lexical_index
+        except Exception as e:
+            print("⚠️ Failed to load lexical index:", e)
+    lexical_index = build_lexical_index(texts, fingerprint)
+    lexical_index.save(path)
+    return lexical_index
+
+# Function to fuse several ranked id lists by reciprocal rank: score(d) = sum 1 / (k + rank)
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[int(doc_id)] = fused.get(int(doc_id), 0.0) + 1.0 / (k + rank)
+    # Ties keep the order of first appearance (vector results first)
+    return sorted(fused, key=fused.get, reverse=True)
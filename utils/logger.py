@@ -1,27 +1,215 @@
 from loguru import logger
 import os
+import time
+import json
+import queue
+import atexit
+import random
+import threading
 from datetime import datetime
+from utils.metrics import current_trace, registry
 
-LOG_DIR = "logs"
+LOG_DIR = os.getenv("LOG_DIR", "logs")
 os.makedirs(LOG_DIR, exist_ok=True)
 
-logger.add(os.path.join(LOG_DIR, "chatbot.log"), rotation="1 MB", retention="10 days")
+# "jsonl": one JSON object per line with a fixed schema, written by a background thread (default).
+# "text": the older dict-repr lines in chatbot.log, written inline.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "jsonl")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # records waiting for the writer; beyond it they are dropped
+LOG_ROTATION_MB = float(os.getenv("LOG_ROTATION_MB", "50"))
+LOG_ROTATION_HOURS = float(os.getenv("LOG_ROTATION_HOURS", "24"))
+LOG_RETENTION = os.getenv("LOG_RETENTION", "10 days")
+LOG_COMPRESSION = os.getenv("LOG_COMPRESSION", "gz")
+# Large text fields (responses, error contexts) are cut to LOG_MAX_FIELD_CHARS except in a
+# LOG_FULL_TEXT_SAMPLE_RATE fraction of records, which keep them whole
+LOG_MAX_FIELD_CHARS = int(os.getenv("LOG_MAX_FIELD_CHARS", "1000"))
+LOG_FULL_TEXT_SAMPLE_RATE = float(os.getenv("LOG_FULL_TEXT_SAMPLE_RATE", "0.1"))
+LOG_SCHEMA_VERSION = 1
 
-def log_interaction(user_query, strategy, response, prompt_version, model_name, tokens_used=None):
-    log_data = {
+records_dropped = registry.counter("rag_log_records_dropped_total", "Log records dropped because the writer queue was full.")
+
+# JSON lines are logged at their own level, below TRACE, so only the file handlers added here receive
+# them; handlers configured elsewhere in the process (the default stderr one included) are left alone
+JSONL_LEVEL = "JSONL"
+try:
+    logger.level(JSONL_LEVEL, no=1)
+except ValueError:
+    pass  # already registered (module reloaded)
+
+text_handler_id = None
+if LOG_FORMAT == "text":
+    text_handler_id = logger.add(os.path.join(LOG_DIR, "chatbot.log"), rotation="1 MB", retention="10 days")
+
+
+# Rotate on whichever comes first: file size or age
+class RotationPolicy:
+    def __init__(self, max_bytes, max_seconds):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.opened = None
+
+    def __call__(self, message, file):
+        now = time.time()
+        if self.opened is None:
+            self.opened = now
+        if (self.max_bytes and file.tell() + len(message) > self.max_bytes) or (self.max_seconds and now - self.opened >= self.max_seconds):
+            self.opened = now
+            return True
+        return False
+
+# Function to cut a large text field, unless this record keeps full text
+def sample_text(value, full_text):
+    if full_text or not isinstance(value, str) or len(value) <= LOG_MAX_FIELD_CHARS:
+        return value
+    return value[:LOG_MAX_FIELD_CHARS] + "…"
+
+
+# Queue of log records drained by a background thread that serializes them to JSON lines and
+# writes them to logs/<name>.<pid>.jsonl (one file per worker, so rotation never races).
+# Callers only enqueue, so a chat turn never waits on serialization or disk.
+class JsonlLogWriter:
+    def __init__(self, name="interactions", directory=LOG_DIR, max_queue=LOG_QUEUE_SIZE):
+        self.name = name
+        self.directory = directory
+        self.queue = queue.Queue(max_queue)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        self.channels = {}
+        self.handler_ids = {}
+
+    def submit(self, record):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            records_dropped.inc()
+
+    # Function to block until everything queued so far has been written
+    def flush(self, timeout=30):
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait(timeout)
+
+    def _ensure_started(self):
+        # Started lazily so each gunicorn worker gets its own thread (and file) after fork
+        if self.thread is not None and self.pid == os.getpid() and self.thread.is_alive():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid() or not self.thread.is_alive():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self._run, name=f"{self.name}-log-writer", daemon=True)
+                self.thread.start()
+
+    # Function to add this process's file handler once and return a logger bound to it
+    def _open(self):
+        channel = f"{self.name}.{os.getpid()}"
+        if channel in self.channels:
+            return self.channels[channel]
+        self.handler_ids[channel] = logger.add(
+            os.path.join(self.directory, f"{channel}.jsonl"),
+            level=JSONL_LEVEL,
+            format="{message}",
+            filter=lambda record: record["extra"].get("jsonl") == channel and record["level"].name == JSONL_LEVEL,
+            rotation=RotationPolicy(LOG_ROTATION_MB * 1024 * 1024, LOG_ROTATION_HOURS * 3600),
+            retention=LOG_RETENTION,
+            compression=LOG_COMPRESSION or None,
+            catch=True
+        )
+        self.channels[channel] = logger.bind(jsonl=channel)
+        return self.channels[channel]
+
+    def _run(self):
+        log = self._open()
+        while True:
+            item = self.queue.get()
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+            try:
+                if item.get("event") == "error":
+                    # The console line of an error is emitted here too, off the request thread
+                    logger.error(f"{item['error']} (trace {item['trace_id']})")
+                log.log(JSONL_LEVEL, json.dumps(self._sampled(item), ensure_ascii=False, default=str))
+            except Exception as e:
+                print("⚠️ Log write failed:", e)
+
+    def _sampled(self, record):
+        full_text = random.random() < LOG_FULL_TEXT_SAMPLE_RATE
+        record["full_text"] = full_text
+        if "response" in record:
+            record["response"] = sample_text(record["response"], full_text)
+        if isinstance(record.get("context"), dict):
+            record["context"] = {key: sample_text(value, full_text) for key, value in record["context"].items()}
+        return record
+
+
+interaction_log = JsonlLogWriter()
+atexit.register(interaction_log.flush, 5)
+
+# Stage spans of the current request: ids, parent ids and durations, so a slow reply can be attributed
+def trace_fields():
+    trace = current_trace()
+    if trace is None:
+        return {"trace_id": None, "latency_ms": None, "spans": []}
+    return {"trace_id": trace.id, "latency_ms": round((time.perf_counter() - trace.start) * 1000, 1), "spans": list(trace.spans)}
+
+def log_interaction(user_query, strategy, response, prompt_version, model_name, tokens_used=None, index_version=None,
+                    prompt_tokens=None, completion_tokens=None):
+    trace = trace_fields()
+    if LOG_FORMAT == "text":
+        logger.info({
+            "timestamp": datetime.utcnow().isoformat(),
+            "query": user_query,
+            "strategy": strategy,
+            "response": response,
+            "prompt_version": prompt_version,
+            "index_version": index_version,
+            "model": model_name,
+            "tokens_used": tokens_used,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            **trace
+        })
+        return
+    # Every interaction record has these keys, in this order (null when unknown)
+    interaction_log.submit({
+        "schema": LOG_SCHEMA_VERSION,
+        "event": "interaction",
         "timestamp": datetime.utcnow().isoformat(),
+        "trace_id": trace["trace_id"],
         "query": user_query,
         "strategy": strategy,
-        "response": response,
         "prompt_version": prompt_version,
+        "index_version": index_version,
         "model": model_name,
-        "tokens_used": tokens_used
-    }
-    logger.info(log_data)
+        "latency_ms": trace["latency_ms"],
+        "tokens_used": tokens_used,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "response_chars": len(response or ""),
+        "response": response,
+        "spans": trace["spans"]
+    })
 
 def log_error(error_message, context=None):
-    logger.error({
+    trace_id = trace_fields()["trace_id"]
+    if LOG_FORMAT == "text":
+        logger.error({
+            "timestamp": datetime.utcnow().isoformat(),
+            "error": error_message,
+            "context": context,
+            "trace_id": trace_id
+        })
+        return
+    # Queued like interactions; the writer thread also prints it to the console handlers
+    interaction_log.submit({
+        "schema": LOG_SCHEMA_VERSION,
+        "event": "error",
         "timestamp": datetime.utcnow().isoformat(),
+        "trace_id": trace_id,
         "error": error_message,
-        "context": context
-    })
\ No newline at end of file
+        "context": dict(context) if context else {}
+    })
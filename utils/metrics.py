@@ -0,0 +1,229 @@
+import os
+import time
+import bisect
+import inspect
+import secrets
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Request tracing and process metrics. Each chat request gets a trace; pipeline stages run in spans
+# that feed per-stage duration histograms and are listed, with their ids, on the request's log record.
+# Metrics are kept per worker process and rendered in the Prometheus text format at /metrics.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted((label_values, (list(counts), total, count)) for label_values, (counts, total, count) in self.series.items())
+        for label_values, (counts, total, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_label = 'le="' + le + '"'
+                lines.append(f"{self.name}_bucket{_labels(self.labels, label_values, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, label_values)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.labels, label_values)} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = []
+        self.caches = {}
+
+    def counter(self, name, description, labels=()):
+        metric = Counter(name, description, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        metric = Histogram(name, description, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    # Function to report a cache from its own stats() (hits, misses, size), read at scrape time
+    def register_cache(self, name, stats):
+        self.caches[name] = stats
+
+    def render_caches(self):
+        samples = {"rag_cache_hits_total": [], "rag_cache_misses_total": [], "rag_cache_hit_ratio": [], "rag_cache_entries": []}
+        for name, stats in sorted(self.caches.items()):
+            try:
+                values = stats()
+            except Exception as e:
+                print(f"⚠️ Cache stats for {name} failed:", e)
+                continue
+            label = _labels(("cache",), (name,))
+            samples["rag_cache_hits_total"].append(f"rag_cache_hits_total{label} {values['hits'] + values.get('disk_hits', 0)}")
+            samples["rag_cache_misses_total"].append(f"rag_cache_misses_total{label} {values['misses']}")
+            samples["rag_cache_hit_ratio"].append(f"rag_cache_hit_ratio{label} {values['hit_ratio']}")
+            samples["rag_cache_entries"].append(f"rag_cache_entries{label} {values['size']}")
+        types = {"rag_cache_hits_total": "counter", "rag_cache_misses_total": "counter", "rag_cache_hit_ratio": "gauge", "rag_cache_entries": "gauge"}
+        lines = []
+        for name, metric_samples in samples.items():
+            if metric_samples:
+                lines += [f"# TYPE {name} {types[name]}"] + metric_samples
+        return lines
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.extend(self.render_caches())
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+stage_duration = registry.histogram("rag_stage_duration_seconds", "Time spent in each pipeline stage.", ("stage",))
+stage_errors = registry.counter("rag_stage_errors_total", "Pipeline stages that raised, by exception type.", ("stage", "error"))
+token_usage = registry.counter("rag_tokens_total", "Tokens used by Azure OpenAI calls (counted locally when a stream reports no usage).", ("operation", "model", "kind"))
+upstream_responses = registry.counter("rag_upstream_responses_total", "HTTP responses from Azure services, by status (every attempt).", ("service", "status"))
+upstream_retries = registry.counter("rag_upstream_retries_total", "Requests to Azure services that were retries.", ("service",))
+
+def render_metrics():
+    return registry.render()
+
+def register_cache(name, stats):
+    registry.register_cache(name, stats)
+
+# Function to count the prompt/completion tokens of an Azure OpenAI usage object (or dict)
+def record_usage(operation, model, usage):
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        tokens = usage.get(kind) if isinstance(usage, dict) else getattr(usage, kind, None)
+        if tokens:
+            token_usage.inc(operation, model or "unknown", kind.split("_")[0], amount=tokens)
+
+
+# One request's trace: its id, start time and the spans finished so far, in finishing order
+class Trace:
+    def __init__(self):
+        self.id = secrets.token_hex(8)
+        self.start = time.perf_counter()
+        self.spans = []
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_span = contextvars.ContextVar("span", default=None)
+
+# Function to start a new trace for the request running in this context (threads started with
+# asyncio.to_thread inherit it)
+def start_trace():
+    trace = Trace()
+    _current_trace.set(trace)
+    _current_span.set(None)
+    return trace
+
+def current_trace():
+    return _current_trace.get()
+
+
+class Span:
+    def __init__(self, stage):
+        self.stage = stage
+        self.id = secrets.token_hex(4)
+        self.parent_id = _current_span.get()
+        self.trace = _current_trace.get()
+        self.start = time.perf_counter()
+
+    def end(self, error=None):
+        if not METRICS_ENABLED:
+            return
+        duration = time.perf_counter() - self.start
+        stage_duration.observe(duration, self.stage)
+        if error is not None:
+            stage_errors.inc(self.stage, type(error).__name__)
+        if self.trace is not None:
+            record = {"span_id": self.id, "parent_id": self.parent_id, "stage": self.stage, "duration_ms": round(duration * 1000, 2)}
+            if error is not None:
+                record["error"] = type(error).__name__
+            self.trace.spans.append(record)
+
+# Function to time a block as a stage of the current trace; stages opened inside it become its children
+@contextmanager
+def span(stage):
+    current = Span(stage)
+    token = _current_span.set(current.id)
+    error = None
+    try:
+        yield current
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end(error)
+
+# Function to start a span that is ended explicitly, for work that spans generator yields (streams)
+def start_span(stage):
+    return Span(stage)
+
+# Decorator running a function (or coroutine function) in a span
+def traced(stage):
+    def decorator(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,9 +1,65 @@
 import os
 import json
+import string
+import threading
+from utils.artifacts import file_fingerprint
+from utils.artifact_registry import ArtifactRegistry
 
-def load_prompt(version="v1"):
-    base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
-    prompt_path = os.path.join(base_dir, 'prompts', f'{version}_prompts.json')
+PROMPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'prompts'))
+PROMPT_CHECK_INTERVAL = float(os.getenv("PROMPT_CHECK_INTERVAL", "5"))  # seconds between file checks
+PROMPT_FIELDS = {"context", "query"}
+
+def prompt_path(version):
+    return os.path.join(PROMPTS_DIR, f'{version}_prompts.json')
+
+
+# One parsed and checked prompt file. version is "<file version>@<fingerprint>", so an edited
+# file gets a new version in logs, responses and answer-cache keys.
+class PromptSet:
+    def __init__(self, version, data):
+        self.version = version
+        self.data = data
+        self.templates = {mode: strategy["template"] for mode, strategy in data["strategies"].items()}
+
+    def render(self, mode, **fields):
+        template = self.templates.get(mode, self.templates["default"])
+        return template.format(**fields)
+
+# Function to parse a prompt file and check every template, so a bad edit is rejected at load
+# rather than failing requests
+def compile_prompts(path, version):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if "default" not in data.get("strategies", {}):
+        raise ValueError(f"{path} has no default strategy")
+    for mode, strategy in data["strategies"].items():
+        fields = {field for _, field, _, _ in string.Formatter().parse(strategy["template"]) if field is not None}
+        if not fields <= PROMPT_FIELDS:
+            raise ValueError(f"Template '{mode}' in {path} uses unknown fields {sorted(fields - PROMPT_FIELDS)}")
+    return PromptSet(version, data)
+
+# Function to create the registry for one prompt file: parsed once, re-checked at most every
+# PROMPT_CHECK_INTERVAL seconds and recompiled when the file changes
+def create_prompt_registry(version, check_interval=PROMPT_CHECK_INTERVAL):
+    path = prompt_path(version)
 
-    with open(prompt_path, "r", encoding="utf-8") as f:
-        return json.load(f)
\ No newline at end of file
+    def sync():
+        return f"{version}@{file_fingerprint([path])[:8]}", None
+
+    def load(prompt_version, _):
+        return compile_prompts(path, prompt_version)
+
+    return ArtifactRegistry(f"prompts {version}", sync, load, check_interval)
+
+prompt_registries = {}
+registries_lock = threading.Lock()
+
+# Function to get the active prompt set for a version
+def get_prompts(version="v1"):
+    with registries_lock:
+        if version not in prompt_registries:
+            prompt_registries[version] = create_prompt_registry(version)
+    return prompt_registries[version].get()
+
+def load_prompt(version="v1"):
+    return get_prompts(version).data
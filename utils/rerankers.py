@@ -0,0 +1,52 @@
+import re
+import numpy as np
+
+# Weight of the FAISS similarity in the local reranker; the rest goes to BM25
+LOCAL_RERANK_VECTOR_WEIGHT = 0.6
+
+# Keeps numbers like "45%" and "2.5" together as single terms
+TOKEN_PATTERN = re.compile(r"\d+(?:[.,]\d+)*%?|[a-z0-9]+")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def min_max(values):
+    values = np.asarray(values, dtype="float32")
+    if len(values) == 0:
+        return values
+    spread = values.max() - values.min()
+    if spread == 0:
+        return np.ones_like(values)
+    return (values - values.min()) / spread
+
+# Function to rerank candidates locally: BM25 blended with the FAISS similarity, CPU only.
+# scorer is anything with score(query, doc_ids, texts), e.g. utils.lexical_index.LexicalIndex.
+def local_rerank(query, chunks, similarities, chunk_ids, scorer, vector_weight=LOCAL_RERANK_VECTOR_WEIGHT):
+    if not chunks:
+        return []
+    lexical = scorer.score(query, chunk_ids, [chunk["text"] for chunk in chunks])
+    combined = vector_weight * min_max(similarities) + (1 - vector_weight) * min_max(lexical)
+    # Stable sort keeps FAISS order on ties
+    order = np.argsort(-combined, kind="stable")
+    return [chunks[i] for i in order]
+
+# A line that is only a list of chunk numbers ("3, 1, 2") and the number a line starts with ("2. ...", "[4] ...")
+NUMBER_LIST_LINE = re.compile(r"^[\s\d,.;\[\]]+$")
+LEADING_NUMBER = re.compile(r"\s*\[?(\d+)")
+
+# Function to parse the chunk numbers out of an LLM ranking reply, ignoring duplicates and out-of-range values.
+# Only whole number lists and the leading number of a line count, so figures in prose ("covers 2019") do not.
+def parse_ranking(raw_output, n_chunks):
+    indices = []
+    for line in raw_output.splitlines():
+        if NUMBER_LIST_LINE.match(line):
+            numbers = re.findall(r"\d+", line)
+        else:
+            match = LEADING_NUMBER.match(line)
+            numbers = [match.group(1)] if match else []
+        for number in numbers:
+            idx = int(number) - 1
+            if 0 <= idx < n_chunks and idx not in indices:
+                indices.append(idx)
+    return indices
@@ -0,0 +1,256 @@
+import os
+import re
+import json
+import time
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+from utils.artifacts import load_faiss_index
+from utils.ann_index import load_index_meta, apply_search_params, search_parameters, to_similarity
+
+# The corpus is split into index shards, each a contiguous range of chunk ids with its own FAISS index.
+# shards.json lists them with the documents, years and sections they contain, so a filtered
+# query only searches the shards in scope.
+SHARD_MANIFEST_FILE_NAME = "shards.json"
+SHARD_BY = os.getenv("SHARD_BY", "document")  # document, year or none
+SHARD_SEARCH_WORKERS = int(os.getenv("SHARD_SEARCH_WORKERS", "4"))
+
+# Every build uploads its files under a new generations/<id>/ prefix and never overwrites the files of
+# another build; the manifest, uploaded last, is what switches readers over to it.
+# shards/ holds the stable-named shards of builds from before generations existed.
+GENERATIONS_PREFIX = "generations/"
+LEGACY_SHARDS_PREFIX = "shards/"
+
+# Filter keys accepted by retrieve_top_k, mapped to chunk fields
+FILTER_FIELDS = {"document": "source", "source": "source", "year": "year", "section": "section"}
+SHARD_VALUE_FIELDS = ["source", "year", "section"]
+
+def shard_key(chunk, shard_by=SHARD_BY):
+    if shard_by == "document":
+        return str(chunk.get("source", "unknown"))
+    if shard_by == "year":
+        return str(chunk.get("year", "unknown"))
+    return "all"
+
+# Function to name a new build: sortable by time, unique across concurrent builds
+def new_generation_id():
+    return time.strftime("%Y%m%dT%H%M%S", time.gmtime()) + "-" + secrets.token_hex(4)
+
+def generation_blob_name(generation, name):
+    return f"{GENERATIONS_PREFIX}{generation}/{name}"
+
+def shard_file_name(name, generation=None):
+    file_name = "shards/" + re.sub(r"[^A-Za-z0-9._-]+", "_", name) + ".faiss"
+    return generation_blob_name(generation, file_name) if generation else file_name
+
+# Function to order chunks so every shard is one contiguous id range.
+# Returns the new order (indices into chunks) and [(shard name, start, end)] in first-seen order.
+def group_chunks_by_shard(chunks, shard_by=SHARD_BY):
+    members = {}
+    for i, chunk in enumerate(chunks):
+        members.setdefault(shard_key(chunk, shard_by), []).append(i)
+    order = []
+    groups = []
+    for name, rows in members.items():
+        groups.append((name, len(order), len(order) + len(rows)))
+        order.extend(rows)
+    return np.array(order, dtype="int64"), groups
+
+# Function to describe one shard in the manifest
+def shard_entry(name, start, end, chunks, index_meta, generation=None):
+    entry = {"name": name, "index": shard_file_name(name, generation), "id_offset": start, "ntotal": end - start, "index_meta": index_meta}
+    for field in SHARD_VALUE_FIELDS:
+        values = {chunk.get(field) for chunk in chunks}
+        # null in the list means some chunks lack the field, so the shard never fully matches a filter on it
+        entry[field] = sorted(values - {None}, key=str) + ([None] if None in values else [])
+    return entry
+
+# artifacts maps the build's other files (chunk_store, lexical_index, domain_model) to their blob names;
+# fingerprint identifies its corpus (utils.chunk_store.corpus_fingerprint)
+def save_shard_manifest(path, entries, generation=None, artifacts=None, fingerprint=None):
+    manifest = {"generation": generation, "fingerprint": fingerprint, "artifacts": artifacts or {}, "shards": entries}
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+# Function to list the blob names a manifest refers to (nothing for None)
+def manifest_blob_names(manifest):
+    if not manifest:
+        return set()
+    return {entry["index"] for entry in manifest["shards"]} | set(manifest.get("artifacts", {}).values())
+
+# Function to turn a request filter ({"document": ..., "year": [...], "section": ...}) into {field: set of values}
+def normalize_filters(filters):
+    if not filters:
+        return {}
+    normalized = {}
+    for key, values in filters.items():
+        if key not in FILTER_FIELDS:
+            raise ValueError(f"Unknown filter '{key}', expected one of {sorted(FILTER_FIELDS)}")
+        if values is None:
+            continue
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        normalized.setdefault(FILTER_FIELDS[key], set()).update(str(value) for value in values)
+    return normalized
+
+
+class IndexShard:
+    def __init__(self, name, index, meta, id_offset, values=None):
+        self.name = name
+        self.index = index
+        self.meta = meta
+        self.id_offset = id_offset
+        self.ntotal = index.ntotal
+        # Field values present in the shard; a field missing here is unknown (e.g. the single legacy index)
+        self.values = {field: {str(value) if value is not None else None for value in vals} for field, vals in (values or {}).items()}
+
+    # Function to tell from the manifest alone whether the shard can hold matching chunks
+    def in_scope(self, filters):
+        return all(field not in self.values or self.values[field] & values for field, values in filters.items())
+
+    # Function to tell whether every chunk in the shard matches, so no per-chunk selection is needed
+    def fully_in_scope(self, filters):
+        return all(field in self.values and self.values[field] <= values for field, values in filters.items())
+
+    def search(self, query_vector, n, selector=None):
+        params = search_parameters(self.index, selector) if selector is not None else None
+        scores, ids = self.index.search(query_vector, min(n, self.ntotal), params=params)
+        keep = ids[0] >= 0
+        return to_similarity(scores[0][keep], self.meta["metric"]), ids[0][keep] + self.id_offset
+
+
+# All shards behind one search call; exposes ntotal/d/reconstruct_n like a FAISS index
+class ShardedIndex:
+    def __init__(self, shards, chunk_store, workers=SHARD_SEARCH_WORKERS):
+        self.shards = shards
+        self.chunk_store = chunk_store
+        self.ntotal = sum(shard.ntotal for shard in shards)
+        self.d = shards[0].index.d
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers)) if len(shards) > 1 else None
+
+    def reconstruct_n(self, start, n):
+        vectors = np.vstack([shard.index.reconstruct_n(0, shard.ntotal) for shard in self.shards])
+        return vectors[start:start + n]
+
+    # Function to pick the shards to search and, where a shard is only partly in scope,
+    # the local ids to restrict it to. Returns [(shard, local ids or None)].
+    def plan(self, filters):
+        plan = []
+        for shard in self.shards:
+            if not shard.in_scope(filters):
+                continue
+            if shard.fully_in_scope(filters):
+                plan.append((shard, None))
+                continue
+            mask = np.ones(shard.ntotal, dtype=bool)
+            for field, values in filters.items():
+                mask &= self.chunk_store.matching(field, values, shard.id_offset, shard.id_offset + shard.ntotal)
+            local_ids = np.flatnonzero(mask)
+            if len(local_ids):
+                plan.append((shard, local_ids))
+        return plan
+
+    # Function to search the shards in scope in parallel and merge by similarity.
+    # Returns (similarities, chunk ids), best first.
+    def search(self, query_vector, n, filters=None):
+        plan = self.plan(normalize_filters(filters))
+        if not plan:
+            return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+
+        def run(item):
+            shard, local_ids = item
+            selector = faiss.IDSelectorBatch(local_ids.astype("int64")) if local_ids is not None else None
+            return shard.search(query_vector, n, selector)
+
+        results = list(self.executor.map(run, plan)) if self.executor and len(plan) > 1 else [run(item) for item in plan]
+        similarities = np.concatenate([sims for sims, _ in results])
+        ids = np.concatenate([ids for _, ids in results])
+        order = np.argsort(-similarities, kind="stable")[:n]
+        return similarities[order], ids[order]
+
+    # Function to list the chunk ids in scope (sorted), or None when nothing is filtered
+    def allowed_ids(self, filters):
+        filters = normalize_filters(filters)
+        if not filters:
+            return None
+        ranges = []
+        for shard, local_ids in self.plan(filters):
+            ranges.append(np.arange(shard.ntotal) + shard.id_offset if local_ids is None else local_ids + shard.id_offset)
+        return np.concatenate(ranges) if ranges else np.zeros(0, dtype="int64")
+
+
+# Function to refresh the local copy of the manifest. Returns (manifest, local path), or (None, None)
+# for older builds that have a single index.faiss and no manifest.
+def fetch_manifest(artifact_store, temp_dir):
+    manifest_path = os.path.join(temp_dir, SHARD_MANIFEST_FILE_NAME)
+    try:
+        artifact_store.fetch(SHARD_MANIFEST_FILE_NAME, manifest_path)
+    except FileNotFoundError:
+        return None, None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f), manifest_path
+
+# Function to refresh the local copies of every shard listed in a fetched manifest, or of the single
+# index.faiss of older builds. Returns the shard layout for open_shards and the local paths
+# whose changes mean a new index version.
+def fetch_shards(artifact_store, temp_dir, manifest=None, manifest_path=None, legacy_index_name="index.faiss", legacy_meta_name="index_meta.json"):
+    if manifest is None:
+        index_path = os.path.join(temp_dir, "index.faiss")
+        if artifact_store.fetch(legacy_index_name, index_path):
+            print(f"⬇️ Downloaded {legacy_index_name}")
+        meta_path = os.path.join(temp_dir, legacy_meta_name)
+        try:
+            artifact_store.fetch(legacy_meta_name, meta_path)
+        except FileNotFoundError:
+            # Indexes built before index_meta.json existed are plain IndexFlatL2
+            meta_path = None
+        return [{"name": "all", "path": index_path, "meta_path": meta_path, "id_offset": 0}], [index_path]
+
+    layout = []
+    paths = [manifest_path]
+    for entry in manifest["shards"]:
+        # One local file per shard name: a new build's copy replaces the old one by rename
+        index_path = os.path.join(temp_dir, "shards", os.path.basename(entry["index"]))
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        if artifact_store.fetch(entry["index"], index_path):
+            print(f"⬇️ Downloaded {entry['index']}")
+        layout.append({
+            "name": entry["name"],
+            "path": index_path,
+            "meta": entry.get("index_meta"),
+            "id_offset": entry["id_offset"],
+            "ntotal": entry.get("ntotal"),
+            "values": {field: entry[field] for field in SHARD_VALUE_FIELDS if field in entry}
+        })
+        paths.append(index_path)
+    return layout, paths
+
+# Function to open the shards of a fetched layout, memory-mapped
+def open_shards(layout):
+    shards = []
+    for item in layout:
+        index = load_faiss_index(item["path"])
+        meta = item.get("meta") or load_index_meta(item.get("meta_path"), index)
+        apply_search_params(index, meta)
+        shards.append(IndexShard(item["name"], index, meta, item["id_offset"], item.get("values")))
+    return shards
+
+# Function to check that opened shards and a chunk store come from the same build: shard sizes match
+# the manifest and the shards cover the chunk ids exactly once. Raises ValueError otherwise.
+def validate_shards(shards, layout, n_chunks):
+    next_id = 0
+    for shard, item in sorted(zip(shards, layout), key=lambda pair: pair[0].id_offset):
+        if item.get("ntotal") is not None and shard.ntotal != item["ntotal"]:
+            raise ValueError(f"Shard '{shard.name}' holds {shard.ntotal} vectors, the manifest lists {item['ntotal']}")
+        if shard.id_offset != next_id:
+            raise ValueError(f"Shard '{shard.name}' starts at chunk id {shard.id_offset}, expected {next_id}")
+        next_id += shard.ntotal
+    if next_id != n_chunks:
+        raise ValueError(f"The index holds {next_id} vectors but the chunk store has {n_chunks} chunks")
+
+# Function to fetch and open every shard. Returns the shards and the local paths of the index files.
+def load_shards(artifact_store, temp_dir, legacy_index_name="index.faiss", legacy_meta_name="index_meta.json"):
+    manifest, manifest_path = fetch_manifest(artifact_store, temp_dir)
+    layout, paths = fetch_shards(artifact_store, temp_dir, manifest, manifest_path, legacy_index_name, legacy_meta_name)
+    return open_shards(layout), paths
@@ -0,0 +1,23 @@
+import functools
+import tiktoken
+
+TOKENIZER_MODEL = "gpt-4o"
+
+# Function to create the tokenizer once per process
+@functools.lru_cache(maxsize=None)
+def get_encoder(model=TOKENIZER_MODEL):
+    return tiktoken.encoding_for_model(model)
+
+def count_tokens(text):
+    return len(get_encoder().encode(text))
+
+def count_tokens_batch(texts):
+    return [len(tokens) for tokens in get_encoder().encode_ordinary_batch(list(texts))]
+
+# Function to fill in token_count for chunks stored before counts were precomputed
+def ensure_token_counts(chunks):
+    missing = [chunk for chunk in chunks if "token_count" not in chunk]
+    if missing:
+        for chunk, count in zip(missing, count_tokens_batch(chunk["text"] for chunk in missing)):
+            chunk["token_count"] = count
+    return chunks